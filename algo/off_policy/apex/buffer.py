@@ -2,7 +2,7 @@ import numpy as np
 
 from utility.debug_tools import assert_colorize
 from utility.run_avg import RunningMeanStd
-from algo.off_policy.replay.utils import init_buffer, add_buffer, copy_buffer
+from algo.off_policy.replay.utils import init_buffer, add_buffer, copy_buffer, store_state, stack_frames
 
 
 class LocalBuffer(dict):
@@ -11,12 +11,13 @@ class LocalBuffer(dict):
         self.capacity = args['local_capacity']
         self.n_steps = args['n_steps']
         self.gamma = args['gamma']
+        self.frame_stack = args.get('frame_stack', 1)
 
         # The following two fake data members are only used to complete the data pipeline
         self.fake_ratio = np.zeros(1)
         self.fake_ids = np.zeros(1, dtype=np.int32)
 
-        init_buffer(self, self.capacity, state_shape, action_dim, True, extra_state=1)
+        init_buffer(self, self.capacity, state_shape, action_dim, True, extra_state=1, frame_stack=self.frame_stack)
 
         self.reward_scale = args['reward_scale'] if 'reward_scale' in args else 1
         self.normalize_reward = args['normalize_reward']
@@ -30,10 +31,10 @@ class LocalBuffer(dict):
         while True:
             yield (self.fake_ratio, 
                    self.fake_ids, 
-                   (self['state'][:1], 
+                   (self._get_states(np.arange(1)), 
                     self['action'][:1], 
                     self['reward'][:1],
-                    self['state'][:1], 
+                    self._get_states(np.arange(1)), 
                     self['done'][:1], 
                     self['steps'][:1]))
 
@@ -47,10 +48,10 @@ class LocalBuffer(dict):
             self.running_reward_stats.update(reward)
             reward = self.running_reward_stats.normalize(reward)
         reward *= np.where(done, 1, self.reward_scale)
-        return (self['state'][:self.idx], 
+        return (self._get_states(np.arange(self.idx)), 
                 self['action'][:self.idx], 
                 reward,
-                self['state'][1:self.idx+1], 
+                self._get_states(np.arange(1, self.idx+1)), 
                 done, 
                 self['steps'][:self.idx])
 
@@ -64,4 +65,11 @@ class LocalBuffer(dict):
         self.idx = self.idx + 1
 
     def add_last_state(self, state):
-        self['state'][self.idx] = state
\ No newline at end of file
+        store_state(self, self.idx, state)
+
+    """ Implementation """
+    def _get_states(self, indexes):
+        if self.frame_stack == 1:
+            return self['state'][indexes]
+        # local buffers start with an episode
+        return stack_frames(self, indexes, self.frame_stack)
\ No newline at end of file
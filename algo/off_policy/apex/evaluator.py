@@ -0,0 +1,170 @@
+import time
+import threading
+from collections import deque
+import numpy as np
+import ray
+
+from utility.display import pwc
+
+
+def get_eval_actor(BaseClass, *args, **kwargs):
+    @ray.remote(num_cpus=1)
+    class EvalActor(BaseClass):
+        """ Interface """
+        def __init__(self,
+                    name,
+                    actor_no,
+                    args,
+                    env_args,
+                    buffer_args,
+                    n_episodes,
+                    learner=None,
+                    sess_config=None,
+                    device=None):
+            """ Evaluate weights by running n_episodes episodes in parallel on a vectorized environment.
+            Observation statistics are fetched from learner if observations are normalized """
+            self.no = actor_no
+            self.learner = learner if env_args.get('normalize_obs', False) else None
+            env_args = dict(env_args, n_envs=n_episodes, log_video=False)
+            buffer_args = dict(buffer_args, type='local', local_capacity=1)
+
+            super().__init__(name,
+                            args,
+                            env_args,
+                            buffer_args,
+                            sess_config=sess_config,
+                            device=device)
+
+        def evaluate(self, weights):
+            """ Return (scores, duration) of the deterministic policy defined by weights """
+            start = time.time()
+            self.set_weights(weights)
+            env = self.train_env
+            if self.learner:
+                self.obs_moments.set_moments(ray.get(self.learner.get_obs_moments.remote()))
+            state = env.reset()
+            dones = np.zeros(env.n_envs, dtype=bool)
+            # finished environments keep stepping until all are done, EnvStats stops recording their scores
+            while not np.all(dones):
+                action = self.act(state, deterministic=True)
+                for _ in range(self.max_action_repetitions):
+                    state, _, done, _ = env.step(action)
+                    dones = np.logical_or(dones, np.reshape(done, -1))
+                    if np.all(dones):
+                        break
+
+            return np.reshape(env.get_score(), -1), time.time() - start
+
+        def print_construction_complete(self):
+            pwc(f'EvalActor {self.no} has been constructed.', 'cyan')
+
+    return EvalActor.remote(*args, **kwargs)
+
+
+def get_evaluator(BaseClass, name, args, env_args, buffer_args, learner=None, sess_config=None, device=None):
+    """ Create an Evaluator together with its pool of EvalActors,
+    args['evaluator'] specifies n_actors, n_episodes, best_k and max_pending """
+    eval_args = args.get('evaluator', {})
+    actors = [get_eval_actor(BaseClass, name, i, args, env_args, buffer_args, eval_args.get('n_episodes', 4),
+                             learner=learner, sess_config=sess_config, device=device)
+              for i in range(eval_args.get('n_actors', 2))]
+
+    @ray.remote(num_cpus=0)
+    class Evaluator:
+        """ Interface """
+        def __init__(self, actors, args):
+            """ Evaluate candidate weights reported by workers on a pool of EvalActors and rank them.
+            Candidates are queued and dispatched by a background thread,
+            so neither workers nor the learner wait for evaluation.
+            Weights of the best_k candidates are kept in the object store
+
+            Arguments:
+                actors {list} -- EvalActors
+                args {dict} -- best_k: number of evaluated candidates kept
+                               max_pending: maximum number of queued candidates,
+                                            those with the lowest training scores are dropped beyond it
+            """
+            self.actors = actors
+            self.best_k = args.get('best_k', 3)
+            self.max_pending = args.get('max_pending', 8)
+
+            self.pending = []           # [(training score, submission time, weights id)]
+            self.best = []              # [(evaluation score, submission time, weights id)] in descending order of scores
+            self.latest_score = None    # evaluation score of the latest evaluated candidate
+            self.cond = threading.Condition()
+
+            # metrics
+            self.n_evaluated = 0
+            self.n_dropped = 0
+            self.latencies = deque(maxlen=100)      # seconds from submission to the end of evaluation
+            self.eval_times = deque(maxlen=100)     # seconds spent on evaluation
+
+            self.dispatching_thread = threading.Thread(target=self._dispatching_loop, daemon=True)
+            self.dispatching_thread.start()
+
+        def evaluate_model(self, weights, score):
+            """ Queue weights whose training score is score for evaluation """
+            weights_id = ray.put(weights)
+            with self.cond:
+                self.pending.append((score, time.time(), weights_id))
+                if len(self.pending) > self.max_pending:
+                    self.pending.pop(int(np.argmin([c[0] for c in self.pending])))
+                    self.n_dropped += 1
+                self.cond.notify()
+
+        def get_best_model(self):
+            """ Return (score, submission time, weights id) of the best candidate, or None if no candidate has been evaluated.
+            The submission time tells snapshots apart, a later one holds newer weights.
+            The id is nested in a tuple so that weights are only fetched by whoever uses them """
+            with self.cond:
+                return self.best[0] if self.best else None
+
+        def get_stats(self):
+            with self.cond:
+                return dict(Evaluated=self.n_evaluated,
+                            Pending=len(self.pending),
+                            Dropped=self.n_dropped,
+                            BestScores=[score for score, _, _ in self.best],
+                            LatestScore=self.latest_score,
+                            EvalLatencyMean=np.mean(self.latencies) if self.latencies else 0,
+                            EvalTimeMean=np.mean(self.eval_times) if self.eval_times else 0)
+
+        """ Implementation """
+        def _dispatching_loop(self):
+            idle_actors = list(self.actors)
+            in_flight = {}      # id of evaluation --> (actor, candidate)
+            while True:
+                with self.cond:
+                    if not in_flight and not self.pending:
+                        self.cond.wait()
+                    while idle_actors and self.pending:
+                        # evaluate the candidate with the highest training score first
+                        candidate = self.pending.pop(int(np.argmax([c[0] for c in self.pending])))
+                        actor = idle_actors.pop()
+                        in_flight[actor.evaluate.remote(candidate[2])] = (actor, candidate)
+                if not in_flight:
+                    continue
+
+                ready_ids, _ = ray.wait(list(in_flight), timeout=.1)
+                for ready_id in ready_ids:
+                    actor, (train_score, submission_time, weights_id) = in_flight.pop(ready_id)
+                    idle_actors.append(actor)
+                    scores, eval_time = ray.get(ready_id)
+                    latency = time.time() - submission_time
+                    self._rank(np.mean(scores), submission_time, weights_id, latency, eval_time)
+                    pwc(f'Evaluator: candidate with training score {train_score:.2f} '
+                        f'scores {np.mean(scores):.2f}({np.std(scores):.2f}) over {len(scores)} episodes\t'
+                        f'latency {latency:.2f}s, evaluation {eval_time:.2f}s', 'blue')
+
+        def _rank(self, score, submission_time, weights_id, latency, eval_time):
+            with self.cond:
+                self.best.append((score, submission_time, weights_id))
+                self.best.sort(key=lambda c: c[0], reverse=True)
+                # ids of dropped candidates go out of scope, which frees their weights
+                del self.best[self.best_k:]
+                self.n_evaluated += 1
+                self.latest_score = score
+                self.latencies.append(latency)
+                self.eval_times.append(eval_time)
+
+    return Evaluator.remote(actors, eval_args)
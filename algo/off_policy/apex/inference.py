@@ -0,0 +1,332 @@
+import time
+import threading
+from collections import deque, defaultdict
+import numpy as np
+import ray
+
+from utility.display import pwc
+from utility.weight_codec import WeightDecoder
+from utility.run_avg import RunningMoments
+from env.gym_env import create_gym_env
+from algo.off_policy.np_policy import NumpyPolicy
+from algo.off_policy.quantization import QuantizedNumpyPolicy
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.learner import fetch_weights, fetch_quantized_weights
+from algo.off_policy.apex.transfer import Pusher, shared_memory_writer
+
+
+def _fetch_policy(learner, version, decoders, quantization=None):
+    """ Return (latest version, policy weights), which are a quantized payload if quantization is given, 
+    or None if version is already the latest """
+    if quantization:
+        return fetch_quantized_weights(learner, version, quantization)
+    version, weights = fetch_weights(learner, version, ['policy'], decoders)
+
+    return version, weights if weights is None else weights['policy']
+
+def _set_policy(policy, weights):
+    if isinstance(weights, dict):
+        policy.set_quantized(weights)
+    else:
+        policy.set_flat(weights)
+
+def get_inference_server(*args, max_concurrency=64, **kwargs):
+    @ray.remote(num_cpus=1, max_concurrency=max_concurrency)
+    class InferenceServer:
+        """ Interface """
+        def __init__(self,
+                    layout,
+                    spec,
+                    args,
+                    learner=None):
+            """ Central inference server which dynamically batches observations from many env-only workers
+
+            Arguments:
+                layout, spec -- Returned by OffPolicyOperation.export_numpy_policy
+                args {dict} -- max_batch_size: maximum number of requests in a batch
+                               max_wait: seconds to wait for a batch to fill up
+                               weight_update_period: seconds between two weight pulls from the learner
+                               quantization: None, 'float16' or 'int8', the dtype of the pulled weights
+
+            Keyword Arguments:
+                learner -- Learner actor, from which weights are pulled if provided (default: {None})
+            """
+            self.quantization = args.get('quantization')
+            self.policy = (QuantizedNumpyPolicy(layout, spec, self.quantization) 
+                           if self.quantization else NumpyPolicy(layout, spec))
+            self.max_batch_size = args['max_batch_size']
+            self.max_wait = float(args['max_wait'])
+            self.weight_update_period = float(args['weight_update_period'])
+            self.learner = learner
+
+            self.requests = deque()
+            self.cond = threading.Condition()
+            self.batch_sizes = deque(maxlen=1000)
+
+            self.weights_version = 0
+            self.decoders = defaultdict(WeightDecoder)
+            if learner is not None:
+                self._pull_weights()
+            self.last_weight_update = time.time()
+
+            self.batching_thread = threading.Thread(target=self._batching_loop, daemon=True)
+            self.batching_thread.start()
+
+        def set_weights(self, weights):
+            self.policy.set_flat(weights)
+
+        def act(self, state, deterministic=False, sigma=None):
+            """ Called concurrently by workers, block until the batch containing state is processed.
+            If sigma is given, state draws its own noise with standard deviation sigma in noisy layers,
+            otherwise it shares the noise of the batch drawn with the sigma of the policy spec """
+            request = dict(state=state, deterministic=deterministic, sigma=sigma,
+                           event=threading.Event(), action=None)
+            with self.cond:
+                self.requests.append(request)
+                self.cond.notify()
+            request['event'].wait()
+
+            return request['action']
+
+        def get_stats(self):
+            return dict(BatchSizeMean=np.mean(self.batch_sizes) if self.batch_sizes else 0)
+
+        """ Implementation """
+        def _batching_loop(self):
+            while True:
+                with self.cond:
+                    while not self.requests:
+                        self.cond.wait()
+                    # wait for more requests until the batch is full or max_wait is reached
+                    deadline = time.time() + self.max_wait
+                    while len(self.requests) < self.max_batch_size:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    batch = [self.requests.popleft() for _ in range(min(len(self.requests), self.max_batch_size))]
+
+                self._process(batch)
+                self.batch_sizes.append(len(batch))
+
+                if self.learner is not None and time.time() - self.last_weight_update > self.weight_update_period:
+                    self._pull_weights()
+                    self.last_weight_update = time.time()
+
+        def _pull_weights(self):
+            self.weights_version, weights = _fetch_policy(self.learner, self.weights_version, 
+                                                          self.decoders, self.quantization)
+            if weights is not None:
+                _set_policy(self.policy, weights)
+
+        def _process(self, batch):
+            for deterministic in (False, True):
+                for per_sample in (False, True):
+                    requests = [r for r in batch if r['deterministic'] == deterministic 
+                                and (r['sigma'] is not None) == per_sample]
+                    if requests:
+                        self._act(requests, deterministic, per_sample)
+
+        def _act(self, requests, deterministic, per_sample):
+            states = np.stack([r['state'] for r in requests])
+            sigma = [r['sigma'] for r in requests] if per_sample else None
+            actions = np.reshape(self.policy.act(states, deterministic=deterministic, sigma=sigma), 
+                                 (len(requests), -1))
+            for r, a in zip(requests, actions):
+                r['action'] = np.squeeze(a)
+                r['event'].set()
+
+    return InferenceServer.remote(*args, **kwargs)
+
+
+def get_env_worker(*args, **kwargs):
+    @ray.remote(num_cpus=1)
+    class EnvWorker:
+        """ Interface """
+        def __init__(self,
+                    worker_no,
+                    args,
+                    env_args,
+                    buffer_args,
+                    server=None,
+                    policy=None,
+                    noisy_sigma=None):
+            """ Worker that only steps the environment, actions are computed either by
+            the central inference server or by a local NumpyPolicy.
+            As in Worker, worker 0 only records the deterministic policy
+
+            Keyword Arguments:
+                server -- InferenceServer actor (default: {None})
+                policy {tuple} -- (layout, spec) for a local NumpyPolicy, used when server is None (default: {None})
+                noisy_sigma {float} -- standard deviation of this worker's noise in noisy layers,
+                                       the sigma of the policy spec is used if None (default: {None})
+            """
+            self.no = worker_no
+            self.server = server
+            self.noisy_sigma = noisy_sigma
+            self.quantization = args.get('inference', {}).get('quantization')
+            self.shared_memory = buffer_args.get('shared_memory', False)
+            self.transfer_args = buffer_args.get('transfer')
+            if server is None:
+                self.policy = (QuantizedNumpyPolicy(*policy, self.quantization) 
+                               if self.quantization else NumpyPolicy(*policy))
+            self.weights_version = 0
+            self.decoders = defaultdict(WeightDecoder)
+            self.max_action_repetitions = args.get('max_action_repetitions', 1)
+
+            env_args['n_envs'] = 1
+            # states are pushed raw and normalized by synced moments before acting, see OffPolicyOperation._prepare_data
+            self.env = create_gym_env(dict(env_args, normalize_obs=False))
+            self.obs_moments = (RunningMoments(self.env.state_shape, env_args.get('obs_clip', 5.)) 
+                                if env_args.get('normalize_obs', False) else None)
+
+            buffer_args['n_steps'] = args['n_steps']
+            buffer_args['gamma'] = args['gamma']
+            buffer_args['frame_stack'] = env_args.get('frame_stack', 1)
+            buffer_args['local_capacity'] = self.env.max_episode_steps
+            self.buffer = LocalBuffer(buffer_args, self.env.state_shape, self.env.action_dim)
+
+        def set_weights(self, weights):
+            self.policy.set_flat(weights)
+
+        def act(self, state, deterministic=False):
+            if self.obs_moments is not None:
+                state = self.obs_moments.normalize(state)
+            sigma = None if self.noisy_sigma is None else [self.noisy_sigma]
+            if self.server is None:
+                return self.policy.act(state, deterministic=deterministic, sigma=sigma)
+            else:
+                return ray.get(self.server.act.remote(state, deterministic=deterministic, 
+                                                      sigma=self.noisy_sigma))
+
+        def run_trajectory(self, fn=None, evaluation=False):
+            """ Same as OffPolicyOperation.run_trajectory, except that actions come from self.act """
+            state = self.env.reset()
+            done = False
+
+            while not done:
+                action = self.act(state, deterministic=evaluation)
+                for _ in range(self.max_action_repetitions):
+                    next_state, reward, done, _ = self.env.step(action)
+                    if fn:
+                        fn(state, action, reward, done)
+                    state = next_state
+                    if done:
+                        break
+
+            return self.env.get_score(), self.env.get_epslen()
+
+        def sample_data(self, learner, evaluator=None, log_period=10, replay=None):
+            """ replay is the ReplayServer this worker pushes data to, 
+            data are pushed to the learner if it is None.
+            Whenever the mean score improves, the learner's latest weights are sent to evaluator if provided """
+            writer = shared_memory_writer(learner) if self.shared_memory else None
+            pusher = Pusher(learner, self.transfer_args, replay=replay, writer=writer, top_priority=True)
+
+            def collect_fn(state, action, reward, done):
+                self.buffer.add_data(state, action, reward, done)
+
+            to_record = self.no == 0
+            scores = deque(maxlen=log_period)
+            epslens = deque(maxlen=log_period)
+            best_score_mean = -50
+            step = 0
+            episode_i = 0
+            while True:
+                episode_i += 1
+                self.buffer.reset()
+                fn = None if to_record else collect_fn
+                score, epslen = self.run_trajectory(fn=fn, evaluation=to_record)
+                step += epslen
+                scores.append(score)
+                epslens.append(epslen)
+
+                if not to_record:
+                    if self.obs_moments is not None:
+                        self.obs_moments.update(self.buffer['state'][:self.buffer.idx])
+                    self.buffer.add_last_state(np.zeros_like(self.buffer['state'][0]))
+                    # env-only workers cannot compute priorities, leave it to the learner
+                    pusher.push(self.buffer, self.buffer.idx)
+                if self.obs_moments is not None:
+                    moments = self.obs_moments
+                    moments.set_moments(ray.get(learner.merge_obs_moments.remote(moments.pop_delta())))
+
+                if self.server is None:
+                    self.weights_version, weights = _fetch_policy(learner, self.weights_version, 
+                                                                  self.decoders, self.quantization)
+                    if weights is not None:
+                        _set_policy(self.policy, weights)
+
+                if episode_i % log_period == 0:
+                    score_mean = np.mean(scores)
+                    pusher.call('record_transfer_stats', self.no, pusher.get_stats())
+                    if to_record:
+                        pusher.call('rl_log', dict(
+                            Timing='Eval',
+                            WorkerNo=self.no,
+                            Steps=step,
+                            ScoreMean=score_mean,
+                            ScoreStd=np.std(scores),
+                            EpslenMean=np.mean(epslens),
+                        ))
+                    if evaluator is not None and score_mean > min(250, best_score_mean):
+                        best_score_mean = score_mean
+                        pwc(f'EnvWorker {self.no}: Best score updated to {best_score_mean:2f}', 'blue')
+                        # env-only workers hold no full weights, ray resolves the id before evaluate_model runs
+                        evaluator.evaluate_model.remote(learner.get_weights.remote(), score_mean)
+
+        def run_steps(self, n_steps):
+            """ Step the environment n_steps times without collecting data, used for benchmark """
+            steps = 0
+            start = time.time()
+            while steps < n_steps:
+                _, epslen = self.run_trajectory()
+                steps += epslen
+
+            return steps, time.time() - start
+
+        def print_construction_complete(self):
+            pwc(f'EnvWorker {self.no} has been constructed.', 'cyan')
+
+    return EnvWorker.remote(*args, **kwargs)
+
+
+if __name__ == '__main__':
+    # compare env steps/sec of the central inference server against per-worker inference
+    # python -m algo.off_policy.apex.inference
+    from utility.yaml_op import load_args
+    from algo.off_policy.sac.agent import Agent
+
+    args = load_args('algo/off_policy/apex/sac_args.yaml')
+    env_args, agent_args, buffer_args = args['env'], args['agent'], args['buffer']
+    buffer_args['type'] = 'local'
+    buffer_args['local_capacity'] = 1
+    agent_args['model_name'] = 'inference_benchmark'
+    agent = Agent('Agent', agent_args, env_args, buffer_args, device='/CPU:0')
+    layout, spec = agent.export_numpy_policy()
+    weights = agent.get_weights(['policy'])['policy']
+    n_steps = 2000
+
+    ray.init()
+    for n_workers in [4, 8, 16]:
+        for central in [False, True]:
+            server = None
+            if central:
+                server = get_inference_server(layout, spec, agent_args['inference'],
+                                              max_concurrency=n_workers + 1)
+                ray.get(server.set_weights.remote(weights))
+            workers = [get_env_worker(i, agent_args, env_args.copy(), buffer_args.copy(),
+                                      server=server, policy=(layout, spec))
+                       for i in range(n_workers)]
+            if not central:
+                ray.get([w.set_weights.remote(weights) for w in workers])
+            start = time.time()
+            steps, _ = zip(*ray.get([w.run_steps.remote(n_steps) for w in workers]))
+            duration = time.time() - start
+            name = 'central' if central else 'per-worker'
+            stats = ray.get(server.get_stats.remote()) if central else {}
+            print(f'{n_workers} workers, {name} inference: {np.sum(steps) / duration:.1f} env steps/sec\t{stats}')
+            [ray.kill(w) for w in workers]
+            if server is not None:
+                ray.kill(server)
+    ray.shutdown()
@@ -1,6 +1,6 @@
 import os
 import time
-from collections import deque
+from collections import deque, defaultdict
 import numpy as np
 import threading
 import tensorflow as tf
@@ -8,8 +8,38 @@ import ray
 
 from utility import tf_utils
 from utility.display import pwc
+from utility.weight_codec import WeightEncoder, WeightDecoder
+from algo.off_policy.quantization import quantize_weights
+from algo.off_policy.apex.transfer import merge_packets
 
 
+def fetch_weights(learner, version, groups=None, decoders=None):
+    """ Return (latest version, weights) published by learner, where weights is
+    a dict mapping each group in groups to its flat weights, or None if version is already the latest.
+    decoders maps each group to the WeightDecoder holding version, 
+    full snapshots are fetched if decoders are not provided """
+    decoders = decoders or defaultdict(WeightDecoder)
+    latest_version, weights_ids = ray.get(learner.get_weights_id.remote(version, groups))
+    if weights_ids is None:
+        return latest_version, None
+    
+    payloads = ray.get(list(weights_ids.values()))
+    weights = {name: decoders[name].decode(payload) for name, payload in zip(weights_ids, payloads)}
+    if any(w is None for w in weights.values()):
+        # some payloads are deltas against versions the decoders do not have
+        return fetch_weights(learner, -1, groups, decoders)
+
+    return latest_version, weights
+
+def fetch_quantized_weights(learner, version, dtype):
+    """ Return (latest version, payload), where payload is the latest published policy 
+    quantized by quantization.quantize_weights, or None if version is already the latest """
+    latest_version, payload_ids = ray.get(learner.get_quantized_weights_id.remote(version, dtype))
+    if payload_ids is None:
+        return latest_version, None
+
+    return latest_version, ray.get(payload_ids['policy'])
+
 def get_learner(BaseClass, *args, **kwargs):
     @ray.remote(num_gpus=0.3, num_cpus=2)
     class Learner(BaseClass):
@@ -38,20 +68,102 @@ def get_learner(BaseClass, *args, **kwargs):
                             log_params=log_params,
                             log_stats=log_stats,
                             device=device)
+
+            # weights are published to the object store every weight_publish_period updates
+            self.weight_publish_period = args.get('weight_publish_period', 1)
+            self.weights_version = 0
+            # each group is encoded by its own encoder, see utility/weight_codec.py
+            self.encoders = {name: WeightEncoder.from_args(args.get('weight_codec')) 
+                             for name in self.variable_groups}
+            self.weights_ids = {}           # (group, base version) --> id of the encoded latest weights
+            self.weights_lock = threading.Lock()
+            self._publish_weights()
+
+            self.transfer_stats = {}        # worker_no --> the latest stats of its Pusher
             
             self.learning_thread = threading.Thread(target=self.background_learning, daemon=True)
             self.learning_thread.start()
             
-        def get_weights(self):
-            return self.variables.get_flat()
+        def get_weights_id(self, version=-1, groups=None):
+            """ Return (latest version, weights_ids), where weights_ids maps each group in groups
+            to the id of its latest weights encoded against version, or None if version is already the latest.
+            Ids are nested in a dict so that ray does not fetch the weights on behalf of the caller """
+            with self.weights_lock:
+                if version == self.weights_version:
+                    return self.weights_version, None
+
+                weights_ids = {}
+                for name in groups or self.encoders:
+                    encoder = self.encoders[name]
+                    # payloads are shared by all workers with the same version
+                    key = (name, version if encoder.delta else None)
+                    if key not in self.weights_ids:
+                        self.weights_ids[key] = ray.put(encoder.encode(version))
+                    weights_ids[name] = self.weights_ids[key]
+
+                return self.weights_version, weights_ids
+
+        def get_quantized_weights_id(self, version=-1, dtype='int8'):
+            """ Same as get_weights_id, except that the latest published policy weights are
+            quantized for workers running QuantizedNumpyPolicy """
+            with self.weights_lock:
+                if version == self.weights_version:
+                    return self.weights_version, None
+
+                key = ('policy', dtype)
+                if key not in self.weights_ids:
+                    layout, _ = self.export_numpy_policy()
+                    encoder = self.encoders['policy']
+                    self.weights_ids[key] = ray.put(quantize_weights(encoder.weights[encoder.version], layout, dtype))
 
-        def set_weights(self, weights):
+                return self.weights_version, dict(policy=self.weights_ids[key])
+
+        def set_weights(self, weights, groups=None):
             pwc('Learner: pull weights from the evaluator', 'blue')
-            self.variables.set_flat(weights)
+            super().set_weights(weights, groups=groups)
+            self._publish_weights()
 
-        def merge_buffer(self, local_buffer, length):
+        def merge_buffer(self, local_buffer, length, top_priority=False):
+            if top_priority:
+                # used by workers who cannot compute priorities, e.g., env-only workers.
+                # local_buffer may be read-only when ray deserializes it from the object store
+                local_buffer = dict(local_buffer, priority=np.full((length, 1), self.buffer.top_priority))
             self.buffer.merge(local_buffer, length)
 
+        def merge_packets(self, packets, top_priority=False):
+            """ Merge packets created by transfer.pack_buffer """
+            merge_packets(self.buffer, packets, top_priority=top_priority)
+
+        def merge_obs_moments(self, moments):
+            """ All-reduce of observation statistics, see OffPolicyOperation._prepare_data.
+            Merge moments a worker has collected since its last sync, and return the merged moments """
+            self.obs_moments.merge(moments)
+            return self.obs_moments.get_moments()
+
+        def get_obs_moments(self):
+            return self.obs_moments.get_moments()
+
+        def record_transfer_stats(self, worker_no, stats):
+            self.transfer_stats[worker_no] = stats
+
+        def rl_log(self, kwargs):
+            """ Attach transfer stats summed over workers, the longest push interval, and rate limiter stats """
+            kwargs = kwargs.copy()
+            for k in ['InFlight', 'Queued', 'Dropped', 'SkippedCalls', 'BlockedTime']:
+                kwargs[k] = sum(stats[k] for stats in self.transfer_stats.values())
+            kwargs['PushInterval'] = max((stats['PushInterval'] for stats in self.transfer_stats.values()), default=0)
+            if getattr(self.buffer, 'rate_limiter', None):
+                kwargs.update(self.buffer.rate_limiter.get_stats())
+            super().rl_log(kwargs)
+
+        def get_shared_memory_layout(self):
+            """ Layout of the SharedMemoryReplay, from which workers create SharedMemoryWriters """
+            return self.buffer.layout
+
+        def commit_slots(self, start, length, priorities=None):
+            """ Used by workers who write transitions to the SharedMemoryReplay directly """
+            self.buffer.commit(start, length, priorities)
+
         def background_learning(self):
             while not self.buffer.good_to_learn:
                 time.sleep(1)
@@ -61,6 +173,8 @@ def get_learner(BaseClass, *args, **kwargs):
             while True:
                 t += 1
                 self.learn(t)
+                if t % self.weight_publish_period == 0:
+                    self._publish_weights()
 
         def record_stats(self, kwargs):
             assert isinstance(kwargs, dict)
@@ -69,4 +183,14 @@ def get_learner(BaseClass, *args, **kwargs):
         def print_construction_complete(self):
             pwc('Learner has been constructed.', 'cyan')
 
+        """ Implementation """
+        def _publish_weights(self):
+            weights = self.get_weights(list(self.variable_groups))
+            with self.weights_lock:
+                self.weights_version += 1
+                for name, w in weights.items():
+                    self.encoders[name].push(w, self.weights_version)
+                # payloads are encoded and put into the object store on demand
+                self.weights_ids = {}
+
     return Learner.remote(*args, **kwargs)
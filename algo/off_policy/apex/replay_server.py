@@ -0,0 +1,272 @@
+import time
+from collections import deque
+import numpy as np
+import ray
+
+from utility.display import pwc, assert_colorize
+from utility.schedule import PiecewiseSchedule
+from algo.off_policy.apex.transfer import merge_packets
+from algo.off_policy.replay.uniform_replay import UniformReplay
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+def get_replay_server(*args, max_concurrency=16, **kwargs):
+    @ray.remote(num_cpus=1, max_concurrency=max_concurrency)
+    class ReplayServer:
+        """ Interface """
+        def __init__(self,
+                    server_no,
+                    buffer_args,
+                    state_shape,
+                    action_dim):
+            """ Replay hosted in its own process, so that inserts from workers
+            do not compete with the learner for the GIL
+
+            Arguments:
+                buffer_args {dict} -- Same as those for the learner's replay,
+                                      n_steps, gamma and batch_size should be specified
+            """
+            self.no = server_no
+            if buffer_args['type'] == 'proportional':
+                self.buffer = ProportionalPrioritizedReplay(buffer_args, state_shape, action_dim)
+            elif buffer_args['type'] == 'uniform':
+                self.buffer = UniformReplay(buffer_args, state_shape, action_dim)
+            else:
+                raise NotImplementedError
+
+            self.n_inserts = 0
+            self.n_samples = 0
+            self.start_time = time.time()
+
+        def good_to_learn(self):
+            return self.buffer.good_to_learn
+
+        def merge_buffer(self, local_buffer, length, top_priority=False):
+            """ Same as Learner.merge_buffer """
+            if top_priority:
+                local_buffer = dict(local_buffer, priority=np.full((length, 1), self.buffer.top_priority))
+            self.buffer.merge(local_buffer, length)
+            self.n_inserts += length
+
+        def merge_packets(self, packets, top_priority=False):
+            """ Merge packets created by transfer.pack_buffer """
+            merge_packets(self.buffer, packets, top_priority=top_priority)
+            self.n_inserts += sum(packet['length'] for packet in packets)
+
+        def sample(self):
+            self.n_samples += 1
+            return self.buffer.sample()
+
+        def sample_n(self, n):
+            """ Return (total priorities, priorities, indexes, samples) of n transitions
+            sampled proportionally to their priorities, only the total is returned if n is zero.
+            Used by ShardedPrioritizedReplay, which computes IS ratios globally """
+            with self.buffer.locker:
+                total_priorities = self.buffer.data_structure.total_priorities
+                if n == 0:
+                    return total_priorities, None, None, None
+                priorities, indexes = self.buffer._sample_indexes(n)
+                samples = self.buffer._get_samples(indexes)
+            self.n_samples += 1
+
+            return total_priorities, priorities, np.asarray(indexes), samples
+
+        def update_priorities(self, priorities, saved_mem_idxs):
+            self.buffer.update_priorities(priorities, saved_mem_idxs)
+
+        def get_stats(self):
+            duration = time.time() - self.start_time
+            return dict(ServerNo=self.no,
+                        Size=len(self.buffer),
+                        Inserts=self.n_inserts,
+                        InsertsPerSec=self.n_inserts / duration,
+                        SamplesPerSec=self.n_samples / duration)
+
+        def print_construction_complete(self):
+            pwc(f'ReplayServer {self.no} has been constructed.', 'cyan')
+
+    return ReplayServer.remote(*args, **kwargs)
+
+def get_replay_servers(n_servers, buffer_args, state_shape, action_dim, max_concurrency=16):
+    """ Create n_servers ReplayServers, each holds 1/n_servers of the capacity """
+    # a limiter per server would block servers whose share of samples is small
+    assert_colorize(not buffer_args.get('samples_per_insert'), 
+                    'samples_per_insert is not supported by ReplayServers, set it to null or n_servers to 0')
+    buffer_args = buffer_args.copy()
+    buffer_args['capacity'] = int(float(buffer_args['capacity'])) // n_servers
+    buffer_args['min_size'] = int(float(buffer_args['min_size'])) // n_servers
+
+    return [get_replay_server(i, buffer_args, state_shape, action_dim, max_concurrency=max_concurrency)
+            for i in range(n_servers)]
+
+
+class RemoteReplay:
+    """ Interface """
+    def __init__(self, servers, args):
+        """ Replay used by the learner when replay is hosted by ReplayServers.
+        Batches are prefetched from servers in a round-robin way and priorities are pushed asynchronously.
+        Indexes in batches are offset by server_no * capacity, so that priorities can be routed back.
+
+        Arguments:
+            servers {list} -- ReplayServers created by get_replay_servers
+            args {dict} -- buffer_args, prefetch specifies the number of in-flight batches per server
+        """
+        self.servers = servers
+        self.capacity = int(float(args['capacity'])) // len(servers)
+        self.prefetch = args.get('prefetch', 2)
+        self.prioritized = args['type'] != 'uniform'
+        # transitions merged through this replay per server, which keeps shard sizes balanced
+        self.n_merged = np.zeros(len(servers), dtype=np.int64)
+
+    @property
+    def good_to_learn(self):
+        return all(ray.get([s.good_to_learn.remote() for s in self.servers]))
+
+    def __call__(self):
+        requests = deque((i, s.sample.remote()) for _ in range(self.prefetch)
+                         for i, s in enumerate(self.servers))
+        while True:
+            server_no, request = requests.popleft()
+            samples = self._encode_indexes(server_no, ray.get(request))
+            requests.append((server_no, self.servers[server_no].sample.remote()))
+
+            yield samples
+
+    def sample(self):
+        server_no = np.random.randint(len(self.servers))
+        return self._encode_indexes(server_no, ray.get(self.servers[server_no].sample.remote()))
+
+    def merge(self, local_buffer, length, server_no=None):
+        """ Merge to server_no, or to the server that has received the fewest transitions from this replay """
+        server_no = int(np.argmin(self.n_merged)) if server_no is None else server_no
+        self.n_merged[server_no] += length
+        self.servers[server_no].merge_buffer.remote(local_buffer, length)
+
+    def update_priorities(self, priorities, saved_mem_idxs):
+        """ Route priorities to their servers, this does not wait for the updates """
+        priorities = np.asarray(priorities)
+        server_nos, mem_idxs = np.divmod(np.asarray(saved_mem_idxs), self.capacity)
+        for server_no in np.unique(server_nos):
+            mask = server_nos == server_no
+            self.servers[server_no].update_priorities.remote(priorities[mask], mem_idxs[mask])
+
+    def get_stats(self):
+        return ray.get([s.get_stats.remote() for s in self.servers])
+
+    """ Implementation """
+    def _encode_indexes(self, server_no, samples):
+        if self.prioritized:
+            IS_ratios, indexes, samples = samples
+            indexes = np.asarray(indexes) + server_no * self.capacity
+            samples = (IS_ratios, indexes, samples)
+        
+        return samples
+
+
+
+class ShardedPrioritizedReplay(RemoteReplay):
+    """ Interface """
+    def __init__(self, servers, args):
+        """ Prioritized replay sharded across ReplayServers, each with its own sum tree.
+        Sampling follows the global priority distribution: the batch is split among servers
+        in proportion to their total priorities, then each server samples within its sum tree.
+        IS ratios are computed against the global total priority.
+        Server totals used for splitting may be one batch stale when batches are prefetched,
+        the totals returned with each batch are used to compute probabilities """
+        super().__init__(servers, args)
+        self.batch_size = args['batch_size']
+        self.beta_schedule = PiecewiseSchedule([(0, args['beta0']), (float(args['beta_steps']), 1.)], 
+                                                outside_value=1.)
+        self.beta = float(args['beta0'])
+        self.sample_i = 0
+        self.total_priorities = None
+
+    def __call__(self):
+        requests = deque(self._request() for _ in range(self.prefetch))
+        while True:
+            samples = self._process(ray.get(requests.popleft()))
+            requests.append(self._request())
+
+            yield samples
+
+    def sample(self):
+        return self._process(ray.get(self._request()))
+
+    """ Implementation """
+    def _request(self):
+        if self.total_priorities is None:
+            self.total_priorities = np.array([r[0] for r in ray.get([s.sample_n.remote(0) for s in self.servers])])
+        counts = np.random.multinomial(self.batch_size, self.total_priorities / np.sum(self.total_priorities))
+
+        return [s.sample_n.remote(n) for s, n in zip(self.servers, counts)]
+
+    def _process(self, results):
+        total_priorities, priorities, indexes, samples = zip(*results)
+        self.total_priorities = np.array(total_priorities)
+        shards = [i for i, p in enumerate(priorities) if p is not None]
+        priorities = np.concatenate([priorities[i] for i in shards])
+        # global indexes
+        indexes = np.concatenate([indexes[i] + i * self.capacity for i in shards])
+        samples = tuple(np.concatenate(field) for field in zip(*[samples[i] for i in shards]))
+
+        probabilities = priorities / np.sum(self.total_priorities)
+        IS_ratios = (np.min(probabilities) / probabilities)**self.beta
+        self.sample_i += 1
+        self.beta = self.beta_schedule.value(self.sample_i)
+
+        return IS_ratios, indexes, samples
+
+
+if __name__ == '__main__':
+    # learner updates/sec and insert throughput with different numbers of sharded ReplayServers
+    # python -m algo.off_policy.apex.replay_server
+    from algo.off_policy.apex.buffer import LocalBuffer
+
+    state_shape, action_dim = (24, ), 4
+    buffer_args = dict(type='proportional', normalize_reward=False, reward_scale=1, to_update_priority=False,
+                       alpha=.7, beta0=.4, epsilon=1e-4, beta_steps=5e4, min_size=1e4, capacity=1e5,
+                       local_capacity=100, n_steps=1, gamma=.99, batch_size=256, prefetch=2)
+    duration = 20
+
+    @ray.remote(num_cpus=1)
+    def insert(replay, duration):
+        local_buffer = LocalBuffer(buffer_args, state_shape, action_dim)
+        local_buffer['priority'][:] = 1
+        local_buffer.idx = local_buffer.capacity
+        start = time.time()
+        while time.time() - start < duration:
+            ray.get(replay.merge_buffer.remote(dict(local_buffer), local_buffer.idx))
+
+    def learn(replay, duration):
+        # mimic the learner: consume batches and send back priorities
+        n_updates = 0
+        start = time.time()
+        for IS_ratios, indexes, _ in replay():
+            replay.update_priorities(np.random.uniform(size=len(indexes)), indexes)
+            n_updates += 1
+            if time.time() - start > duration:
+                break
+
+        return n_updates / (time.time() - start)
+
+    ray.init()
+    for n_workers in [2, 6, 12]:
+        for n_servers in [1, 2, 4]:
+            servers = get_replay_servers(n_servers, buffer_args, state_shape, action_dim,
+                                         max_concurrency=n_workers + 4)
+            replay = ShardedPrioritizedReplay(servers, buffer_args)
+            # prefill so that learning starts immediately
+            for s in servers:
+                while not ray.get(s.good_to_learn.remote()):
+                    ray.get(insert.remote(s, .5))
+            n_inserts = sum(stats['Inserts'] for stats in replay.get_stats())
+            start = time.time()
+            inserts = [insert.remote(servers[i % n_servers], duration) for i in range(n_workers)]
+            updates_per_sec = learn(replay, duration)
+            ray.get(inserts)
+            n_inserts = sum(stats['Inserts'] for stats in replay.get_stats()) - n_inserts
+            inserts_per_sec = n_inserts / (time.time() - start)
+            print(f'{n_workers} workers, {n_servers} replay servers: {updates_per_sec:.1f} updates/sec\t'
+                  f'{inserts_per_sec:.1f} inserts/sec')
+            [ray.kill(s) for s in servers]
+    ray.shutdown()
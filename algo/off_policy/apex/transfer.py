@@ -0,0 +1,248 @@
+"""
+Compact format for pushing local buffers from workers to the replay.
+A packet only carries the filled rows of each field, laid out back to back
+in one contiguous (optionally lz4-compressed) buffer described by a small header.
+The receiver rebuilds the fields as views into that buffer and merges them
+into the replay without intermediate copies.
+"""
+import time
+from collections import deque
+import numpy as np
+import ray
+
+from utility.display import assert_colorize
+
+
+def pack_buffer(local_buffer, length, compression=None, with_priority=True):
+    """ Pack the first length transitions of local_buffer
+
+    Keyword Arguments:
+        compression {str} -- None or 'lz4' (default: {None})
+        with_priority {bool} -- whether to send priorities,
+                                workers who cannot compute priorities leave it to the replay (default: {True})
+    """
+    assert_colorize(compression in (None, 'lz4'), f'Unsupported compression: {compression}')
+    fields = []
+    data = []
+    for k, v in local_buffer.items():
+        if k == 'priority':
+            if not with_priority:
+                continue
+            v = v.astype(np.float32)
+        # the extra state row is dropped since the replay only keeps the first length states
+        v = np.ascontiguousarray(v[:length])
+        fields.append((k, v.dtype.str, v.shape[1:]))
+        data.append(v.tobytes())
+    data = b''.join(data)
+    if compression == 'lz4':
+        import lz4.frame
+        data = lz4.frame.compress(data)
+
+    return dict(length=length, fields=fields, compression=compression, data=data)
+
+def unpack_buffer(packet):
+    """ Return (buffer, length), where fields in buffer are read-only views into packet['data'] """
+    data = packet['data']
+    if packet['compression'] == 'lz4':
+        import lz4.frame
+        data = lz4.frame.decompress(data)
+    length = packet['length']
+    buffer = {}
+    offset = 0
+    for k, dtype, shape in packet['fields']:
+        dtype = np.dtype(dtype)
+        count = length * int(np.prod(shape))
+        buffer[k] = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape((length, *shape))
+        offset += count * dtype.itemsize
+
+    return buffer, length
+
+def merge_packets(replay, packets, top_priority=False):
+    """ Merge packets into replay, priorities are set to replay.top_priority if top_priority """
+    for packet in packets:
+        buffer, length = unpack_buffer(packet)
+        if top_priority:
+            buffer['priority'] = np.full((length, 1), replay.top_priority)
+        replay.merge(buffer, length)
+
+def packet_nbytes(packet):
+    return len(packet['data'])
+
+def shared_memory_writer(learner):
+    """ SharedMemoryWriter attached to the learner's SharedMemoryReplay, 
+    which is imported on demand since it requires Python 3.8+ """
+    from algo.off_policy.replay.shared_memory_replay import SharedMemoryWriter
+    return SharedMemoryWriter(ray.get(learner.get_shared_memory_layout.remote()))
+
+
+class Pusher:
+    """ Interface """
+    def __init__(self, learner, args, replay=None, writer=None, top_priority=False):
+        """ Push local buffers of a worker to the replay, with at most max_in_flight unfinished calls.
+        When the window is full, pushes are handled according to backpressure:
+            block: wait until a call finishes
+            drop_oldest: queue pushes locally, dropping the oldest ones beyond max_queue
+            lower_rate: adapt the interval between calls to the replay's throughput. 
+                        The interval doubles (up to max_push_interval) whenever a call is due 
+                        while the window is full, and halves after each call that goes through. 
+                        Pushes are queued locally in between and sent in one call,
+                        block if there are more than max_queue
+        
+        Arguments:
+            learner -- Learner actor
+            args {dict} -- compression: None or 'lz4'
+                           chunks_per_push: number of local buffers sent in one call
+                           max_in_flight, backpressure, max_queue, max_push_interval: see above
+
+        Keyword Arguments:
+            replay -- ReplayServer actor, packets are sent to the learner if None (default: {None})
+            writer -- SharedMemoryWriter, transitions are written to shared memory in place if provided (default: {None})
+            top_priority {bool} -- whether the replay should assign top priorities to transitions (default: {False})
+        """
+        args = args or {}
+        self.learner = learner
+        self.replay = replay or learner
+        self.writer = writer
+        self.top_priority = top_priority
+        self.compression = args.get('compression')
+        self.chunks_per_push = args.get('chunks_per_push', 1)
+        self.max_in_flight = args.get('max_in_flight', 4)
+        self.backpressure = args.get('backpressure', 'block')
+        self.max_queue = args.get('max_queue', 8)
+        self.max_push_interval = args.get('max_push_interval', 10)
+        assert_colorize(self.backpressure in ('block', 'drop_oldest', 'lower_rate'), 
+                        f'Unsupported backpressure: {self.backpressure}')
+
+        self.packets = []           # packets to be sent in the next call
+        self.queue = deque()        # lists of packets waiting for the window
+        self.in_flight = []         # ids of unfinished calls
+        self.calls = {}             # name --> id of the last call made by self.call
+        self.push_interval = 0      # minimum seconds between calls, adapted by lower_rate
+        self.last_push = time.time()
+
+        # metrics
+        self.n_dropped = 0          # number of transitions dropped
+        self.n_skipped_calls = 0
+        self.blocked_time = 0
+
+    def push(self, local_buffer, length):
+        """ Push the first length transitions in local_buffer, local_buffer can be reset afterwards """
+        if self.writer is not None:
+            # slots are already written, so commits are never dropped
+            self._wait(self.max_in_flight - 1)
+            start = self.writer.write(local_buffer, length)
+            priorities = None if self.top_priority else local_buffer['priority'][:length]
+            self.in_flight.append(self.learner.commit_slots.remote(start, length, priorities))
+        else:
+            self.packets.append(pack_buffer(local_buffer, length, self.compression,
+                                            with_priority=not self.top_priority))
+            if len(self.packets) >= self.chunks_per_push:
+                self.queue.append(self.packets)
+                self.packets = []
+                self._send()
+
+    def call(self, name, *args, **kwargs):
+        """ Call learner.name.remote(*args, **kwargs) unless the last call of name is unfinished.
+        Used for periodic calls, e.g., logging, which are skipped rather than queued """
+        last_call = self.calls.get(name)
+        if last_call is not None and not ray.wait([last_call], timeout=0)[0]:
+            self.n_skipped_calls += 1
+        else:
+            self.calls[name] = getattr(self.learner, name).remote(*args, **kwargs)
+
+    def get_stats(self):
+        return dict(InFlight=len(self.in_flight),
+                    Queued=sum(len(packets) for packets in self.queue),
+                    Dropped=self.n_dropped,
+                    SkippedCalls=self.n_skipped_calls,
+                    BlockedTime=self.blocked_time,
+                    PushInterval=self.push_interval)
+
+    """ Implementation """
+    def _send(self):
+        if self.backpressure == 'block':
+            while self.queue:
+                self._wait(self.max_in_flight - 1)
+                self._submit(self.queue.popleft())
+        else:
+            self._wait()
+            if self.backpressure == 'lower_rate':
+                now = time.time()
+                if len(self.queue) > self.max_queue:
+                    self._wait(self.max_in_flight - 1)
+                    self._submit_queue()
+                elif now - self.last_push >= self.push_interval:
+                    if len(self.in_flight) < self.max_in_flight:
+                        self._submit_queue()
+                        self.push_interval /= 2
+                    else:
+                        # the replay cannot keep up, wait longer before the next call
+                        self.push_interval = min(max(2 * self.push_interval, now - self.last_push), 
+                                                 self.max_push_interval)
+                        self.last_push = now
+            else:
+                while self.queue and len(self.in_flight) < self.max_in_flight:
+                    self._submit(self.queue.popleft())
+                while len(self.queue) > self.max_queue:
+                    self.n_dropped += sum(packet['length'] for packet in self.queue.popleft())
+
+    def _submit(self, packets):
+        self.in_flight.append(self.replay.merge_packets.remote(packets, top_priority=self.top_priority))
+
+    def _submit_queue(self):
+        """ Send everything queued in one call """
+        self._submit([packet for packets in self.queue for packet in packets])
+        self.queue.clear()
+        self.last_push = time.time()
+
+    def _wait(self, max_in_flight=None):
+        """ Remove finished calls from self.in_flight, 
+        block until there are at most max_in_flight unfinished calls if it's provided """
+        if self.in_flight:
+            _, self.in_flight = ray.wait(self.in_flight, num_returns=len(self.in_flight), timeout=0)
+        if max_in_flight is not None and len(self.in_flight) > max_in_flight:
+            start = time.time()
+            _, self.in_flight = ray.wait(self.in_flight, num_returns=len(self.in_flight) - max_in_flight)
+            self.blocked_time += time.time() - start
+
+if __name__ == '__main__':
+    # bytes per transition and pushes/sec of packets against sending dict(local_buffer)
+    # serialization is done by pickle as ray does for dicts of numpy arrays
+    # python -m algo.off_policy.apex.transfer
+    import time
+    import pickle
+    from algo.off_policy.apex.buffer import LocalBuffer
+    from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+    state_shape, action_dim = (24, ), 4
+    args = dict(normalize_reward=False, reward_scale=1, to_update_priority=False,
+                alpha=.7, beta0=.4, epsilon=1e-4, beta_steps=5e4, min_size=1e4, capacity=1e5,
+                local_capacity=2000, n_steps=3, tb_capacity=10, gamma=.99, batch_size=256)
+    replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+    local_buffer = LocalBuffer(args, state_shape, action_dim)
+    local_buffer['state'][:] = np.random.normal(size=local_buffer['state'].shape)
+    local_buffer['priority'][:] = 1
+    n = 50
+    try:
+        import lz4.frame
+        compressions = [None, 'lz4']
+    except ImportError:
+        print('lz4 is not installed, only uncompressed packets are benchmarked')
+        compressions = [None]
+
+    for length in [100, 1000, 2000]:
+        start = time.time()
+        for _ in range(n):
+            data = pickle.dumps(dict(local_buffer))
+            replay.merge(pickle.loads(data), length)
+        duration = time.time() - start
+        print(f'{length} transitions, dict: {len(data) / length:.1f} bytes/transition\t'
+              f'{n / duration:.1f} pushes/sec')
+        for compression in compressions:
+            start = time.time()
+            for _ in range(n):
+                data = pickle.dumps([pack_buffer(local_buffer, length, compression)])
+                merge_packets(replay, pickle.loads(data))
+            duration = time.time() - start
+            print(f'{length} transitions, packet(compression={compression}): '
+                  f'{len(data) / length:.1f} bytes/transition\t{n / duration:.1f} pushes/sec')
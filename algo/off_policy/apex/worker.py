@@ -1,11 +1,15 @@
 import os
 from time import time
-from collections import deque
+from collections import deque, defaultdict
 import numpy as np
 import ray
 
 from utility.display import pwc
 from utility.schedule import PiecewiseSchedule
+from utility.weight_codec import WeightDecoder
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.learner import fetch_weights
+from algo.off_policy.apex.transfer import Pusher, shared_memory_writer
 
 
 def get_worker(BaseClass, *args, **kwargs):
@@ -24,9 +28,21 @@ def get_worker(BaseClass, *args, **kwargs):
                     save=False, 
                     device=None):
             self.no = worker_no                             # use 0 worker to evaluate the model
+            self.n_envs = env_args.get('n_envs', 1)         # number of environments stepped with batched actions
             self.weight_update_freq = weight_update_freq    # update weights 
+            # write transitions to the learner's shared memory in place instead of sending them through ray
+            self.shared_memory = buffer_args.get('shared_memory', False)
+            self.transfer_args = buffer_args.get('transfer')
             buffer_args['type'] = 'local'
             buffer_args['local_capacity'] = 1 if worker_no == 0 else env_args['max_episode_steps'] * weight_update_freq
+            # policy weights are pulled every update, other groups are only used to compute priorities 
+            # so we pull them every critic_sync_period updates to reduce the bytes moved per sync
+            self.critic_sync_period = args.get('critic_sync_period', 1)
+            self.n_pulls = 0
+            self.weights_versions = {}                      # versions of the weights published by the learner
+            self.decoders = defaultdict(WeightDecoder)      # group --> decoder, see utility/weight_codec.py
+            self.policy_lags = deque(maxlen=100)            # versions the policy lags behind when weights are pulled
+            self.sync_bytes = deque(maxlen=100)             # bytes moved per sync
 
             super().__init__(name, 
                             args, 
@@ -35,27 +51,59 @@ def get_worker(BaseClass, *args, **kwargs):
                             sess_config=sess_config,
                             save=save,
                             device=device)
+            # each environment fills its own lane of local buffer, lanes are pushed independently
+            self.buffers = [self.buffer] + [LocalBuffer(buffer_args, self.state_shape, self.action_dim) 
+                                            for _ in range(self.n_envs - 1)]
+            self.env_steps = 0
 
-        def compute_priorities(self):
-            state, action, reward, next_state, done, steps = self.buffer.sample()
-            return self.sess.run(self.priority, feed_dict={
-                self.data['state']: state,
+        def compute_priorities(self, buffer=None):
+            buffer = self.buffer if buffer is None else buffer
+            state, action, reward, next_state, done, steps = buffer.sample()
+            feed_dict = {
+                self.data['raw_state']: state,
                 self.data['action']: action,
                 self.data['reward']: reward,
-                self.data['next_state']:next_state,
+                self.data['raw_next_state']:next_state,
                 self.data['done']: done,
                 self.data['steps']: steps
-            })
+            }
+            feed_dict.update(self._get_obs_feeddict())
+            return self.sess.run(self.priority, feed_dict=feed_dict)
+
+        def pull_weights(self, learner):
+            """ Fetch weights only if the learner has published a new version """
+            def pull(groups):
+                version = self.weights_versions.get(groups, 0)
+                latest_version, weights = fetch_weights(learner, version, list(groups), self.decoders)
+                if weights is None:
+                    return 0, 0
+                self.set_weights(weights)
+                self.weights_versions[groups] = latest_version
+                
+                return latest_version - version, sum(self.decoders[name].nbytes for name in groups)
+
+            lag, nbytes = pull(('policy', ))
+            self.policy_lags.append(lag)
+            if self.n_pulls % self.critic_sync_period == 0:
+                nbytes += pull(tuple(name for name in self.variable_groups if name != 'policy'))[1]
+            self.sync_bytes.append(nbytes)
+            self.n_pulls += 1
+            if self.obs_moments is not None:
+                # observation statistics are synced with weights
+                moments = self.obs_moments
+                moments.set_moments(ray.get(learner.merge_obs_moments.remote(moments.pop_delta())))
+
+        def sample_data(self, learner, evaluator, replay=None):
+            """ replay is the ReplayServer this worker pushes data to, 
+            data are pushed to the learner if it is None """
+            writer = shared_memory_writer(learner) if self.shared_memory else None
+            pusher = Pusher(learner, self.transfer_args, replay=replay, writer=writer)
+            if self.n_envs > 1:
+                self._sample_vec_data(learner, evaluator, pusher)
 
-        def sample_data(self, learner, evaluator):
             def collect_fn(state, action, reward, done):
                 self.buffer.add_data(state, action, reward, done)
 
-            def pull_weights_from_learner():
-                # pull weights from learner
-                weights = ray.get(learner.get_weights.remote())
-                self.variables.set_flat(weights)
-
             to_record = self.no == 0
             scores = deque(maxlen=self.weight_update_freq)
             epslens = deque(maxlen=self.weight_update_freq)
@@ -83,13 +131,16 @@ def get_worker(BaseClass, *args, **kwargs):
                             ScoreMax=np.max(score), 
                             EpslenMean=np.mean(epslens), 
                             EpslenStd=np.std(epslens), 
+                            PolicyLag=np.mean(self.policy_lags) if self.policy_lags else 0,
+                            SyncMB=np.mean(self.sync_bytes) / 2**20 if self.sync_bytes else 0,
+                            FullSyncMB=self.variables.get_flat().nbytes / 2**20,
                         )
                         tf_stats = dict(worker_no=f'worker_{self.no}')
                         tf_stats.update(stats)
 
-                        learner.record_stats.remote(tf_stats)
+                        pusher.call('record_stats', tf_stats)
                         
-                        learner.rl_log.remote(stats)
+                        pusher.call('rl_log', stats)
 
                     if score_mean > min(250, best_score_mean):
                         best_score_mean = score_mean
@@ -98,18 +149,112 @@ def get_worker(BaseClass, *args, **kwargs):
 
                     # send data to learner
                     if self.buffer.idx == self.buffer.capacity:
-                        last_state = np.zeros_like(self.buffer['state'][0])
-                        self.buffer.add_last_state(last_state)
-                        self.buffer['priority'][:self.buffer.idx] = self.compute_priorities()
-                        # push samples to the central buffer after each episode
-                        learner.merge_buffer.remote(dict(self.buffer), self.buffer.idx)
-                        self.buffer.reset()
+                        self._push(pusher, self.buffer)
+
+                    self.pull_weights(learner)
+
+        def run_steps(self, n_steps):
+            """ Collect n_steps transitions without pushing them, used for benchmark """
+            start = time()
+            if self.n_envs == 1:
+                def collect_fn(state, action, reward, done):
+                    self.buffer.add_data(state, action, reward, done)
+
+                while self.env_steps < n_steps:
+                    self.buffer.reset()
+                    _, epslen = self.run_trajectory(fn=collect_fn)
+                    self.env_steps += epslen
+            else:
+                for lane, _, _ in self._run_lanes():
+                    if self.env_steps >= n_steps:
+                        break
+                    self.buffers[lane].reset()
 
-                    # pull weights from learner
-                    weights = ray.get(learner.get_weights.remote())
-                    self.variables.set_flat(weights)
+            return self.env_steps, time() - start
 
         def print_construction_complete(self):
             pwc(f'Worker {self.no} has been constructed.', 'cyan')
 
+        """ Implementation """
+        def _sample_vec_data(self, learner, evaluator, pusher):
+            """ Same as sample_data, except that self.n_envs environments are stepped together.
+            Weights are pulled every weight_update_freq episodes per environment """
+            scores = deque(maxlen=self.weight_update_freq * self.n_envs)
+            best_score_mean = -50
+            episode_i = 0
+            for lane, score, epslen in self._run_lanes():
+                episode_i += 1
+                scores.append(score)
+                buffer = self.buffers[lane]
+                # push the lane once it cannot hold another episode, 
+                # so that pushed transitions always end with a complete episode
+                if buffer.idx + self.max_path_length > buffer.capacity:
+                    self._push(pusher, buffer)
+
+                if episode_i % scores.maxlen == 0:
+                    score_mean = np.mean(scores)
+                    if score_mean > min(250, best_score_mean):
+                        best_score_mean = score_mean
+                        pwc(f'Worker {self.no}: Best score updated to {best_score_mean:2f}', 'blue')
+                        evaluator.evaluate_model.remote(self.variables.get_flat(), score_mean)
+
+                    self.pull_weights(learner)
+
+        def _run_lanes(self):
+            """ Step self.train_env, which holds self.n_envs environments, with one batched action per step
+            and add transitions to the buffer of each lane. Yield (lane, score, epslen) whenever an episode ends """
+            env = self.train_env
+            states = env.reset()
+            while True:
+                actions = np.reshape(self.act(states), (self.n_envs, -1))
+                for _ in range(self.max_action_repetitions):
+                    next_states, rewards, dones, _ = env.step(actions)
+                    for buffer, state, action, reward, done in zip(self.buffers, states, actions, rewards, dones):
+                        buffer.add_data(state, action, reward, done)
+                    states = next_states
+                    self.env_steps += self.n_envs
+                    if np.any(dones):
+                        # finished environments should not be stepped again before being reset, 
+                        # so repetitions stop early for all lanes
+                        break
+
+                done_lanes = np.nonzero(dones[:, 0])[0]
+                if done_lanes.size:
+                    scores, epslens = env.get_score(), env.get_epslen()
+                    for lane in done_lanes:
+                        yield lane, scores[lane], epslens[lane]
+                    states[done_lanes] = env.reset(done_lanes)
+
+        def _push(self, pusher, buffer):
+            """ Push a local buffer ending with a complete episode to the replay """
+            if self.obs_moments is not None:
+                self.obs_moments.update(buffer['state'][:buffer.idx])
+            buffer.add_last_state(np.zeros_like(buffer['state'][0]))
+            buffer['priority'][:buffer.idx] = self.compute_priorities(buffer)
+            pusher.push(buffer, buffer.idx)
+            buffer.reset()
+            pusher.call('record_transfer_stats', self.no, pusher.get_stats())
+
     return Worker.remote(*args, **kwargs)
+
+
+if __name__ == '__main__':
+    # env steps/sec per core of workers stepping different numbers of environments
+    # python -m algo.off_policy.apex.worker
+    from utility.yaml_op import load_args
+    from algo.off_policy.td3.agent import Agent
+
+    args = load_args('algo/off_policy/apex/td3_args.yaml')
+    env_args, agent_args, buffer_args = args['env'], args['agent'], args['buffer']
+    agent_args['model_name'] = 'worker_benchmark'
+    n_steps = 20000
+
+    ray.init()
+    for n_envs in [1, 4, 16]:
+        env_args['n_envs'] = n_envs
+        agent_args['actor']['per_sample_noise'] = n_envs > 1
+        worker = get_worker(Agent, 'Agent', 1, agent_args, env_args.copy(), buffer_args.copy(), 1, device='/CPU:0')
+        steps, duration = ray.get(worker.run_steps.remote(n_steps))
+        print(f'{n_envs} envs per worker: {steps / duration:.1f} env steps/sec')
+        ray.kill(worker)
+    ray.shutdown()
@@ -9,9 +9,12 @@ from ray.experimental.tf_utils import TensorFlowVariables
 from utility.logger import Logger
 from utility.display import pwc
 from utility.debug_tools import assert_colorize
+from utility.tf_utils import VariableGroup
+from utility.run_avg import RunningMoments
 from basic_model.model import Model
 from env.gym_env import create_gym_env
 from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.replay_server import RemoteReplay, ShardedPrioritizedReplay
 from algo.off_policy.replay.uniform_replay import UniformReplay
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
 
@@ -43,20 +46,38 @@ class OffPolicyOperation(Model, ABC):
         # environment info
         env_args['gamma'] = self.gamma
         env_args['seed'] += 100
-        self.eval_env = create_gym_env(env_args)
+        # environments return raw states, which are normalized in the graph if normalize_obs, see _prepare_data
+        # evaluation runs one episode at a time even if training uses several environments
+        self.eval_env = create_gym_env(dict(env_args, n_envs=1, normalize_obs=False))
         env_args['seed'] -= 100
         env_args['log_video'] = False
-        self.train_env = create_gym_env(env_args)
+        self.train_env = create_gym_env(dict(env_args, normalize_obs=False))
         self.state_shape = self.train_env.state_shape
         self.action_dim = self.train_env.action_dim
+        self.normalize_obs = env_args.get('normalize_obs', False)
+        assert_colorize(not self.normalize_obs or env_args.get('frame_stack', 1) == 1, 
+                        'Stacked frames are not normalized by running moments')
+        # moments of states added to the replay, with which sampled and acted states are normalized
+        self.obs_moments = RunningMoments(self.state_shape, env_args.get('obs_clip', 5.)) if self.normalize_obs else None
 
         # replay buffer hyperparameters
         buffer_args['n_steps'] = args['n_steps']
         buffer_args['gamma'] = args['gamma']
         buffer_args['batch_size'] = args['batch_size']
+        buffer_args['frame_stack'] = env_args.get('frame_stack', 1)
         self.buffer_type = buffer_args['type']
-        if self.buffer_type == 'proportional':
-            self.buffer = ProportionalPrioritizedReplay(buffer_args, self.state_shape, self.action_dim)
+        if buffer_args.get('servers'):
+            # replay is sharded across ReplayServers, see apex/replay_server.py
+            ReplayType = ShardedPrioritizedReplay if self.buffer_type == 'proportional' else RemoteReplay
+            self.buffer = ReplayType(buffer_args['servers'], buffer_args)
+        elif self.buffer_type == 'proportional':
+            if buffer_args.get('shared_memory'):
+                # imported on demand since it requires Python 3.8+
+                from algo.off_policy.replay.shared_memory_replay import SharedMemoryReplay
+                ReplayType = SharedMemoryReplay
+            else:
+                ReplayType = ProportionalPrioritizedReplay
+            self.buffer = ReplayType(buffer_args, self.state_shape, self.action_dim)
         elif self.buffer_type == 'uniform':
             self.buffer = UniformReplay(buffer_args, self.state_shape, self.action_dim)
         elif self.buffer_type == 'local':
@@ -81,6 +102,12 @@ class OffPolicyOperation(Model, ABC):
 
         with self.graph.as_default():
             self.variables = TensorFlowVariables(self.loss, self.sess)
+            # named variable groups, each is synchronized through its own contiguous buffer
+            self.variable_groups = {name: VariableGroup(variables, self.sess)
+                                    for name, variables in self._variable_groups().items() if variables}
+        group_size = sum(group.get_flat_size() for group in self.variable_groups.values())
+        assert_colorize(group_size == self.variables.get_flat_size(), 
+                        f'Variable groups hold {group_size} weights, but the model has {self.variables.get_flat_size()}')
         
     @property
     def max_path_length(self):
@@ -91,18 +118,50 @@ class OffPolicyOperation(Model, ABC):
         return self.buffer.good_to_learn
 
     def add_data(self, state, action_repr, reward, done):
+        if self.obs_moments is not None:
+            self.obs_moments.update(state)
         self.buffer.add(state, action_repr, reward, done)
         
     def merge_buffer(self, buffer, length):
+        if self.obs_moments is not None:
+            self.obs_moments.update(buffer['state'][:length])
         self.buffer.merge(buffer, length)
 
     def act(self, state, deterministic=False):
         state = state.reshape((-1, *self.state_shape))
         action_tf = self.action_det if deterministic else self.action
-        action = self.sess.run(action_tf, feed_dict={self.data['state']: state})
+        feed_dict = {self.data['raw_state']: state}
+        feed_dict.update(self._get_obs_feeddict())
+        action = self.sess.run(action_tf, feed_dict=feed_dict)
         
         return np.squeeze(action)
 
+    def get_weights(self, groups=None):
+        """ Return flat weights of self.variables if groups is None, 
+        otherwise a dict mapping each group in groups to its flat weights """
+        if groups is None:
+            return self.variables.get_flat()
+        else:
+            return {name: self.variable_groups[name].get_flat() for name in groups}
+
+    def set_weights(self, weights, groups=None):
+        """ Set weights returned by get_weights, only groups in groups are set if it's provided """
+        if isinstance(weights, dict):
+            for name in (groups or weights):
+                self.variable_groups[name].set_flat(weights[name])
+        else:
+            self.variables.set_flat(weights)
+
+    def export_numpy_policy(self):
+        """ Export the layout of the policy group and the policy spec, 
+        from which a NumpyPolicy acts without tensorflow. See algo/off_policy/np_policy.py """
+        variables = self.variable_groups['policy'].variables
+        layout = [(name, var.shape.as_list()) for name, var in variables.items()]
+        spec = self._numpy_policy_spec()
+        spec['state_shape'] = self.state_shape
+
+        return layout, spec
+
     def run_trajectory(self, fn=None, render=False, random_action=False, evaluation=False):
         """ run a trajectory, fn is a function executed after each environment step """
         env = self.eval_env if evaluation else self.train_env
@@ -124,7 +183,8 @@ class OffPolicyOperation(Model, ABC):
         return env.get_score(), env.get_epslen()
 
     def learn(self, t=None):
-        feed_dict = self._get_feeddict(t) if self.schedule_lr else None
+        feed_dict = self._get_feeddict(t) if self.schedule_lr else {}
+        feed_dict.update(self._get_obs_feeddict())
     
         fetches = [self.priority, self.data['saved_mem_idxs']] if self.buffer_type == 'proportional' else []
         
@@ -194,6 +254,17 @@ class OffPolicyOperation(Model, ABC):
             state, action, reward, next_state, done, steps = samples
             data['IS_ratio'] = 1                                # fake ratio to avoid complicate the code
 
+        # states are fed here when they do not come from the replay, e.g., when acting
+        data['raw_state'] = state
+        data['raw_next_state'] = next_state
+        if self.normalize_obs:
+            # the replay holds raw states, which are normalized by the current moments when they are sampled.
+            # States normalized when they were added would disagree with the moments the agent acts with
+            with tf.name_scope('obs_moments'):
+                self.obs_mean = tf.placeholder(tf.float32, self.state_shape, name='mean')
+                self.obs_inv_std = tf.placeholder(tf.float32, self.state_shape, name='inv_std')
+            state, next_state = self._normalize_obs(state), self._normalize_obs(next_state)
+
         data['state'] = state
         data['action'] = action
         data['reward'] = reward
@@ -203,6 +274,19 @@ class OffPolicyOperation(Model, ABC):
 
         return data
 
+    def _normalize_obs(self, state):
+        """ Same as RunningMoments.normalize, with moments fed by _get_obs_feeddict """
+        clip = self.obs_moments.clip
+
+        return tf.clip_by_value((state - self.obs_mean) * self.obs_inv_std, -clip, clip)
+
+    def _get_obs_feeddict(self):
+        if self.obs_moments is None:
+            return {}
+        mean, inv_std = self.obs_moments.scale
+
+        return {self.obs_mean: mean, self.obs_inv_std: inv_std}
+
     def _compute_priority(self, priority):
         with tf.name_scope('priority'):
             priority += self.prio_epsilon
@@ -218,3 +302,10 @@ class OffPolicyOperation(Model, ABC):
 
     def _get_feeddict(self, t):
         raise NotImplementedError
+
+    def _variable_groups(self):
+        """ Return a dict mapping group names(policy, critic, target, temperature) to variables """
+        raise NotImplementedError
+
+    def _numpy_policy_spec(self):
+        raise NotImplementedError
@@ -7,11 +7,15 @@ import numpy as np
 import tensorflow as tf
 import ray
 
+from utility.display import pwc, assert_colorize
 from utility.tf_utils import get_sess_config
 from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
 from algo.off_policy.apex.worker import get_worker
 from algo.off_policy.apex.learner import get_learner
 from algo.off_policy.apex.evaluator import get_evaluator
+from algo.off_policy.apex.inference import get_inference_server, get_env_worker
+from algo.off_policy.apex.replay_server import get_replay_servers
+from env.gym_env import create_gym_env
 
 
 def main(env_args, agent_args, buffer_args, render=False):
@@ -32,43 +36,105 @@ def main(env_args, agent_args, buffer_args, render=False):
 
     ray.init()
 
+    n_servers = buffer_args.get('n_servers', 0)
+    if n_servers:
+        # replay is sharded across ReplayServers, workers push data to servers by worker_no.
+        # worker 0 only records the policy, so servers are assigned over the others, 
+        # otherwise a server may never fill up and learning never starts
+        assert_colorize(n_servers < n_workers, 
+                        f'{n_servers} ReplayServers need at least {n_servers + 1} workers, but get {n_workers}')
+        env = create_gym_env(dict(env_args, n_envs=1, log_video=False))
+        server_args = dict(buffer_args, n_steps=agent_args['n_steps'], 
+                           gamma=agent_args['gamma'], batch_size=agent_args['batch_size'],
+                           frame_stack=env_args.get('frame_stack', 1))
+        servers = get_replay_servers(n_servers, server_args, env.state_shape, env.action_dim, 
+                                     max_concurrency=n_workers // n_servers + 4)
+        learner_buffer_args = dict(buffer_args, servers=servers)
+        replays = [None] + [servers[(worker_no - 1) % n_servers] for worker_no in range(1, n_workers)]
+    else:
+        learner_buffer_args = buffer_args
+        replays = [None] * n_workers
+
     agent_name = 'Agent'
     sess_config = get_sess_config(2)
-    learner = get_learner(Agent, agent_name, agent_args, env_args, buffer_args, 
+    n_envs = env_args.get('n_envs', 1)
+    env_args['n_envs'] = 1
+    learner = get_learner(Agent, agent_name, agent_args, env_args, learner_buffer_args, 
                             log=True, log_tensorboard=True, log_stats=True, 
                             sess_config=sess_config, device='/GPU: 0')
     env_args['seed'] = 0
     agent_args['model_name'] = 'evaluator'
-    evaluator = get_evaluator(Agent, agent_name, agent_args, env_args, buffer_args,
+    evaluator = get_evaluator(Agent, agent_name, agent_args, env_args, buffer_args, learner=learner,
                             sess_config=sess_config, device='/CPU: 0')
-    workers = []
-    agent_args['model_name'] = 'worker'
-    env_args['log_video'] = False
-    sess_config = tf.ConfigProto(intra_op_parallelism_threads=1,
-                                 inter_op_parallelism_threads=1,
-                                 allow_soft_placement=True)
-    # we treat worker_0 separately as an evaluator
-    for worker_no in range(n_workers):
-        weight_update_freq = 1    # np.random.randint(1, 10)
-        if agent_args['algorithm'] == 'apex-td3':
-            agent_args['actor']['noisy_sigma'] = 0.1 if worker_no == 0 else np.random.randint(4, 10) * .1
-        elif agent_args['algorithm'] == 'apex-sac':
-            agent_args['Policy']['noisy_sigma'] = 0.1 if worker_no == 0 else np.random.randint(4, 10) * .1
-        else:
-            raise NotImplementedError
-        env_args['seed'] = 0#(worker_no + 1) * 100
-        if worker_no == 0:
-            env_args['log_video'] = True
-        else:
-            env_args['log_video'] = False
-        worker = get_worker(Agent, agent_name, worker_no, agent_args, env_args, buffer_args, 
-                            weight_update_freq, sess_config=sess_config, device=f'/CPU:0')
-        workers.append(worker)
 
-    pids = [worker.sample_data.remote(learner, evaluator) for worker in workers]
+    def noisy_sigma(worker_no):
+        # worker 0 records the policy, others explore with different amounts of noise as in Ape-X
+        return 0.1 if worker_no == 0 else np.random.randint(4, 10) * .1
 
+    if agent_args.get('central_inference'):
+        # env-only workers share a central inference server, which pulls weights from the learner
+        layout, spec = ray.get(learner.export_numpy_policy.remote())
+        server = get_inference_server(layout, spec, agent_args['inference'], learner=learner,
+                                      max_concurrency=n_workers + 1)
+        workers = [get_env_worker(worker_no, agent_args, dict(env_args, log_video=worker_no == 0), buffer_args.copy(), 
+                                  server=server, noisy_sigma=noisy_sigma(worker_no))
+                   for worker_no in range(n_workers)]
+    else:
+        workers = []
+        agent_args['model_name'] = 'worker'
+        env_args['log_video'] = False
+        sess_config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                                     inter_op_parallelism_threads=1,
+                                     allow_soft_placement=True)
+        # we treat worker_0 separately as an evaluator
+        for worker_no in range(n_workers):
+            weight_update_freq = 1    # np.random.randint(1, 10)
+            env_args['n_envs'] = 1 if worker_no == 0 else n_envs
+            if agent_args['algorithm'] == 'apex-td3':
+                policy_args = agent_args['actor']
+            elif agent_args['algorithm'] == 'apex-sac':
+                policy_args = agent_args['Policy']
+            else:
+                raise NotImplementedError
+            policy_args['noisy_sigma'] = noisy_sigma(worker_no)
+            # environments acting in one batch draw their own noise
+            policy_args['per_sample_noise'] = env_args['n_envs'] > 1
+            env_args['seed'] = 0#(worker_no + 1) * 100
+            if worker_no == 0:
+                env_args['log_video'] = True
+            else:
+                env_args['log_video'] = False
+            worker = get_worker(Agent, agent_name, worker_no, agent_args, env_args, buffer_args, 
+                                weight_update_freq, sess_config=sess_config, device=f'/CPU:0')
+            workers.append(worker)
+
+    pids = [worker.sample_data.remote(learner, evaluator, replay=replay) for worker, replay in zip(workers, replays)]
+
+    # the learner is restored to the best snapshot only if it is newer than the last restored one,
+    # or if the latest evaluation falls behind the best by more than restore_threshold
+    restore_threshold = agent_args.get('evaluator', {}).get('restore_threshold')
+    restored_time = 0       # submission time of the last restored snapshot
+    n_evaluated = 0
     while True:
         time.sleep(600)
-        weights = evaluator.get_best_model.remote()
-        ray.get(learner.set_weights.remote(weights))
+        stats = ray.get(evaluator.get_stats.remote())
+        pwc(f'Evaluator: {stats}', 'cyan')
+        best = ray.get(evaluator.get_best_model.remote())
+        if best is None:
+            continue
+        score, submission_time, weights_id = best
+        # regressions are only judged on evaluations made since the last check
+        regressed = (restore_threshold is not None and stats['Evaluated'] > n_evaluated
+                     and stats['LatestScore'] < score - float(restore_threshold))
+        n_evaluated = stats['Evaluated']
+        if submission_time > restored_time:
+            pwc(f'Restore the learner to the new best snapshot, which scores {score:.2f}', 'cyan')
+        elif regressed:
+            pwc(f'Restore the learner to the best snapshot, which scores {score:.2f}, '
+                f'since the latest evaluation regresses to {stats["LatestScore"]:.2f}', 'cyan')
+        else:
+            pwc(f'Keep the learner, the best snapshot scoring {score:.2f} has been restored before', 'cyan')
+            continue
+        ray.get(learner.set_weights.remote(weights_id))
+        restored_time = submission_time
 
@@ -0,0 +1,273 @@
+"""
+NumPy runtime for off-policy policies.
+It allows processes that only act (e.g., Ape-X workers and evaluators)
+to run the policy without building a tensorflow graph and session.
+
+The learner exports a (layout, spec) pair via OffPolicyOperation.export_numpy_policy,
+where layout describes the flat weights returned by TensorFlowVariables.get_flat
+and spec describes the forward pass of the policy. Both are plain python objects,
+so they can be shipped through ray without importing tensorflow on the other end.
+"""
+import numpy as np
+
+from utility.display import assert_colorize
+
+
+""" Layers """
+def relu(x):
+    return np.maximum(x, 0)
+
+def layer_norm(x, beta, gamma, epsilon=1e-12):
+    """ Mirror tc.layers.layer_norm, which normalizes over the last dimension for 2D inputs """
+    mean = np.mean(x, axis=-1, keepdims=True)
+    var = np.var(x, axis=-1, keepdims=True)
+    x = (x - mean) / np.sqrt(var + epsilon)
+
+    return gamma * x + beta
+
+def truncated_normal(shape, stddev):
+    """ Mirror tf.random.truncated_normal, values beyond two stddevs are resampled """
+    x = np.random.normal(size=shape)
+    invalid = np.abs(x) > 2
+    while np.any(invalid):
+        x[invalid] = np.random.normal(size=np.sum(invalid))
+        invalid = np.abs(x) > 2
+
+    return (stddev * x).astype(np.float32)
+
+def factorized_noise(features, units, sigma):
+    """ Factorized Gaussian noise used by Layer.noisy, return (epsilon_w_in, epsilon_w_out).
+    sigma is either a scalar shared by all samples, or an array of shape [N, 1], 
+    in which case each of the N samples draws its own noise of shape [N, features] and [N, units] """
+    f = lambda eps: np.sign(eps) * np.sqrt(np.abs(eps))
+    batch_shape = () if np.isscalar(sigma) else (len(sigma), )
+    epsilon_w_in = f(truncated_normal((*batch_shape, features), sigma))
+    epsilon_w_out = f(truncated_normal((*batch_shape, units), sigma))
+
+    return epsilon_w_in, epsilon_w_out
+
+
+""" Spec helpers, used by agents to describe their policies """
+def layer_spec(var_names, noisy=False, norm=None, sigma=.4):
+    """ Pop the variables of a (noisy) dense layer followed by an optional normalization layer
+    from var_names, which should be in the order of creation
+
+    Arguments:
+        var_names {list} -- variable names in the order of creation
+
+    Keyword Arguments:
+        noisy {bool} -- whether the layer is a noisy layer (default: {False})
+        norm {str or None} -- 'layer' or None (default: {None})
+        sigma {float} -- standard deviation for the noisy layer (default: {.4})
+    """
+    def pop(suffix):
+        name = var_names.pop(0)
+        assert_colorize(name.endswith(suffix), f'Expect a variable ending with "{suffix}", but get "{name}"')
+        return name
+
+    spec = dict(kernel=pop('kernel'), bias=pop('bias'))
+    if noisy:
+        spec.update(noisy_w=pop('noisy_w'), noisy_b=pop('noisy_b'), sigma=sigma)
+    if norm == 'layer':
+        spec.update(beta=pop('beta'), gamma=pop('gamma'))
+    else:
+        assert_colorize(norm is None or norm.lower() == 'none', f'Unsupported normalization: {norm}')
+
+    return spec
+
+def variable_names(variables):
+    """ Variable names consistent with keys in TensorFlowVariables.variables """
+    return [v.op.name for v in variables]
+
+
+class NumpyPolicy:
+    """ Interface """
+    def __init__(self, layout, spec):
+        """ A policy runs in pure NumPy
+
+        Arguments:
+            layout {list} -- A list of (name, shape) describing the flat weights
+            spec {dict} -- Description of the forward pass, see _numpy_policy_spec in agents
+        """
+        self.layout = [(name, tuple(shape)) for name, shape in layout]
+        self.spec = spec
+        self.state_shape = tuple(spec['state_shape'])
+        self.params = {}
+        self.sigma = None       # per-sample standard deviations of noisy layers, see act
+
+        self._forward = dict(
+            soft_policy=self._soft_policy,
+            deterministic_policy=self._deterministic_policy,
+            iqn=self._iqn,
+            duel=self._duel,
+            double=self._double,
+        )[spec['type']]
+
+    @property
+    def size(self):
+        return sum(int(np.prod(shape)) for _, shape in self.layout)
+
+    def set_flat(self, flat):
+        """ Set weights from the flat vector returned by TensorFlowVariables.get_flat """
+        flat = np.asarray(flat, dtype=np.float32)
+        assert_colorize(flat.size == self.size, f'Expect weights of size {self.size}, but get {flat.size}')
+        start = 0
+        for name, shape in self.layout:
+            end = start + int(np.prod(shape))
+            self.params[name] = flat[start: end].reshape(shape)
+            start = end
+
+    def act(self, state, deterministic=False, sigma=None):
+        """ Same as OffPolicyOperation.act. If sigma is given, it holds a standard deviation for each state,
+        with which the state draws its own noise in noisy layers in place of the sigma in spec """
+        state = np.reshape(state, (-1, *self.state_shape)).astype(np.float32)
+        self.sigma = None if sigma is None else np.reshape(sigma, (-1, 1)).astype(np.float32)
+        action = self._forward(state, deterministic)
+
+        return np.squeeze(action)
+
+    """ Implementation """
+    def _layer(self, x, spec, activation=relu, noise_on_activation=True):
+        p = self.params
+        y = self._matmul(x, spec['kernel']) + p[spec['bias']]
+        o = 0
+        if 'noisy_w' in spec:
+            # x @ (noisy_w * epsilon_w) + noisy_b * epsilon_b in Layer.noisy, where
+            # epsilon_w = epsilon_w_in @ epsilon_w_out and epsilon_b = epsilon_w_out
+            if self.sigma is None:
+                epsilon_w_in, epsilon_w_out = factorized_noise(x.shape[-1], y.shape[-1], spec['sigma'])
+            else:
+                epsilon_w_in, epsilon_w_out = factorized_noise(x.shape[-1], y.shape[-1], self.sigma)
+                # the batch is tiled by iqn, copies of a state share its noise
+                reps = (len(x) // len(self.sigma), 1)
+                epsilon_w_in, epsilon_w_out = np.tile(epsilon_w_in, reps), np.tile(epsilon_w_out, reps)
+            o = (self._matmul(x * epsilon_w_in, spec['noisy_w']) + p[spec['noisy_b']]) * epsilon_w_out
+            if noise_on_activation:
+                # Layer.noisy followed by norm_activation
+                y, o = o + y, 0
+        if 'beta' in spec:
+            y = layer_norm(y, p[spec['beta']], p[spec['gamma']])
+        if activation:
+            y = activation(y)
+
+        # Layer.noisy_norm_activation only applies norm and activation to the noiseless part
+        return o + y
+
+    def _matmul(self, x, name):
+        return x @ self.params[name]
+
+    def _mlp(self, x, layers, **kwargs):
+        for spec in layers:
+            x = self._layer(x, spec, **kwargs)
+
+        return x
+
+    def _soft_policy(self, state, deterministic):
+        LOG_STD_MIN = -20.
+        LOG_STD_MAX = 2.
+        x = self._mlp(state, self.spec['layers'])
+        mean = self._layer(x, self.spec['mean'], activation=None)
+        if deterministic:
+            return np.tanh(mean)
+
+        logstd = self._layer(x, self.spec['logstd'], activation=None)
+        logstd = np.clip(logstd, LOG_STD_MIN, LOG_STD_MAX)
+        action = mean + np.exp(logstd) * np.random.normal(size=mean.shape)
+
+        return np.tanh(action)
+
+    def _deterministic_policy(self, state, deterministic):
+        # noisy layers are used regardless of deterministic, consistent with td3.Agent
+        x = self._mlp(state, self.spec['layers'])
+        x = self._layer(x, self.spec['out'], activation=None)
+
+        return np.tanh(x)
+
+    def _iqn(self, state, deterministic):
+        spec = self.spec
+        K = spec['K']
+        batch_size = state.shape[0]
+
+        # psi function in the paper
+        x = self._mlp(state, spec['psi'])
+        x_tiled = np.tile(x, [K, 1])
+        # phi function in the paper
+        quantiles = np.random.uniform(size=(K * batch_size, 1))
+        x_quantiles = np.arange(spec['quantile_embedding_dim']) * np.pi * quantiles
+        x_quantiles = self._layer(np.cos(x_quantiles).astype(np.float32), spec['phi'], activation=None)
+        # f function in the paper
+        y = x_tiled * x_quantiles
+        y = self._mlp(y, spec['f'], noise_on_activation=False)
+        quantile_values = self._layer(y, spec['out'], activation=None, noise_on_activation=False)
+        quantile_values = np.reshape(quantile_values, (K, batch_size, -1))
+        Qs = np.mean(quantile_values, axis=0)
+
+        return np.argmax(Qs, axis=1)
+
+    def _duel(self, state, deterministic):
+        spec = self.spec
+        x = self._mlp(state, spec['psi'])
+        # mirror rainbow_iqn.Networks._duel_net, where only the last f layer matters
+        for s in spec['f_v']:
+            hv = self._layer(x, s, noise_on_activation=False)
+        v = self._layer(hv, spec['v'], activation=None, noise_on_activation=False)
+        for s in spec['f_a']:
+            ha = self._layer(x, s, noise_on_activation=False)
+        a = self._layer(ha, spec['a'], activation=None, noise_on_activation=False)
+        Qs = v + a - np.mean(a, axis=1, keepdims=True)
+
+        return np.argmax(Qs, axis=1)
+
+    def _double(self, state, deterministic):
+        spec = self.spec
+        x = self._mlp(state, spec['psi'])
+        x = self._mlp(x, spec['f'], noise_on_activation=False)
+        Qs = self._layer(x, spec['out'], activation=None, noise_on_activation=False)
+
+        return np.argmax(Qs, axis=1)
+
+
+if __name__ == '__main__':
+    # compare the numpy policy against the tensorflow agent
+    # python -m algo.off_policy.np_policy
+    import os
+    import psutil
+    from utility.yaml_op import load_args
+    from utility.timer import Timer
+    from utility.debug_tools import timeit
+    from algo.off_policy.sac.agent import Agent
+
+    process = psutil.Process(os.getpid())
+    rss = lambda: process.memory_info().rss / 2**20
+
+    args = load_args('algo/off_policy/apex/sac_args.yaml')
+    env_args, agent_args, buffer_args = args['env'], args['agent'], args['buffer']
+    buffer_args['type'] = 'local'
+    buffer_args['local_capacity'] = 1
+    agent_args['model_name'] = 'np_policy_benchmark'
+    n = 1000
+
+    start_mem = rss()
+    duration, agent = timeit(Agent, 'Agent', agent_args, env_args, buffer_args, device='/CPU:0')
+    print(f'tensorflow agent: startup {duration:.2f}s\tmemory {rss() - start_mem:.1f}MB')
+
+    start_mem = rss()
+    def build_numpy_policy():
+        policy = NumpyPolicy(*agent.export_numpy_policy())
+        policy.set_flat(agent.get_weights(['policy'])['policy'])
+        return policy
+    duration, policy = timeit(build_numpy_policy)
+    print(f'numpy policy: startup {duration:.2f}s\tmemory {rss() - start_mem:.1f}MB')
+
+    state = agent.train_env.reset()
+    for deterministic in [True, False]:
+        with Timer(f'tensorflow act(deterministic={deterministic}) {n} times'):
+            for _ in range(n):
+                agent.act(state, deterministic=deterministic)
+        with Timer(f'numpy act(deterministic={deterministic}) {n} times'):
+            for _ in range(n):
+                policy.act(state, deterministic=deterministic)
+
+    tf_action = agent.act(state, deterministic=True)
+    np_action = policy.act(state, deterministic=True)
+    print(f'max absolute difference of deterministic actions: {np.max(np.abs(tf_action - np_action)):.2e}')
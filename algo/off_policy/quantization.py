@@ -0,0 +1,156 @@
+"""
+Post-training quantization for NumpyPolicy.
+Kernels are stored either as float16 or as int8 with per-channel (per output unit) scales,
+other variables (biases, normalization parameters, etc.) are stored as float16.
+The quantized payload replaces the float32 flat weights in weight sync,
+shrinking the payload by about 2x (float16) or 4x (int8).
+NumPy has no int8 or float16 matrix multiplication kernels and converts such operands
+to float32 on every call, so QuantizedNumpyPolicy dequantizes a payload once when it is set
+and acts in float32 on the dequantized weights.
+"""
+import numpy as np
+
+from utility.display import assert_colorize
+from algo.off_policy.np_policy import NumpyPolicy
+
+
+def quantize_weights(flat, layout, dtype='int8'):
+    """ Quantize the flat weights returned by TensorFlowVariables.get_flat
+
+    Arguments:
+        flat {np.ndarray} -- flat float32 weights
+        layout {list} -- A list of (name, shape) describing flat
+
+    Keyword Arguments:
+        dtype {str} -- 'int8' or 'float16' (default: {'int8'})
+
+    Returns:
+        payload {dict} -- name --> quantized array,
+                          int8 kernels are represented by (quantized array, scale)
+    """
+    assert_colorize(dtype in ('int8', 'float16'), f'Unsupported dtype: {dtype}')
+    flat = np.asarray(flat, dtype=np.float32)
+    payload = dict(dtype=dtype, weights={})
+    start = 0
+    for name, shape in layout:
+        end = start + int(np.prod(shape))
+        w = flat[start: end].reshape(shape)
+        start = end
+        if dtype == 'int8' and len(shape) == 2:
+            # symmetric per-channel quantization
+            scale = np.max(np.abs(w), axis=0) / 127.
+            scale = np.where(scale == 0, 1., scale).astype(np.float32)
+            q = np.round(w / scale).astype(np.int8)
+            payload['weights'][name] = (q, scale)
+        else:
+            payload['weights'][name] = w.astype(np.float16)
+
+    return payload
+
+def dequantize_weights(payload, layout):
+    """ Recover flat float32 weights from the payload """
+    weights = payload['weights']
+    flat = [(weights[name][0] * weights[name][1] if isinstance(weights[name], tuple)
+            else weights[name]).astype(np.float32).reshape(-1)
+            for name, _ in layout]
+
+    return np.concatenate(flat)
+
+def payload_nbytes(payload):
+    return sum(sum(x.nbytes for x in w) if isinstance(w, tuple) else w.nbytes
+               for w in payload['weights'].values())
+
+
+class QuantizedNumpyPolicy(NumpyPolicy):
+    """ Interface """
+    def __init__(self, layout, spec, dtype='int8'):
+        self.dtype = dtype
+        super().__init__(layout, spec)
+
+    def set_flat(self, flat):
+        self.set_quantized(quantize_weights(flat, self.layout, self.dtype))
+
+    def set_quantized(self, payload):
+        """ Set weights from the payload returned by quantize_weights """
+        assert_colorize(payload['dtype'] == self.dtype,
+                        f'Expect a payload of dtype {self.dtype}, but get {payload["dtype"]}')
+        weights = payload['weights']
+        for name, _ in self.layout:
+            w = weights[name]
+            self.params[name] = (w[0] * w[1] if isinstance(w, tuple) else w).astype(np.float32)
+
+
+def compare_actions(reference, policy, states, discrete=False, seed=0):
+    """ Compare the actions of policy against those of reference at states.
+    Both policies draw the same random numbers so that the noisy layers behave identically
+
+    Returns:
+        dict -- max and mean absolute differences for continuous actions,
+                action agreement for discrete actions
+    """
+    def act(p, state):
+        np.random.seed(seed)
+        return p.act(state, deterministic=True)
+
+    reference_actions = np.array([act(reference, s) for s in states])
+    actions = np.array([act(policy, s) for s in states])
+    if discrete:
+        return dict(Agreement=np.mean(reference_actions == actions))
+    else:
+        diff = np.abs(reference_actions - actions)
+        return dict(MaxDiff=np.max(diff), MeanDiff=np.mean(diff))
+
+def rollout_states(policy, env, n_steps):
+    """ Collect states visited by policy in env """
+    states = []
+    state = env.reset()
+    for _ in range(n_steps):
+        states.append(state)
+        state, _, done, _ = env.step(policy.act(state, deterministic=True))
+        if done:
+            state = env.reset()
+
+    return np.array(states)
+
+
+if __name__ == '__main__':
+    # accuracy and throughput report against the float32 numpy policy
+    # python -m algo.off_policy.quantization
+    from utility.yaml_op import load_args
+    from utility.timer import Timer
+    from algo.off_policy.sac.agent import Agent
+
+    args = load_args('algo/off_policy/apex/sac_args.yaml')
+    env_args, agent_args, buffer_args = args['env'], args['agent'], args['buffer']
+    buffer_args['type'] = 'local'
+    buffer_args['local_capacity'] = 1
+    agent_args['model_name'] = 'quantization_benchmark'
+    agent = Agent('Agent', agent_args, env_args, buffer_args, device='/CPU:0')
+    layout, spec = agent.export_numpy_policy()
+    flat = agent.get_weights(['policy'])['policy']
+
+    policy = NumpyPolicy(layout, spec)
+    policy.set_flat(flat)
+    states = rollout_states(policy, agent.train_env, 1000)
+    print(f'float32: payload {flat.astype(np.float32).nbytes / 2**20:.2f}MB')
+    batch = states[:64]
+    n = 1000
+
+    with Timer(f'float32 act {n} times'):
+        for s in states:
+            policy.act(s)
+    with Timer(f'float32 act on batches of {len(batch)} {n} times'):
+        for _ in range(n):
+            policy.act(batch)
+    for dtype in ['float16', 'int8']:
+        payload = quantize_weights(flat, layout, dtype)
+        quantized = QuantizedNumpyPolicy(layout, spec, dtype)
+        quantized.set_quantized(payload)
+        print(f'{dtype}: payload {payload_nbytes(payload) / 2**20:.2f}MB\t'
+              f'{compare_actions(policy, quantized, states)}')
+        with Timer(f'{dtype} act {n} times'):
+            for s in states:
+                quantized.act(s)
+        with Timer(f'{dtype} act on batches of {len(batch)} {n} times'):
+            for _ in range(n):
+                quantized.act(batch)
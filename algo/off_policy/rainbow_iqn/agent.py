@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 from algo.off_policy.basic_agent import OffPolicyOperation
+from algo.off_policy.np_policy import layer_spec, variable_names
 from algo.off_policy.rainbow_iqn.networks import Networks
 from utility.losses import huber_loss
 from utility.display import pwc
@@ -143,6 +144,41 @@ class Agent(OffPolicyOperation):
     def _update_target_net(self):
         self.sess.run(self.update_target_op)
 
+    def _variable_groups(self):
+        # actions are selected by the online Q network
+        return dict(
+            policy=self.Qnets.main_variables,
+            target=self.Qnets.target_variables
+        )
+
+    def _numpy_policy_spec(self):
+        # noisy layers in Networks use the default sigma of Layer.noisy
+        net_args = self.args['Qnets']
+        var_names = variable_names(self.Qnets.main_variables)
+        dense = lambda: layer_spec(var_names)
+        noisy = lambda: layer_spec(var_names, noisy=True)
+
+        spec = dict(type=self.algo)
+        spec['psi'] = [dense() for _ in net_args['psi_units']]
+        if self.algo == 'iqn':
+            spec['phi'] = dense()
+            spec['f'] = [noisy() for _ in net_args['f_units']]
+            spec['out'] = noisy()
+            spec['K'] = net_args['K']
+            spec['quantile_embedding_dim'] = net_args['quantile_embedding_dim']
+        elif self.algo == 'duel':
+            spec['f_v'] = [noisy() for _ in net_args['f_units']]
+            spec['v'] = noisy()
+            spec['f_a'] = [noisy() for _ in net_args['f_units']]
+            spec['a'] = noisy()
+        elif self.algo == 'double':
+            spec['f'] = [noisy() for _ in net_args['f_units']]
+            spec['out'] = noisy()
+        else:
+            raise NotImplementedError(f'Invalid algorithm: {self.algo}')
+
+        return spec
+
     def _log_loss(self):
         if self.log_tensorboard:
             with tf.name_scope('loss'):
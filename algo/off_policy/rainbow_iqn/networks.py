@@ -63,15 +63,15 @@ class Networks(Module):
                                         reuse=reuse))
             # online IQN network
             quantiles, quantile_values, Qs = net_fn(self.state, self.N, self.batch_size, 'main')
-            # Qs for online action selection
-            _, _, Qs_online = net_fn(self.state, self.K, 1, 'main', reuse=True)      
+            # Qs for online action selection, states may come from several environments
+            _, _, Qs_online = net_fn(self.state, self.K, tf.shape(self.state)[0], 'main', reuse=True)
             # target IQN network
             _, quantile_values_next_target, Qs_next_target = net_fn(self.next_state, self.N_prime, self.batch_size, 'target')
             # next online Qs for double Q action selection
             _, _, Qs_next = net_fn(self.next_state, self.K, self.batch_size, 'main', reuse=True)
             
             self.quantiles = quantiles                                              # [B, N, 1]
-            self.best_action = select_action(Qs_online, 'best_action')           # [1]
+            self.best_action = select_action(Qs_online, 'best_action')           # [B]
             next_action = select_action(Qs_next, 'next_action')                  # [B]
 
             # quantile_values for regression loss
@@ -6,7 +6,8 @@ from utility.debug_tools import assert_colorize
 from utility.display import pwc
 from utility.utils import to_int
 from utility.run_avg import RunningMeanStd
-from algo.off_policy.replay.utils import add_buffer, copy_buffer
+from algo.off_policy.replay.utils import add_buffer, copy_buffer, stack_frames
+from algo.off_policy.replay.rate_limiter import RateLimiter
 
 class Replay(ABC):
     """ Interface """
@@ -25,12 +26,16 @@ class Replay(ABC):
 
         self.n_steps = args['n_steps']
         self.gamma = args['gamma']
+        # frames of stacked states are stored once, see replay/utils.init_buffer
+        self.frame_stack = args.get('frame_stack', 1)
         
         self.is_full = False
         self.mem_idx = 0
         
         # locker used to avoid conflict introduced by tf.data.Dataset and multi-agent
         self.locker = threading.Lock()
+        # rate limiter shared by inserts and samples, None if samples_per_insert is not specified
+        self.rate_limiter = RateLimiter.from_args(args)
 
     @property
     def good_to_learn(self):
@@ -47,6 +52,8 @@ class Replay(ABC):
         assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
                                             f'transitions in buffer: {len(self)}\t'
                                             f'minimum required size: {self.min_size}')
+        if self.rate_limiter:
+            self.rate_limiter.await_sample(self.batch_size)
         with self.locker:
             samples = self._sample()
 
@@ -56,6 +63,8 @@ class Replay(ABC):
         """ Merge a local buffer to the replay buffer, useful for distributed algorithms """
         assert_colorize(length < self.capacity, 
                     f'Local buffer cannot be largeer than the replay: {length} vs. {self.capacity}')
+        if self.rate_limiter:
+            self.rate_limiter.await_insert(length)
         with self.locker:
             self._merge(local_buffer, length)
 
@@ -91,10 +100,14 @@ class Replay(ABC):
                 self.tb_idx = n_not_ready
                 self.tb_full = False
         else:
+            if self.rate_limiter:
+                self.rate_limiter.await_insert(1)
             with self.locker:
                 add_buffer(self.memory, self.mem_idx, state, action, reward,
                             done, self.n_steps, self.gamma)
                 self.mem_idx = (self.mem_idx + 1) % self.capacity
+                # memory is recycled via FIFO as in _merge
+                self.is_full = self.is_full or self.mem_idx == 0
 
     def _sample(self):
         raise NotImplementedError
@@ -126,12 +139,13 @@ class Replay(ABC):
         indexes = np.asarray(indexes) # convert tuple to array
         
         done = self.memory['done'][indexes]
-        state = self.memory['state'][indexes] 
+        state = self._get_states(indexes)
         # squeeze steps since it is of shape [None, 1]
         next_indexes = (indexes + np.squeeze(self.memory['steps'][indexes])) % self.capacity
         assert indexes.shape == next_indexes.shape
         # using zero state as the terminal state
-        next_state = np.where(done, np.zeros_like(state), self.memory['state'][next_indexes])
+        next_state = np.where(done.reshape(-1, *[1] * (state.ndim - 1)), 
+                              np.zeros_like(state), self._get_states(next_indexes))
 
         # process rewards
         reward = np.copy(self.memory['reward'][indexes])
@@ -147,3 +161,10 @@ class Replay(ABC):
             done,
             self.memory['steps'][indexes],
         )
+
+    def _get_states(self, indexes):
+        if self.frame_stack == 1:
+            return self.memory['state'][indexes]
+        # frames before the oldest transition have been overwritten
+        return stack_frames(self.memory, indexes, self.frame_stack, 
+                            oldest=self.mem_idx if self.is_full else 0)
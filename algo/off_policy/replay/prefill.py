@@ -0,0 +1,144 @@
+"""
+Parallel prefill of a replay before training.
+Episodes are collected by a random or scripted policy across a process pool,
+n-step rewards are computed in one vectorized pass, and the replay is filled
+by bulk merges of complete episodes. The processed dataset is cached on disk,
+keyed by the environment arguments, policy and n-step config, so later runs
+with the same setting skip collection.
+"""
+import os
+import time
+import json
+import hashlib
+import importlib
+from multiprocessing import Pool
+import numpy as np
+
+from utility.display import pwc
+from env.gym_env import create_gym_env
+from algo.off_policy.replay.utils import init_buffer, store_state, compute_n_step
+
+
+# env_args that do not affect collected transitions
+_RUNTIME_ARGS = ('n_envs', 'n_workers', 'backend', 'double_buffered', 'log_video', 'video_path')
+
+def _get_policy(policy, env):
+    """ Return a function mapping a state to an action,
+    policy is either 'random' or the import path of a function fn(env, state), e.g., 'package.module.fn' """
+    if policy == 'random':
+        return lambda state: env.random_action()
+    module, fn = policy.rsplit('.', 1)
+    fn = getattr(importlib.import_module(module), fn)
+
+    return lambda state: fn(env, state)
+
+def _collect(env_args, n_transitions, seed, policy):
+    """ Run complete episodes until at least n_transitions transitions are collected,
+    return one-step (state, action, reward, done) with raw states """
+    # off-policy replays hold raw states, see OffPolicyOperation._prepare_data
+    env = create_gym_env(dict(env_args, n_envs=1, n_workers=1, seed=seed, log_video=False, normalize_obs=False))
+    # forked workers share the random states of their parent
+    env.action_space.seed(seed)
+    np.random.seed(seed)
+    policy = _get_policy(policy, env)
+    states, actions, rewards, dones = [], [], [], []
+    while len(states) < n_transitions:
+        state = env.reset()
+        done = False
+        while not done:
+            action = policy(state)
+            next_state, reward, done, _ = env.step(np.asarray(action))
+            states.append(state)
+            actions.append(action)
+            rewards.append(reward)
+            dones.append(done)
+            state = next_state
+
+    # stacked frames are kept in uint8 until they are stored by prefill
+    state_dtype = np.uint8 if env.state_dtype == np.uint8 else np.float32
+    return (np.asarray(states, dtype=state_dtype), np.asarray(actions),
+            np.asarray(rewards, dtype=np.float32), np.asarray(dones, dtype=bool))
+
+def cache_path(cache_dir, env_args, policy, n_steps, gamma):
+    """ Datasets are keyed by a hash of all env_args except those only deciding 
+    how environments are run, e.g., frame_size, grayscale and frame_stack change the cached states """
+    key = {k: v for k, v in env_args.items() if k not in _RUNTIME_ARGS}
+    key = hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:8]
+    name = f'{env_args["name"]}-seed{env_args.get("seed", 42)}-{policy}-n{n_steps}-gamma{gamma}-{key}'
+
+    return os.path.join(cache_dir, f'{name}.npz'.replace(':', '_'))
+
+def collect_dataset(env_args, n_transitions, n_steps, gamma, n_workers=4, policy='random', cache_dir=None):
+    """ Return a dict of n-step transitions of complete episodes with at least n_transitions transitions,
+    which is loaded from cache_dir if a large enough dataset has been cached """
+    path = cache_path(cache_dir, env_args, policy, n_steps, gamma) if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as f:
+            dataset = dict(f)
+        if len(dataset['reward']) >= n_transitions:
+            pwc(f'Prefill: load {len(dataset["reward"])} transitions from {path}', 'cyan')
+            return dataset
+
+    start = time.time()
+    seed = env_args.get('seed', 42)
+    n_per_worker = -(-n_transitions // n_workers)
+    with Pool(n_workers) as pool:
+        results = pool.starmap(_collect, [(env_args, n_per_worker, seed + 1000 * i, policy)
+                                          for i in range(n_workers)])
+    # each worker returns complete episodes, so their concatenation does not mix episodes
+    state, action, reward, done = [np.concatenate(x) for x in zip(*results)]
+    reward, done, steps = compute_n_step(reward, done, n_steps, gamma)
+    dataset = dict(state=state, action=action, reward=reward, done=done, steps=steps)
+    pwc(f'Prefill: collect {len(reward)} transitions with {n_workers} workers in {time.time() - start:.1f}s', 'cyan')
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, **dataset)
+
+    return dataset
+
+def prefill(replay, env_args, state_shape, action_dim, args, moments=None):
+    """ Fill replay until it is good to learn
+
+    Arguments:
+        replay -- a Replay whose n_steps and gamma define the n-step config
+        args {dict} -- n_workers: number of collecting processes
+                       policy: 'random' or the import path of a scripted policy fn(env, state)
+                       cache_dir: directory of cached datasets, nothing is cached if None
+
+    Keyword Arguments:
+        moments -- RunningMoments of the agent if it normalizes states, see OffPolicyOperation._prepare_data.
+                   Replays hold raw states, which update moments as if the agent added them (default: {None})
+    """
+    n_transitions = replay.min_size - len(replay)
+    if n_transitions <= 0:
+        return
+    dataset = collect_dataset(env_args, n_transitions, replay.n_steps, replay.gamma,
+                              n_workers=args.get('n_workers', 4),
+                              policy=args.get('policy', 'random'),
+                              cache_dir=args.get('cache_dir'))
+    # merges end at episode ends so that no n-step next state points beyond the merged transitions,
+    # an episode ends at a transition whose n-step window is done after one step
+    episode_ends = np.nonzero(np.reshape(dataset['done'] & (dataset['steps'] == 1), -1))[0] + 1
+    n = len(dataset['reward'])
+    buffer = {}
+    init_buffer(buffer, n, state_shape, action_dim, True, frame_stack=replay.frame_stack)
+    for k, v in dataset.items():
+        if k == 'state':
+            if moments is not None:
+                moments.update(v)
+            store_state(buffer, slice(None), v)
+            continue
+        if k == 'action':
+            # discrete actions are broadcast to each row as in add_buffer
+            v = np.reshape(v, (n, -1)) if buffer[k].ndim > 1 else np.reshape(v, n)
+        buffer[k][:] = v
+    buffer['priority'][:] = getattr(replay, 'top_priority', 1)
+
+    start = 0
+    chunk_size = max(1, replay.capacity // 10)
+    while not replay.good_to_learn and start < n:
+        # the largest chunk of complete episodes no longer than chunk_size, or the next episode otherwise
+        ends = episode_ends[(episode_ends > start) & (episode_ends - start <= chunk_size)]
+        end = ends[-1] if len(ends) else episode_ends[episode_ends > start][0]
+        replay.merge({k: v[start:end] for k, v in buffer.items()}, end - start)
+        start = end
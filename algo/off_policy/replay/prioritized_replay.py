@@ -25,7 +25,8 @@ class PrioritizedReplay(Replay):
 
         self.sample_i = 0   # count how many times self.sample is called
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, self.n_steps == 1)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, self.n_steps == 1, 
+                    frame_stack=self.frame_stack)
 
         # Code for single agent
         if self.n_steps > 1:
@@ -33,13 +34,15 @@ class PrioritizedReplay(Replay):
             self.tb_idx = 0
             self.tb_full = False
             self.tb = {}
-            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, True)
+            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, True, frame_stack=self.frame_stack)
 
     @override(Replay)
     def sample(self):
         assert_colorize(self.good_to_learn, 'There are not sufficient transitions to start learning --- '
                                             f'transitions in buffer: {len(self)}\t'
                                             f'minimum required size: {self.min_size}')
+        if self.rate_limiter:
+            self.rate_limiter.await_sample(self.batch_size)
         with self.locker:        
             samples = self._sample()
             self.sample_i += 1
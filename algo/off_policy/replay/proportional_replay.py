@@ -16,13 +16,7 @@ class ProportionalPrioritizedReplay(PrioritizedReplay):
     @override(PrioritizedReplay)
     def _sample(self):
         total_priorities = self.data_structure.total_priorities
-        
-        segment = total_priorities / self.batch_size
-
-        priorities, indexes = list(zip(*[self.data_structure.find(np.random.uniform(i * segment, (i+1) * segment))
-                                        for i in range(self.batch_size)]))
-
-        priorities = np.array(priorities)
+        priorities, indexes = self._sample_indexes(self.batch_size)
         probabilities = priorities / total_priorities
 
         # compute importance sampling ratios
@@ -30,3 +24,12 @@ class ProportionalPrioritizedReplay(PrioritizedReplay):
         samples = self._get_samples(indexes)
         
         return IS_ratios, indexes, samples
+
+    def _sample_indexes(self, batch_size):
+        """ Stratified sampling proportional to priorities """
+        segment = self.data_structure.total_priorities / batch_size
+
+        priorities, indexes = list(zip(*[self.data_structure.find(np.random.uniform(i * segment, (i+1) * segment))
+                                        for i in range(batch_size)]))
+
+        return np.array(priorities), indexes
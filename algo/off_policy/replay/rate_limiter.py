@@ -0,0 +1,85 @@
+import time
+import threading
+
+from utility.debug_tools import assert_colorize
+
+
+class RateLimiter:
+    """ Interface """
+    def __init__(self, samples_per_insert, min_size, tolerance):
+        """ Keep the number of sampled transitions close to samples_per_insert times
+        the number of inserted transitions by blocking whichever side is ahead.
+
+        Let diff = samples_per_insert * inserts - samples, sampling is allowed
+        if diff does not drop below offset - tolerance after sampling, and inserting is allowed
+        if diff does not exceed offset + tolerance after inserting, where offset = samples_per_insert * min_size
+        accounts for the transitions inserted before learning starts
+
+        Arguments:
+            samples_per_insert {float} -- target ratio between sampled and inserted transitions
+            min_size {int} -- number of transitions required before sampling
+            tolerance {float} -- number of transitions sampling is allowed to be ahead or behind of the target
+        """
+        assert_colorize(samples_per_insert > 0, f'samples_per_insert should be positive, but get {samples_per_insert}')
+        self.samples_per_insert = samples_per_insert
+        self.min_size = min_size
+        offset = samples_per_insert * min_size
+        self.min_diff = offset - tolerance
+        self.max_diff = offset + tolerance
+
+        self.n_inserts = 0
+        self.n_samples = 0
+        self.sample_size = 1        # size of the last sample request
+        self.insert_blocked_time = 0
+        self.sample_blocked_time = 0
+        self.cond = threading.Condition()
+
+    @classmethod
+    def from_args(cls, args):
+        """ Return None if samples_per_insert is not specified """
+        samples_per_insert = args.get('samples_per_insert')
+        if not samples_per_insert:
+            return None
+        samples_per_insert = float(samples_per_insert)
+        tolerance = float(args.get('samples_per_insert_tolerance', samples_per_insert * args['batch_size']))
+
+        return cls(samples_per_insert, int(float(args['min_size'])), tolerance)
+
+    @property
+    def diff(self):
+        return self.samples_per_insert * self.n_inserts - self.n_samples
+
+    def can_insert(self, n):
+        return self.diff + self.samples_per_insert * n <= self.max_diff
+
+    def can_sample(self, n):
+        return self.n_inserts >= self.min_size and self.diff - n >= self.min_diff
+
+    def await_insert(self, n):
+        """ Block until n transitions can be inserted, then count them """
+        with self.cond:
+            # an insert larger than the band is let through once sampling is blocked,
+            # otherwise both sides would wait forever
+            start = time.time()
+            while not self.can_insert(n) and self.can_sample(self.sample_size):
+                self.cond.wait(1)
+            self.insert_blocked_time += time.time() - start
+            self.n_inserts += n
+            self.cond.notify_all()
+
+    def await_sample(self, n):
+        """ Block until n transitions can be sampled, then count them """
+        with self.cond:
+            self.sample_size = n
+            start = time.time()
+            while not self.can_sample(n):
+                self.cond.wait(1)
+            self.sample_blocked_time += time.time() - start
+            self.n_samples += n
+            self.cond.notify_all()
+
+    def get_stats(self):
+        n_inserts = max(1, self.n_inserts - self.min_size)
+        return dict(SamplesPerInsert=self.n_samples / n_inserts,
+                    InsertBlockedTime=self.insert_blocked_time,
+                    SampleBlockedTime=self.sample_blocked_time)
@@ -0,0 +1,247 @@
+"""
+Replay whose memory lives in shared memory segments, for single-node Ape-X.
+The learner creates the segments and hands out a picklable layout.
+Workers attach to the segments with SharedMemoryWriter, reserve a slot range
+by advancing a cursor shared by all writers, and copy transitions in place.
+They then commit the slots together with their priorities, which is the only
+data passed to the learner.
+Each slot has a sequence number, which is odd while a writer is overwriting the slot
+and turns even when the slot is committed. Sampled transitions that read an odd slot
+may mix two transitions, they are replaced and not sampled again until committed.
+"""
+import os
+import fcntl
+import tempfile
+import numpy as np
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    raise ImportError('SharedMemoryReplay requires multiprocessing.shared_memory from Python 3.8+, '
+                      'set buffer.shared_memory to False on older Pythons')
+
+from utility.decorators import override
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+def _create(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array[...] = 0
+
+    return shm, array
+
+def _attach(name, shape, dtype, owner_pid):
+    shm = shared_memory.SharedMemory(name=name)
+    if os.getpid() != owner_pid:
+        # segments are owned by the replay, prevent the resource tracker
+        # of the attaching process from unlinking them when it exits
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    return shm, array
+
+def _lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f'{name}.lock')
+
+
+class SharedMemoryReplay(ProportionalPrioritizedReplay):
+    """ Interface """
+    def __init__(self, args, state_shape, action_dim, name=None):
+        super().__init__(args, state_shape, action_dim)
+        self.name = name or f'replay_{os.getpid()}'
+        self.segments = []
+        # move memory to shared memory
+        for k, v in self.memory.items():
+            shm, self.memory[k] = _create(f'{self.name}_{k}', v.shape, v.dtype)
+            self.segments.append(shm)
+        # cursor counts transitions ever reserved, slots are cursor % capacity
+        shm, self.cursor = _create(f'{self.name}_cursor', (1, ), np.int64)
+        self.segments.append(shm)
+        shm, self.seqs = _create(f'{self.name}_seqs', (self.capacity, ), np.int64)
+        self.segments.append(shm)
+        open(_lock_path(self.name), 'w').close()
+
+        # commits from different writers may arrive out of order, track the furthest committed cursor
+        self.max_cursor = 0
+
+    @property
+    def layout(self):
+        """ Picklable description of the segments, from which SharedMemoryWriter attaches to them """
+        return dict(name=self.name,
+                    pid=os.getpid(),
+                    capacity=self.capacity,
+                    fields={k: (v.shape, v.dtype.str) for k, v in self.memory.items()})
+
+    def commit(self, start, length, priorities=None):
+        """ Make the transitions written by a SharedMemoryWriter at cursor [start, start + length) available for sampling
+
+        Keyword Arguments:
+            priorities {np.ndarray} -- priorities of the transitions, top_priority is used if None (default: {None})
+        """
+        priorities = np.full(length, self.top_priority) if priorities is None else np.reshape(priorities, -1)
+        assert np.all(priorities[:length])
+        if self.rate_limiter:
+            self.rate_limiter.await_insert(length)
+        with self.locker:
+            for i, priority in enumerate(priorities[:length]):
+                self.data_structure.update(priority, (start + i) % self.capacity)
+            self.seqs[np.arange(start, start + length) % self.capacity] += 1
+            self._advance(start + length)
+
+    def close(self):
+        for shm in self.segments:
+            shm.close()
+            shm.unlink()
+        os.remove(_lock_path(self.name))
+
+    """ Implementation """
+    @override(ProportionalPrioritizedReplay)
+    def _sample(self):
+        while True:
+            IS_ratios, indexes, samples = super()._sample()
+            indexes = np.asarray(indexes)
+            # writers turn sequence numbers odd in their own processes without the lock before copying,
+            # but they only turn even again at commit, which holds self.locker as sampling does.
+            # So slots that are even after reading have not been written during the read
+            torn = self._torn(indexes, samples[4], samples[5])
+            if not np.any(torn):
+                return IS_ratios, indexes, samples
+            # slots being written keep their old priorities until they are committed
+            for idx in indexes[torn]:
+                if self.seqs[idx] % 2 == 1:
+                    self.data_structure.update(0, idx)
+            intact = np.nonzero(~torn)[0]
+            if intact.size:
+                # torn transitions are replaced by intact ones of the same batch
+                pick = np.arange(len(indexes))
+                pick[torn] = np.random.choice(intact, np.sum(torn))
+                return IS_ratios[pick], indexes[pick], tuple(v[pick] for v in samples)
+
+    def _torn(self, indexes, done, steps):
+        """ Whether the slots read for each transition, including those of its next state 
+        and stacked frames, are being written """
+        writing = self.seqs % 2 == 1
+        torn = writing[indexes]
+        for i in range(1, self.frame_stack):
+            torn |= writing[(indexes - i) % self.capacity]
+        next_indexes = (indexes + np.reshape(steps, -1).astype(np.int64)) % self.capacity
+        # next states of done transitions are zeros
+        torn |= writing[next_indexes] & ~np.reshape(done, -1).astype(bool)
+
+        return torn
+
+    @override(ProportionalPrioritizedReplay)
+    def _merge(self, local_buffer, length):
+        # local merges, e.g., from the single-agent temporary buffer, also advance the shared cursor
+        with Cursor(self.name, self.cursor) as cursor:
+            start = cursor.reserve(length)
+        self.mem_idx = start % self.capacity
+        super()._merge(local_buffer, length)
+        self._advance(start + length)
+
+    def _advance(self, end):
+        self.max_cursor = max(self.max_cursor, end)
+        if not self.is_full and self.max_cursor >= self.capacity:
+            self.is_full = True
+        self.mem_idx = self.max_cursor % self.capacity
+
+
+class Cursor:
+    """ Shared cursor guarded by a file lock, so that writers in different processes reserve disjoint slots """
+    def __init__(self, name, cursor):
+        self.lock_path = _lock_path(name)
+        self.cursor = cursor
+
+    def __enter__(self):
+        self.lock_file = open(self.lock_path, 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+    def reserve(self, n):
+        """ Return the start of the reserved range, only call it within the context """
+        start = int(self.cursor[0])
+        self.cursor[0] = start + n
+
+        return start
+
+
+class SharedMemoryWriter:
+    """ Interface """
+    def __init__(self, layout):
+        """ Write transitions to a SharedMemoryReplay living in another process on the same node
+
+        Arguments:
+            layout {dict} -- SharedMemoryReplay.layout
+        """
+        self.name = layout['name']
+        self.capacity = layout['capacity']
+        self.segments = []
+        self.memory = {}
+        for k, (shape, dtype) in layout['fields'].items():
+            shm, self.memory[k] = _attach(f'{self.name}_{k}', shape, dtype, layout['pid'])
+            self.segments.append(shm)
+        shm, self.cursor = _attach(f'{self.name}_cursor', (1, ), np.int64, layout['pid'])
+        self.segments.append(shm)
+        shm, self.seqs = _attach(f'{self.name}_seqs', (self.capacity, ), np.int64, layout['pid'])
+        self.segments.append(shm)
+
+    def write(self, local_buffer, length):
+        """ Copy the first length transitions of local_buffer in place, return the start cursor.
+        Slots are recycled in FIFO order. The replay does not sample them 
+        from the moment they are marked as being written until they are committed """
+        with Cursor(self.name, self.cursor) as cursor:
+            start = cursor.reserve(length)
+        slot = start % self.capacity
+        # mark the slots as being written before overwriting them
+        self.seqs[np.arange(slot, slot + length) % self.capacity] += 1
+        first_part = min(slot + length, self.capacity) - slot
+        for k, v in self.memory.items():
+            v[slot: slot + first_part] = local_buffer[k][:first_part]
+            v[:length - first_part] = local_buffer[k][first_part: length]
+
+        return start
+
+    def close(self):
+        for shm in self.segments:
+            shm.close()
+
+
+if __name__ == '__main__':
+    # bytes and time per push: pickling the local buffer against writing to shared memory
+    # python -m algo.off_policy.replay.shared_memory_replay
+    import time
+    import pickle
+    from algo.off_policy.apex.buffer import LocalBuffer
+
+    state_shape, action_dim = (24, ), 4
+    args = dict(normalize_reward=False, reward_scale=1, to_update_priority=False,
+                alpha=.7, beta0=.4, epsilon=1e-4, beta_steps=5e4, min_size=1e4, capacity=1e5,
+                local_capacity=2000, n_steps=3, tb_capacity=10, gamma=.99, batch_size=256)
+    replay = SharedMemoryReplay(args, state_shape, action_dim)
+    writer = SharedMemoryWriter(replay.layout)
+    local_buffer = LocalBuffer(args, state_shape, action_dim)
+    local_buffer['priority'][:] = 1
+    n = 100
+
+    for length in [100, 1000, 2000]:
+        local_buffer.idx = length
+        start = time.time()
+        for _ in range(n):
+            data = pickle.loads(pickle.dumps(dict(local_buffer)))
+            replay.merge(data, length)
+        pickle_time = (time.time() - start) / n
+        nbytes = len(pickle.dumps(dict(local_buffer)))
+
+        start = time.time()
+        for _ in range(n):
+            cursor = writer.write(local_buffer, length)
+            replay.commit(cursor, length, local_buffer['priority'][:length])
+        shm_time = (time.time() - start) / n
+        print(f'{length} transitions: pickle {nbytes / 2**10:.1f}KB {pickle_time * 1e3:.2f}ms\t'
+              f'shared memory {length * 8 / 2**10:.1f}KB of priorities {shm_time * 1e3:.2f}ms')
+    writer.close()
+    replay.close()
@@ -10,7 +10,7 @@ class UniformReplay(Replay):
     def __init__(self, args, state_shape, action_dim):
         super().__init__(args, state_shape, action_dim)
 
-        init_buffer(self.memory, self.capacity, state_shape, action_dim, False)
+        init_buffer(self.memory, self.capacity, state_shape, action_dim, False, frame_stack=self.frame_stack)
 
         # Code for single agent
         if self.n_steps > 1:
@@ -18,7 +18,7 @@ class UniformReplay(Replay):
             self.tb_idx = 0
             self.tb_full = False
             self.tb = {}
-            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, False)
+            init_buffer(self.tb, self.tb_capacity, state_shape, action_dim, False, frame_stack=self.frame_stack)
 
     @override(Replay)
     def add(self, state, action, reward, done):
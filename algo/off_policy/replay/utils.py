@@ -3,12 +3,20 @@ import numpy as np
 from utility.debug_tools import assert_colorize
 
 
-def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0):
+def init_buffer(buffer, capacity, state_shape, action_dim, has_priority, extra_state=0, frame_stack=1):
+    """ If frame_stack is larger than 1, states are stacks of uint8 frames, see env/gym_env.GymEnvFrameStack.
+    Only the newest frame of each state is stored, together with first_frame, 
+    which tells whether the older frames of the stack repeat it, see stack_frames """
     state_dtype = np.float16
     action_shape = (capacity, ) if action_dim == 1 else (capacity, action_dim)
     action_dtype = np.int8 if action_dim == 1 else np.float16
 
     target_buffer = {'priority': np.zeros((capacity, 1))} if has_priority else {}
+    if frame_stack > 1:
+        *shape, channels = state_shape
+        state_shape = (*shape, channels // frame_stack)
+        state_dtype = np.uint8
+        target_buffer['first_frame'] = np.zeros((capacity + extra_state, 1), dtype=np.bool)
     target_buffer.update({
         'state': np.zeros((capacity + extra_state, *state_shape), dtype=state_dtype),
         'action': np.zeros(action_shape, dtype=action_dtype),
@@ -26,8 +34,34 @@ def reset_buffer(buffer):
 
     buffer.update(target_buffer)
 
+def store_state(buffer, idx, state):
+    """ Store state, or states if idx is a slice, at idx. Only the newest frame is stored if frames are stacked """
+    if 'first_frame' not in buffer:
+        buffer['state'][idx] = state
+        return
+    c = buffer['state'].shape[-1]
+    buffer['state'][idx] = state[..., -c:]
+    # all frames of a stack are the same if it equals itself shifted by a frame
+    same = np.reshape(state[..., :-c] == state[..., c:], (*np.shape(buffer['first_frame'][idx])[:-1], -1))
+    buffer['first_frame'][idx] = np.all(same, axis=-1, keepdims=True)
+
+def stack_frames(buffer, indexes, frame_stack, oldest=0):
+    """ Rebuild stacked states at indexes from frames stored by store_state.
+    Frames are taken backwards from each index until a first frame or the oldest index is met, 
+    which is then repeated for the rest of the stack. 
+    A first frame is not necessarily the start of an episode, 
+    but stacks stopping at it are the same since its own stack repeats it """
+    indexes = np.asarray(indexes)
+    frames = [buffer['state'][indexes]]
+    for _ in range(frame_stack - 1):
+        stop = buffer['first_frame'][indexes, 0] | (indexes == oldest)
+        indexes = np.where(stop, indexes, (indexes - 1) % len(buffer['state']))
+        frames.append(buffer['state'][indexes])
+
+    return np.concatenate(frames[::-1], axis=-1)
+
 def add_buffer(buffer, idx, state, action, reward, done, n_steps, gamma):
-    buffer['state'][idx] = state
+    store_state(buffer, idx, state)
     buffer['action'][idx] = action
     buffer['reward'][idx] = reward
     buffer['done'][idx] = done
@@ -50,3 +84,32 @@ def copy_buffer(dest_buffer, dest_start, dest_end, orig_buffer, orig_start, orig
     
     for key in (dest_buffer if dest_keys else orig_buffer).keys():
         dest_buffer[key][dest_start: dest_end] = orig_buffer[key][orig_start: orig_end]
+
+def compute_n_step(reward, done, n_steps, gamma):
+    """ Vectorized counterpart of the n-step updates in add_buffer, 
+    for consecutive transitions of complete episodes
+    
+    Arguments:
+        reward {np.ndarray} -- one-step rewards of shape [N]
+        done {np.ndarray} -- one-step dones of shape [N]
+
+    Returns:
+        n-step reward, done and steps, each of shape [N, 1]
+    """
+    reward = np.reshape(reward, -1).astype(np.float64)
+    done = np.reshape(done, -1).astype(bool)
+    n = len(reward)
+    n_step_reward = np.copy(reward)
+    n_step_done = np.copy(done)
+    steps = np.ones(n, dtype=np.uint8)
+    # transitions whose n-step windows have not met the end of their episodes
+    alive = ~done
+    for i in range(1, n_steps):
+        alive[n-i:] = False
+        idx = np.nonzero(alive)[0]
+        n_step_reward[idx] += gamma**i * reward[idx + i]
+        n_step_done[idx] = done[idx + i]
+        steps[idx] += 1
+        alive[idx] = ~done[idx + i]
+
+    return n_step_reward[:, None], n_step_done[:, None], steps[:, None]
@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 
 from algo.off_policy.basic_agent import OffPolicyOperation
+from algo.off_policy.np_policy import layer_spec, variable_names
 from algo.off_policy.sac.networks import SoftPolicy, SoftQ, Temperature
 from utility.losses import huber_loss
 from utility.decorators import override
@@ -188,6 +189,30 @@ class Agent(OffPolicyOperation):
             self.alpha_lr: self.alpha_lr_scheduler.value(t)
         }
 
+    @override(OffPolicyOperation)
+    def _variable_groups(self):
+        return dict(
+            policy=self.actor.main_variables,
+            critic=self.critic.main_variables,
+            target=self.actor.target_variables + self.critic.target_variables,
+            temperature=self.temperature.trainable_variables if self.raw_temperature == 'auto' else []
+        )
+
+    @override(OffPolicyOperation)
+    def _numpy_policy_spec(self):
+        policy_args = self.args['Policy']
+        units = policy_args['units']
+        n_noisy = policy_args['n_noisy']
+        var_names = variable_names(self.actor.main_variables)
+
+        layers = [layer_spec(var_names, noisy=i >= len(units) - n_noisy, 
+                            norm=policy_args['norm'], sigma=policy_args['noisy_sigma'])
+                  for i in range(len(units))]
+        mean = layer_spec(var_names)
+        logstd = layer_spec(var_names)
+
+        return dict(type='soft_policy', layers=layers, mean=mean, logstd=logstd)
+
     def _log_loss(self):
         if self.log_tensorboard:
             with tf.name_scope('info'):
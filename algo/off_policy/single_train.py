@@ -2,42 +2,159 @@
 Code for training single agent. The agent trains its networks after every "update_freq" steps.
 """
 import time
+import queue
 import threading
 from collections import deque
 import numpy as np
 import tensorflow as tf
 
 from utility.utils import set_global_seed
-from utility.display import pwc
+from utility.display import pwc, assert_colorize
 from utility.tf_utils import get_sess_config
 from utility.debug_tools import timeit
+from utility.logger import Logger
+from env.gym_env import create_gym_env
 from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.replay.rate_limiter import RateLimiter
+from algo.off_policy.replay.prefill import prefill
+from algo.off_policy.np_policy import NumpyPolicy
 
 
-def evaluate(agent, step, start_episodes, interval, scores, epslens, render):
-    for i in range(1, interval+1):
-        score, epslen = agent.run_trajectory(render=render, evaluation=True)
-        step += epslen
-        scores.append(score)
-        epslens.append(epslen)
-        if i % 4 == 0:
-            agent.rl_log(dict(Timing='Eval', 
-                            Episodes=start_episodes+i,
-                            Steps=step,
-                            Score=score, 
-                            ScoreMean=np.mean(scores),
-                            ScoreStd=np.std(scores),
-                            EpsLenMean=np.mean(epslens),
-                            EpsLenStd=np.std(epslens)))
-    return step
-
-def train(agent, buffer, n_epochs, render):
+class BackgroundEvaluator:
+    """ Interface """
+    def __init__(self, agent, env_args, n_episodes):
+        """ Evaluate snapshots of the policy weights in a background thread while training continues.
+        The thread acts with a NumpyPolicy, so it does not share the tensorflow session with training,
+        and runs n_episodes episodes in parallel on a vectorized environment.
+        Only the latest snapshot waits for evaluation, older ones are replaced.
+        Results go to a log file of their own next to the agent's, 
+        since their columns differ from those of training rows
+
+        Arguments:
+            agent -- the training agent, which exports the policy
+            env_args {dict} -- arguments of the training environment
+            n_episodes {int} -- number of episodes each snapshot is evaluated on
+        """
+        self.agent = agent
+        self.policy = NumpyPolicy(*agent.export_numpy_policy())
+        # states are normalized by the agent's moments as the agent does in its graph
+        self.env = create_gym_env(dict(env_args, n_envs=n_episodes, n_workers=1, log_video=False, normalize_obs=False))
+        self.snapshots = queue.Queue(maxsize=1)     # (step, weights)
+        self.results = queue.Queue()                # stats of evaluated snapshots
+        self.n_replaced = 0
+        self.logger = (Logger(agent.logger.log_dir, f'{agent.model_name}-eval') 
+                       if hasattr(agent, 'logger') else None)
+
+        self.evaluating_thread = threading.Thread(target=self._evaluating_loop, daemon=True)
+        self.evaluating_thread.start()
+
+    def submit(self, step):
+        """ Take a snapshot of the policy weights at step """
+        weights = self.agent.get_weights(['policy'])['policy']
+        try:
+            self.snapshots.get_nowait()
+            self.n_replaced += 1
+        except queue.Empty:
+            pass
+        self.snapshots.put((step, weights))
+
+    def log_results(self):
+        """ Log results finished since the last call. 
+        Logging stays in the training thread as the logger is not thread-safe """
+        while not self.results.empty():
+            results = self.results.get()
+            if self.logger:
+                for k, v in results.items():
+                    self.logger.log_tabular(k, v)
+                self.logger.dump_tabular(print_terminal_info=True)
+
+    """ Implementation """
+    def _evaluating_loop(self):
+        env = self.env
+        while True:
+            step, weights = self.snapshots.get()
+            start = time.time()
+            self.policy.set_flat(weights)
+            state = env.reset()
+            dones = np.zeros(env.n_envs, dtype=bool)
+            # finished environments keep stepping until all are done, EnvStats stops recording their scores
+            while not np.all(dones):
+                if self.agent.obs_moments is not None:
+                    state = self.agent.obs_moments.normalize(state)
+                action = self.policy.act(state, deterministic=True)
+                for _ in range(self.agent.max_action_repetitions):
+                    state, _, done, _ = env.step(action)
+                    dones = np.logical_or(dones, np.reshape(done, -1))
+                    if np.all(dones):
+                        break
+
+            scores, epslens = np.reshape(env.get_score(), -1), np.reshape(env.get_epslen(), -1)
+            self.results.put(dict(Timing='Eval', 
+                                  Steps=step,
+                                  ScoreMean=np.mean(scores),
+                                  ScoreStd=np.std(scores),
+                                  EpsLenMean=np.mean(epslens),
+                                  EpsLenStd=np.std(epslens),
+                                  EvalTime=time.time() - start,
+                                  ReplacedSnapshots=self.n_replaced))
+
+def log_train(agent, episode_i, train_step, score, scores, epslens, rate_limiter=None, update_limiter=None):
+    score_mean = np.mean(scores)
+    score_std = np.std(scores)
+    epslen_mean = np.mean(epslens)
+    epslen_std = np.std(epslens)
+
+    if hasattr(agent, 'stats'):
+        agent.record_stats(score=score, score_mean=score_mean, score_std=score_std,
+                            epslen_mean=epslen_mean, epslen_std=epslen_std,
+                            steps=episode_i)
+    
+    if hasattr(agent, 'logger'):
+        log_info = dict(Timing='Train', 
+                        Episodes=episode_i,
+                        Steps=train_step,
+                        Score=score, 
+                        ScoreMean=score_mean,
+                        ScoreStd=score_std,
+                        EpsLenMean=epslen_mean,
+                        EpsLenStd=epslen_std)
+        if rate_limiter:
+            log_info.update(rate_limiter.get_stats())
+        if update_limiter:
+            log_info.update(dict(UpdateToData=update_limiter.n_samples / max(1, update_limiter.n_inserts),
+                                 CollectorBlockedTime=update_limiter.insert_blocked_time,
+                                 LearnerBlockedTime=update_limiter.sample_blocked_time))
+        agent.rl_log(log_info)
+
+def get_update_limiter(update_to_data_ratio, tolerance):
+    """ Keep the number of updates close to update_to_data_ratio times the number of environment steps.
+    Environment steps are counted as inserts and updates as samples, 
+    so the collector waits if it gets more than tolerance updates ahead of the learner and vice versa """
+    return RateLimiter(float(update_to_data_ratio), 0, float(tolerance))
+
+def background_learning(agent, update_limiter=None):
+    while True:
+        if update_limiter:
+            update_limiter.await_sample(1)
+        agent.learn()
+
+def train(agent, buffer, n_epochs, evaluator, eval_period, background=False, update_limiter=None):
+    """ If background is True, networks are trained by a background thread, 
+    whose pace is controlled by update_limiter and the rate limiter of the replay if there is any.
+    The calling thread collects data in the meantime.
+    A snapshot of the policy is submitted to evaluator every eval_period environment steps """
+    limiter = None      # update_limiter starts counting once training starts
+
     def collection_fn(state, action, reward, done):
         buffer.add_data(state, action, reward, done)
+        if limiter:
+            limiter.await_insert(1)
 
     def train_fn(state, action, reward, done):
         agent.add_data(state, action, reward, done)
-        if agent.good_to_learn:
+        if limiter:
+            limiter.await_insert(1)
+        if not background and agent.good_to_learn:
             agent.learn()
 
     def collect_data(agent, buffer, random_action=False):
@@ -45,7 +162,7 @@ def train(agent, buffer, n_epochs, render):
             buffer.reset()
             score, epslen = agent.run_trajectory(fn=collection_fn, random_action=random_action)
             buffer['priority'][:] = agent.buffer.top_priority
-            agent.merge(buffer, buffer.idx)
+            agent.merge_buffer(buffer, buffer.idx)
         else:
             score, epslen = agent.run_trajectory(fn=train_fn, random_action=random_action)
 
@@ -55,21 +172,23 @@ def train(agent, buffer, n_epochs, render):
     train_step = 0
     scores = deque(maxlen=interval)
     epslens = deque(maxlen=interval)
-    eval_interval = 40
-    eval_step = 0
-    eval_scores = deque(maxlen=eval_interval)
-    eval_epslens = deque(maxlen=eval_interval)
+    next_eval_step = eval_period
 
     pwc(f'Initialize replay buffer')
     while not agent.good_to_learn:
         collect_data(agent, buffer, random_action=True)
     
     pwc(f'Training starts')
+    if background:
+        limiter = update_limiter
+        learning_thread = threading.Thread(target=background_learning, args=(agent, limiter), daemon=True)
+        learning_thread.start()
+    rate_limiter = getattr(agent.buffer, 'rate_limiter', None)
     for episode_i in range(1, n_epochs + 1):
         score, epslen = collect_data(agent, buffer)
         train_step += epslen
 
-        if buffer:
+        if buffer and not background:
             for _ in range(epslen):
                 agent.learn()
 
@@ -77,29 +196,89 @@ def train(agent, buffer, n_epochs, render):
         epslens.append(epslen)
 
         if episode_i % 4 == 0:
-            score_mean = np.mean(scores)
-            score_std = np.std(scores)
-            epslen_mean = np.mean(epslens)
-            epslen_std = np.std(epslens)
-
-            if hasattr(agent, 'stats'):
-                agent.record_stats(score=score, score_mean=score_mean, score_std=score_std,
-                                    epslen_mean=epslen_mean, epslen_std=epslen_std,
-                                    steps=episode_i)
-            
-            if hasattr(agent, 'logger'):
-                agent.rl_log(dict(Timing='Train', 
-                                Episodes=episode_i,
-                                Steps=train_step,
-                                Score=score, 
-                                ScoreMean=score_mean,
-                                ScoreStd=score_std,
-                                EpsLenMean=epslen_mean,
-                                EpsLenStd=epslen_std))
-
-        if episode_i % eval_interval == 0:
-            eval_step = evaluate(agent, eval_step, episode_i - eval_interval, 
-                                    eval_interval, eval_scores, eval_epslens, render)
+            log_train(agent, episode_i, train_step, score, scores, epslens, rate_limiter, limiter)
+
+        if train_step >= next_eval_step:
+            evaluator.submit(train_step)
+            next_eval_step = train_step + eval_period
+        evaluator.log_results()
+
+def train_vec(agent, buffers, n_epochs, evaluator, eval_period, updates_per_step, background=False, update_limiter=None):
+    """ Same as train, except that agent.train_env steps several environments with batched actions.
+    Each environment fills its own buffer in buffers, which is merged into the replay when its episode ends
+    so that transitions of an episode stay contiguous in the replay.
+    updates_per_step updates are run after each vector step if background is False """
+    env = agent.train_env
+    limiter = None      # update_limiter starts counting once training starts
+
+    def merge(buffer):
+        if agent.buffer_type == 'proportional':
+            buffer['priority'][:buffer.idx] = agent.buffer.top_priority
+        agent.merge_buffer(buffer, buffer.idx)
+        buffer.reset()
+
+    def step(state, random_action=False):
+        """ Step all environments and merge finished episodes into the replay,
+        return the next state together with the scores and lengths of finished episodes """
+        action = env.random_action() if random_action else agent.act(state)
+        for _ in range(agent.max_action_repetitions):
+            next_state, reward, done, _ = env.step(action)
+            for buffer, s, a, r, d in zip(buffers, state, action, reward, done):
+                buffer.add_data(s, a, r, d)
+            if limiter:
+                limiter.await_insert(env.n_envs)
+            state = next_state
+            if np.any(done):
+                # finished environments should be reset before being stepped again
+                break
+
+        done_envs = np.nonzero(np.reshape(done, -1))[0]
+        if done_envs.size == 0:
+            return state, [], []
+        scores, epslens = env.get_score()[done_envs], env.get_epslen()[done_envs]
+        for i in done_envs:
+            merge(buffers[i])
+        state[done_envs] = env.reset(done_envs)
+
+        return state, scores, epslens
+
+    interval = 100
+    train_step = 0
+    scores = deque(maxlen=interval)
+    epslens = deque(maxlen=interval)
+    next_eval_step = eval_period
+
+    pwc(f'Initialize replay buffer')
+    state = env.reset()
+    while not agent.good_to_learn:
+        state, _, _ = step(state, random_action=True)
+
+    pwc(f'Training starts')
+    if background:
+        limiter = update_limiter
+        learning_thread = threading.Thread(target=background_learning, args=(agent, limiter), daemon=True)
+        learning_thread.start()
+    rate_limiter = getattr(agent.buffer, 'rate_limiter', None)
+    episode_i = 0
+    while episode_i < n_epochs:
+        state, done_scores, done_epslens = step(state)
+        if not background:
+            for _ in range(updates_per_step):
+                agent.learn()
+
+        for score, epslen in zip(done_scores, done_epslens):
+            episode_i += 1
+            train_step += epslen
+            scores.append(score)
+            epslens.append(epslen)
+
+            if episode_i % 4 == 0:
+                log_train(agent, episode_i, train_step, score, scores, epslens, rate_limiter, limiter)
+
+        if train_step >= next_eval_step:
+            evaluator.submit(train_step)
+            next_eval_step = train_step + eval_period
+        evaluator.log_results()
 
 def main(env_args, agent_args, buffer_args, render=False):
     # print terminal information if main is running in the main thread
@@ -115,6 +294,17 @@ def main(env_args, agent_args, buffer_args, render=False):
     else:
         raise NotImplementedError
 
+    n_envs = env_args.get('n_envs', 1)
+    if n_envs > 1:
+        # environments acting in one batch draw their own noise, 
+        # except for IQN, whose rows are quantile samples rather than states
+        if algorithm == 'td3':
+            agent_args['actor']['per_sample_noise'] = True
+        elif algorithm == 'sac':
+            agent_args['Policy']['per_sample_noise'] = True
+        elif agent_args['Qnets']['algo'] != 'iqn':
+            agent_args['Qnets']['per_sample_noise'] = True
+
     agent_args['env_stats']['times'] = 1
     sess_config = get_sess_config(1)
 
@@ -123,14 +313,42 @@ def main(env_args, agent_args, buffer_args, render=False):
                   log_tensorboard=True, log_stats=True, 
                   save=False, device='/GPU: 0')
 
-    if agent_args['episodic_learning']:
+    if n_envs > 1:
+        # one local buffer per environment, each holds an episode
+        buffer_args['local_capacity'] = agent.max_path_length
+        buffer = [LocalBuffer(buffer_args, agent.state_shape, agent.action_dim) for _ in range(n_envs)]
+    elif agent_args.get('episodic_learning', False):
         # local buffer, only used to store a single episode of transitions
         buffer_args['local_capacity'] = env_args['max_episode_steps']
         buffer = LocalBuffer(buffer_args, agent.state_shape, agent.action_dim)
     else:
         buffer = None
 
+    prefill_args = buffer_args.get('prefill')
+    if prefill_args and prefill_args.get('n_workers'):
+        # fill the replay in parallel, collect_data only tops it up afterwards if needed
+        prefill(agent.buffer, env_args, agent.state_shape, agent.action_dim, prefill_args, 
+                moments=agent.obs_moments)
+
     model = agent_args['model_name']
     pwc(f'Model {model} starts training')
     
-    train(agent, buffer, agent_args['n_epochs'], render)
+    # collector and learner threads are decoupled and coordinated by update_to_data_ratio if it is specified
+    update_to_data_ratio = agent_args.get('update_to_data_ratio')
+    update_limiter = (get_update_limiter(update_to_data_ratio, agent_args.get('update_to_data_tolerance', 100))
+                      if update_to_data_ratio else None)
+    background = agent_args.get('background_learning', False) or update_limiter is not None
+    # inserts and samples would wait for each other if they were in the same thread
+    assert_colorize(not getattr(agent.buffer, 'rate_limiter', None) or background, 
+                    'samples_per_insert requires background_learning in single_train')
+
+    # evaluation runs in the background and does not render
+    evaluator = BackgroundEvaluator(agent, env_args, agent_args.get('eval_episodes', 10))
+    eval_period = agent_args.get('eval_period', 10000)
+
+    if n_envs > 1:
+        train_vec(agent, buffer, agent_args['n_epochs'], evaluator, eval_period,
+                  agent_args.get('updates_per_step', 1), background=background, update_limiter=update_limiter)
+    else:
+        train(agent, buffer, agent_args['n_epochs'], evaluator, eval_period, 
+              background=background, update_limiter=update_limiter)
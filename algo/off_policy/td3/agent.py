@@ -1,6 +1,7 @@
 import tensorflow as tf
 
 from algo.off_policy.basic_agent import OffPolicyOperation
+from algo.off_policy.np_policy import layer_spec, variable_names
 from algo.off_policy.td3.networks import Actor, Critic, DoubleCritic
 from utility.losses import huber_loss
 from utility.tf_utils import n_step_target, stats_summary
@@ -155,6 +156,26 @@ class Agent(OffPolicyOperation):
     def _update_target_net(self):
         self.sess.run(self.update_target_op)
 
+    def _variable_groups(self):
+        return dict(
+            policy=self.actor.trainable_variables,
+            critic=self.critic.trainable_variables,
+            target=self.target_variables
+        )
+
+    def _numpy_policy_spec(self):
+        actor_args = self.args['actor']
+        units = actor_args['units']
+        n_noisy = actor_args['n_noisy']
+        var_names = variable_names(self.actor.trainable_variables)
+
+        layers = [layer_spec(var_names, noisy=i >= len(units) - n_noisy, 
+                            norm=actor_args['norm'], sigma=actor_args['noisy_sigma'])
+                  for i in range(len(units))]
+        out = layer_spec(var_names)
+
+        return dict(type='deterministic_policy', layers=layers, out=out)
+
     def _log_loss(self):
         if self.log_tensorboard:
             with tf.name_scope('info'):
@@ -4,6 +4,7 @@ import ray
 
 from utility.utils import normalize, pwc
 from utility.schedule import PiecewiseSchedule
+from utility.weight_codec import WeightEncoder
 from algo.on_policy.ppo.agent import Agent
 
 
@@ -41,6 +42,10 @@ class Learner(Agent):
         points = [(0, float(args['ac']['value_lr'])),
                   (args['ac']['value_decay_steps'], outside_value)]
         self.value_lr_scheduler = PiecewiseSchedule(points, outside_value=outside_value)
+
+        # weights are encoded against the previous version, which all workers have in synchronous training
+        self.encoder = WeightEncoder.from_args(args.get('weight_codec'))
+        self.encoder.push(self.get_weights())
     
     def apply_gradients(self, timestep, *grads):
         policy_lr = self.policy_lr_scheduler.value(timestep)
@@ -64,11 +69,24 @@ class Learner(Agent):
         if hasattr(self, 'saver') and learn_step % 100 == 0:
             self.save()
 
-        return self.get_weights()
+        base_version = self.encoder.version
+        self.encoder.push(self.get_weights())
+
+        return self.encoder.encode(base_version)
 
     def get_weights(self):
         return self.variables.get_flat()
 
+    def merge_obs_moments(self, moments):
+        """ All-reduce of observation statistics, see env/gym_env.GymEnvNormObs.
+        Merge moments a worker has collected since its last sync, and return the merged moments """
+        self.env_vec.moments.merge(moments)
+        return self.env_vec.moments.get_moments()
+
+    def get_weights_payload(self, version=-1):
+        """ Latest weights encoded against version, a full snapshot is returned by default """
+        return self.encoder.encode(version)
+
     def record_stats(self, score_mean, score_std, epslen_mean, entropy, approx_kl, clip_frac):
         log_info = dict(score_mean=score_mean, score_std=score_std,
                         epslen_mean=epslen_mean, entropy=entropy,
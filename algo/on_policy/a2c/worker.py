@@ -2,6 +2,7 @@ import numpy as np
 import ray
 
 from utility.display import pwc
+from utility.weight_codec import WeightDecoder
 from algo.on_policy.ppo.buffer import PPOBuffer
 from algo.on_policy.ppo.agent import Agent
 
@@ -14,11 +15,15 @@ class Worker(Agent):
                  worker_no,
                  args,
                  env_args,
+                 learner=None,
                  sess_config=None,
                  save=False,
                  device=None):
 
         self.no = worker_no
+        self.learner = learner      # full snapshots are fetched from learner when a delta cannot be applied
+        self.weights_id = None      # id of the weights currently in use
+        self.decoder = WeightDecoder()
 
         super().__init__(name, 
                          args, 
@@ -28,8 +33,8 @@ class Worker(Agent):
                          device=device)
 
     @ray.method(num_return_vals=2)
-    def compute_gradients(self, weights):
-        self._set_weights(weights)
+    def compute_gradients(self, weights_id):
+        self._set_weights(weights_id)
 
         # construct fetches
         fetches = [self.ac.grads, 
@@ -51,9 +56,13 @@ class Worker(Agent):
         
         return grads, loss_info
 
-    def sample_trajectories(self, weights):
+    def sample_trajectories(self, weights_id):
         # function content
-        self._set_weights(weights)
+        self._set_weights(weights_id)
+        if self.normalize_obs:
+            # observation statistics are synced once per epoch
+            moments = self.env_vec.moments
+            moments.set_moments(ray.get(self.learner.merge_obs_moments.remote(moments.pop_delta())))
 
         env_stats = self._sample_data()
         
@@ -70,6 +79,14 @@ class Worker(Agent):
             
 
     """ Implementation """
-    def _set_weights(self, weights):
-        self.variables.set_flat(weights)
+    def _set_weights(self, weights_id):
+        """ weights_id is wrapped in a list so that ray passes the id rather than the weights,
+        which allows us to skip fetching and setting weights we already have """
+        weights_id = weights_id[0]
+        if weights_id != self.weights_id:
+            weights = self.decoder.decode(ray.get(weights_id))
+            if weights is None:
+                weights = self.decoder.decode(ray.get(self.learner.get_weights_payload.remote()))
+            self.variables.set_flat(weights)
+            self.weights_id = weights_id
 
@@ -24,27 +24,28 @@ def main(env_args, agent_args, buffer_args, render=False):
     ray.init(num_cpus=n_workers+1, num_gpus=1)
 
     sess_config = get_sess_config(1)
-    workers = [Worker.remote('Agent', i, agent_args, env_args, sess_config=sess_config, device='/gpu: 0') 
-               for i in range(n_workers)]
-    if render:
-        env_args['log_video'] = True
-    learner = Learner.remote('Agent', agent_args, env_args, log=True, 
+    learner_env_args = dict(env_args, log_video=True) if render else env_args
+    learner = Learner.remote('Agent', agent_args, learner_env_args, log=True, 
                              log_stats=True, sess_config=sess_config, device='/gpu: 0')
+    workers = [Worker.remote('Agent', i, agent_args, env_args, learner=learner, 
+                             sess_config=sess_config, device='/gpu: 0') 
+               for i in range(n_workers)]
 
     max_kl = agent_args['max_kl']
     
-    weights_id = learner.get_weights.remote()
+    weights_id = learner.get_weights_payload.remote()
     
     for epoch_i in range(1, agent_args['n_epochs'] + 1):
         start = time.time()
-        env_stats = [w.sample_trajectories.remote(weights_id) for w in workers]
+        # weights_id is wrapped in a list so that workers can skip weights they already have
+        env_stats = [w.sample_trajectories.remote([weights_id]) for w in workers]
 
         loss_info_list = []
         kl = 0
 
         for i in range(agent_args['n_updates']):
             for j in range(agent_args['n_minibatches']):
-                grads_ids, losses_ids = decompose([w.compute_gradients.remote(weights_id) for w in workers])
+                grads_ids, losses_ids = decompose([w.compute_gradients.remote([weights_id]) for w in workers])
 
                 loss_info = ray.get(list(losses_ids))
                 loss_info_list += loss_info
@@ -71,7 +72,7 @@ def main(env_args, agent_args, buffer_args, render=False):
         ppo_loss, entropy, approx_kl, clip_frac, value_loss = loss_info
 
         env_stats = ray.get(list(env_stats))  # ray cannot use tuple as input
-        scores, epslens = list(zip(*env_stats))
+        scores, epslens, useful_step_fracs = list(zip(*env_stats))
         score_mean = np.mean(scores)
         score_std = np.std(scores)
         epslen_mean = np.mean(epslens)
@@ -90,6 +91,7 @@ def main(env_args, agent_args, buffer_args, render=False):
             'Time': f'{time.time() - start:3.2f}s',
             'ScoreMean': score_mean,
             'ScoreStd': score_std,
+            'UsefulStepFrac': np.mean(useful_step_fracs),
             'PPOLoss': ppo_loss,
             'Entropy': entropy,
             'ValueLoss': value_loss,
@@ -1,14 +1,15 @@
 import os
+from collections import deque
 import numpy as np
 import tensorflow as tf
 from ray.experimental.tf_utils import TensorFlowVariables
 
-from env.gym_env import create_gym_env
+from env.gym_env import create_gym_env, GymEnvGroups
 from basic_model.model import Model
 from algo.on_policy.ppo.networks import ActorCritic
 from algo.on_policy.ppo.buffer import PPOBuffer
 from utility.tf_utils import stats_summary
-from utility.display import pwc
+from utility.display import pwc, assert_colorize
 from utility.schedule import PiecewiseSchedule
 
 
@@ -39,7 +40,15 @@ class Agent(Model):
 
         # environment info
         self.env_vec = create_gym_env(env_args)
-        self.seq_len = self.env_vec.max_episode_steps
+        # one group of environments steps while actions are computed for the other, see GymEnvGroups
+        self.double_buffered = isinstance(self.env_vec, GymEnvGroups)
+        # finished environments reset themselves, so rollouts are fixed-length windows across episodes
+        self.auto_reset = env_args.get('auto_reset', False)
+        self.seq_len = args['rollout_len'] if self.auto_reset else self.env_vec.max_episode_steps
+        self.steps = None       # generator of environment steps, see _sample_data
+        self.normalize_obs = env_args.get('normalize_obs', False)  # see GymEnvNormObs
+        self.episode_scores = deque(maxlen=self.env_vec.n_envs)
+        self.episode_epslens = deque(maxlen=self.env_vec.n_envs)
 
         self.buffer = PPOBuffer(env_args['n_workers'] * env_args['n_envs'], 
                                 self.seq_len, 
@@ -69,6 +78,9 @@ class Agent(Model):
             # don't distinguish lstm at training from that at running
             # since training is done after running
             self.last_lstm_state = None
+        assert_colorize(not (self.use_lstm and (self.double_buffered or self.auto_reset)), 
+                        'Double-buffered sampling and auto_reset do not support lstm, '
+                        'whose state is shared by all environments and is not reset at episode ends')
 
         with self.graph.as_default():
             self.variables = TensorFlowVariables([self.ac.policy_loss, self.ac.V_loss], self.sess)
@@ -170,35 +182,62 @@ class Agent(Model):
         return env_phs
 
     def _sample_data(self):
+        """ Return scores and lengths of episodes together with the fraction of useful steps.
+        Without auto_reset, all environments start new episodes, which last until all are done or seq_len steps, 
+        and the stats of these episodes are returned. Steps of environments already done are wasted.
+        With auto_reset, rollout windows of seq_len steps continue where the previous one stopped, 
+        and the stats of the latest n_envs episodes are returned """
         self.buffer.reset()
-        state = self.env_vec.reset()
+        if not self.auto_reset or self.steps is None:
+            self.steps = self.env_vec.pipelined_steps(self.act) if self.double_buffered else self._synchronous_steps()
         
-        if self.use_lstm:
-            self.last_lstm_state = self.sess.run(self.ac.initial_state, feed_dict={self.env_phs['state']: state})
-        
-        for step in range(self.seq_len):
-            action, value, logpi = self.act(state)
-            next_state, reward, done, _ = self.env_vec.step(action)
-
+        for _ in range(self.seq_len):
+            state, (action, value, logpi), next_state, reward, done, mask, info = next(self.steps)
             self.buffer.add(state=state, 
                             action=action, 
                             reward=reward, 
                             value=value,
                             old_logpi=logpi, 
                             nonterminal=1-done,
-                            mask=self.env_vec.get_mask())
-
-            state = next_state
+                            mask=mask)
 
-            if np.all(done):
+            if self.auto_reset:
+                for i in np.nonzero(np.reshape(done, -1))[0]:
+                    self.episode_scores.append(info[i]['score'])
+                    self.episode_epslens.append(info[i]['epslen'])
+            elif np.all(done):
                 break
+
+        if not self.auto_reset:
+            # wait for the steps in flight
+            self.steps.close()
+        useful_step_frac = np.mean(self.buffer['mask'][:, :self.buffer.idx])
         
         # add one more ad hoc value so that we can take values[1:] as next state values
-        last_value = self.sess.run(self.ac.V, feed_dict={self.env_phs['state']: state})
+        last_value = self.sess.run(self.ac.V, feed_dict={self.env_phs['state']: next_state})
 
         self.buffer.finish(last_value, self.args['advantage_type'], self.gamma, self.gae_discount)
         
-        return self.env_vec.get_score(), self.env_vec.get_epslen()
+        if not self.auto_reset:
+            return self.env_vec.get_score(), self.env_vec.get_epslen(), useful_step_frac
+        elif self.episode_scores:
+            return list(self.episode_scores), list(self.episode_epslens), useful_step_frac
+        else:
+            # no episode has finished yet, return stats of the ongoing ones
+            return self.env_vec.get_score(), self.env_vec.get_epslen(), useful_step_frac
+
+    def _synchronous_steps(self):
+        """ Same as GymEnvGroups.pipelined_steps, except that acting and stepping take turns """
+        state = self.env_vec.reset()
+        
+        if self.use_lstm:
+            self.last_lstm_state = self.sess.run(self.ac.initial_state, feed_dict={self.env_phs['state']: state})
+        
+        while True:
+            action, value, logpi = self.act(state)
+            next_state, reward, done, info = self.env_vec.step(action)
+            yield state, (action, value, logpi), next_state, reward, done, self.env_vec.get_mask(), info
+            state = next_state
 
     def _optimize(self, timestep=None):
         # construct policy fetches
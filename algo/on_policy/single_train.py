@@ -17,13 +17,14 @@ def train(agent, agent_args, test_agent):
         ppo_loss, entropy, approx_kl, p_clip_frac, v_clip_frac, value_loss = loss_info
 
         # logging
-        scores, eps_lens = env_stats
+        scores, eps_lens, useful_step_frac = env_stats
         agent.store(
             score_mean=np.mean(scores),
             score_std=np.std(scores),
             score_max=np.max(scores),
             score_min=np.min(scores),
             epslen_mean=np.mean(eps_lens),
+            useful_step_frac=useful_step_frac,
             ppo_loss=np.mean(ppo_loss),
             value_loss=np.mean(value_loss),
             entropy=np.mean(entropy),
@@ -41,7 +42,7 @@ def train(agent, agent_args, test_agent):
 def main(env_args, agent_args, buffer_args, render=False):
     utils.set_global_seed()
 
-    if env_args.get('n_workers', 0) > 1:
+    if env_args.get('n_workers', 0) > 1 and env_args.get('backend', 'ray') == 'ray':
         ray.init()
     agent_name = 'Agent'
     agent = Agent(agent_name, agent_args, env_args, 
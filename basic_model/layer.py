@@ -259,16 +259,28 @@ class Layer():
         
     def noisy(self, x, units, kernel_initializer=tc.layers.xavier_initializer(), 
                name=None, sigma=.4, factorized=True, return_noise=False):
-        """ noisy layer using factorized Gaussian noise """
+        """ noisy layer using factorized Gaussian noise,
+        noise is drawn for each sample instead of each batch if args['per_sample_noise'] is True,
+        which keeps exploration independent across environments acting in one batch """
         name = self.get_name(name, 'noisy')
-        
+        per_sample = self.args.get('per_sample_noise', False)
+        assert_colorize(factorized or not per_sample, 'per_sample_noise requires factorized noise')
+
         y = self.dense(x, units, kernel_initializer=kernel_initializer)
-            
+
         with tf.variable_scope(name):
             # params for the noisy layer
             features = x.shape.as_list()[-1]
 
-            if factorized:
+            if per_sample:
+                batch_size = tf.shape(x)[0]
+                w_shape = [features, units]
+                b_shape = [units]
+                epsilon_w_in = tf.random.truncated_normal([batch_size, features], stddev=sigma)
+                epsilon_w_in = tf.math.sign(epsilon_w_in) * tf.math.sqrt(tf.math.abs(epsilon_w_in))
+                epsilon_w_out = tf.random.truncated_normal([batch_size, units], stddev=sigma)
+                epsilon_w_out = tf.math.sign(epsilon_w_out) * tf.math.sqrt(tf.math.abs(epsilon_w_out))
+            elif factorized:
                 w_in_dim = [features, 1]
                 w_out_dim = [1, units]
                 w_shape = [features, units]
@@ -292,7 +304,11 @@ class Layer():
                                         initializer=tf.constant_initializer(sigma / np.sqrt(units)))
             
             # output of the noisy layer
-            o = tf.matmul(x, noisy_w * epsilon_w) + noisy_b * epsilon_b
+            if per_sample:
+                # x @ (noisy_w * epsilon_w_in @ epsilon_w_out) computed row by row without forming epsilon_w
+                o = (tf.matmul(x * epsilon_w_in, noisy_w) + noisy_b) * epsilon_w_out
+            else:
+                o = tf.matmul(x, noisy_w * epsilon_w) + noisy_b * epsilon_b
         if hasattr(self, 'log_tensorboard') and self.log_tensorboard:
             with tf.name_scope(f'{name}_log'):
                 tf_utils.stats_summary('x', x, std=True, hist=True)
@@ -1,4 +1,5 @@
 """ Implementation of single process environment """
+import multiprocessing as mp
 import numpy as np
 import gym
 import ray
@@ -7,7 +8,8 @@ from utility import tf_distributions
 from utility.display import pwc, assert_colorize
 from utility.utils import to_int
 from utility.timer import Timer
-from env.wrappers import TimeLimit, EnvStats
+from utility.run_avg import RunningMoments
+from env.wrappers import TimeLimit, WarpFrame, EnvStats
 
 def action_dist_type(env):
     if isinstance(env.action_space, gym.spaces.Discrete):
@@ -19,6 +21,10 @@ def action_dist_type(env):
 
 
 class EnvBase:
+    """ If args['auto_reset'] is True, environments reset themselves once they are done 
+    and the returned state is the first state of the new episode. The info of a done environment
+    carries the terminal state and the stats of the finished episode as terminal_state, score and epslen.
+    If args['frame_size'] is given, frames are warped to it by WarpFrame, in grayscale unless args['grayscale'] is False """
     @property
     def is_action_discrete(self):
         return self.env.is_action_discrete
@@ -47,6 +53,48 @@ class EnvBase:
     def action_dim(self):
         return self.env.action_dim
 
+    def step_async(self, actions):
+        """ Start stepping with actions, whose results are returned by step_wait. 
+        Environments stepped in the calling process only step in step_wait """
+        self._actions = actions
+
+    def step_wait(self):
+        return self.step(self._actions)
+
+    def packed_step(self, actions):
+        """ Step and pack the results of all environments into two arrays, see GymEnvVec. 
+        states keeps the state dtype, e.g., uint8 frames, and each row is the state 
+        followed by the terminal state if auto_reset is True. 
+        Each row of the float64 stats is [reward, done, mask, score, epslen], 
+        where score and epslen of a done environment are those of the finished episode if auto_reset is True """
+        state, reward, done, info = self.step(actions)
+        n = self.n_envs
+        d = int(np.prod(self.state_shape))
+        if not hasattr(self, '_packed'):
+            self._packed = (np.zeros((n, packed_width(self.state_shape, self.auto_reset)), dtype=self.state_dtype),
+                            np.zeros((n, 5)))
+        states, stats = self._packed
+        states[:, :d] = np.reshape(state, (n, d))
+        stats[:, 0] = np.reshape(reward, n)
+        stats[:, 1] = np.reshape(done, n)
+        stats[:, 2] = np.reshape(self.get_mask(), n)
+        stats[:, 3] = np.reshape(self.get_score(), n)
+        stats[:, 4] = np.reshape(self.get_epslen(), n)
+        if self.auto_reset:
+            info = [info] if n == 1 else info
+            for i in np.nonzero(np.reshape(done, n))[0]:
+                stats[i, 3] = info[i]['score']
+                stats[i, 4] = info[i]['epslen']
+                states[i, d:] = np.reshape(info[i]['terminal_state'], d)
+
+        return states, stats
+
+
+def packed_width(state_shape, auto_reset):
+    """ Width of the states packed by EnvBase.packed_step """
+    d = int(np.prod(state_shape))
+    return d + (d if auto_reset else 0)
+
 
 class GymEnv(EnvBase):
     def __init__(self, args):
@@ -55,11 +103,14 @@ class GymEnv(EnvBase):
         self.max_episode_steps = args.get('max_episode_steps', env.spec.max_episode_steps)
         if self.max_episode_steps != env.spec.max_episode_steps:
             env = TimeLimit(env, self.max_episode_steps)
+        if args.get('frame_size'):
+            env = WarpFrame(env, args['frame_size'], args.get('grayscale', True))
         if 'log_video' in args and args['log_video']:
             pwc(f'video will be logged at {args["video_path"]}', color='cyan')
             env = gym.wrappers.Monitor(env, args['video_path'], force=True)
     
         self.env = env = EnvStats(env)
+        self.auto_reset = args.get('auto_reset', False)
 
     @property
     def n_envs(self):
@@ -76,7 +127,12 @@ class GymEnv(EnvBase):
             action = np.reshape(action, *self.action_shape)
         assert_colorize(action.shape == (self.action_dim, ), 
                         f'Expect action of shape {self.action_dim}, but got shape {action.shape}')
-        return self.env.step(action)
+        state, reward, done, info = self.env.step(action)
+        if self.auto_reset and done:
+            info = dict(info, terminal_state=state, score=self.env.get_score(), epslen=self.env.get_epslen())
+            state = self.env.reset()
+
+        return state, reward, done, info
 
     def render(self):
         return self.env.render()
@@ -94,6 +150,9 @@ class GymEnv(EnvBase):
 
 class GymEnvVecBase(EnvBase):
     def __init__(self, args):
+        """ Environment stats are kept in arrays and updated by vectorized operations instead of EnvStats wrappers.
+        Step outputs are written to two sets of preallocated buffers used in turn, 
+        so the outputs of a step stay valid until the step after the next one """
         self.n_envs = n_envs = args['n_envs']
 
         envs = [gym.make(args['name']) for i in range(n_envs)]
@@ -102,94 +161,604 @@ class GymEnvVecBase(EnvBase):
         self.max_episode_steps = args.get('max_episode_steps', envs[0].spec.max_episode_steps)
         if self.max_episode_steps != envs[0].spec.max_episode_steps:
             envs = [TimeLimit(env, self.max_episode_steps) for env in envs]
-        self.envs = [EnvStats(env) for env in envs]
-        self.env = self.envs[0]
+        if args.get('frame_size'):
+            envs = [WarpFrame(env, args['frame_size'], args.get('grayscale', True)) for env in envs]
+        self.envs = envs
+        # only used to describe the environments, see EnvBase
+        self.env = EnvStats(self.envs[0])
+        self.auto_reset = args.get('auto_reset', False)
+
+        self.score = np.zeros(n_envs)
+        self.epslen = np.zeros(n_envs, dtype=np.int64)
+        self.mask = np.ones((n_envs, 1), dtype=np.float32)
+        self.early_done = np.zeros(n_envs, dtype=bool)
+        self.outputs = [dict(state=np.zeros((n_envs, *self.state_shape), dtype=self.state_dtype),
+                             reward=np.zeros((n_envs, 1)),
+                             done=np.zeros((n_envs, 1), dtype=bool))
+                        for _ in range(2)]
+        self.output_idx = 0
     
     def random_action(self):
         return np.asarray([env.action_space.sample() for env in self.envs])
 
-    def reset(self):
-        return np.asarray([env.reset() for env in self.envs])
-    
+    def reset(self, idxes=None):
+        """ Reset all environments, or only those in idxes, return the states of the reset environments """
+        idxes = np.arange(self.n_envs) if idxes is None else idxes
+        self.score[idxes] = 0
+        self.epslen[idxes] = 0
+        self.mask[idxes] = 1
+        self.early_done[idxes] = False
+
+        return np.asarray([self.envs[i].reset() for i in idxes])
+
     def step(self, actions):
         if actions.shape != self.action_shape:
             actions = np.reshape(actions, (self.n_envs, *self.action_shape))
-        step_imp = lambda envs, actions: list(zip(*[env.step(a) for env, a in zip(envs, actions)]))
-        
-        state, reward, done, info = step_imp(self.envs, actions)
+        outputs = self.outputs[self.output_idx]
+        self.output_idx = 1 - self.output_idx
+        state, reward, done = outputs['state'], outputs['reward'], outputs['done']
+        info = [None] * self.n_envs
+        for i, (env, a) in enumerate(zip(self.envs, actions)):
+            state[i], reward[i], done[i], info[i] = env.step(a)
+
+        # environments stop recording stats once they are done
+        self.mask[:, 0] = ~self.early_done
+        self.score += np.where(self.early_done, 0, reward[:, 0])
+        self.epslen += ~self.early_done
+        self.early_done |= done[:, 0]
+
+        if self.auto_reset:
+            done_envs = np.nonzero(done[:, 0])[0]
+            for i in done_envs:
+                info[i] = dict(info[i], terminal_state=state[i].copy(), score=self.score[i], epslen=self.epslen[i])
+            if done_envs.size:
+                state[done_envs] = self.reset(done_envs)
         
-        return (np.asarray(state), 
-                np.reshape(reward, [self.n_envs, 1]), 
-                np.reshape(done, [self.n_envs, 1]), 
-                info)
+        return state, reward, done, info
 
     def get_mask(self):
         """ Get mask at the current step. Should only be called after self.step """
-        return np.reshape([env.get_mask() for env in self.envs], (self.n_envs, 1))
+        return self.mask.copy()
 
     def get_score(self):
-        return np.asarray([env.get_score() for env in self.envs])
+        return self.score.copy()
 
     def get_epslen(self):
-        return np.asarray([env.get_epslen() for env in self.envs])
+        return self.epslen.copy()
 
 
 class GymEnvVec(EnvBase):
     def __init__(self, EnvType, args):
+        """ Each ray worker steps args['n_envs'] environments and returns them packed into two arrays per step,
+        which the driver copies into preallocated arrays. Masks and stats come with the step,
+        so get_mask, get_score and get_epslen are local reads. 
+        Two sets of outputs are used in turn as in GymEnvVecBase """
         self.n_workers= args['n_workers']
         self.envsperworker = args['n_envs']
         self.n_envs = self.envsperworker * self.n_workers
 
         RayEnvType = ray.remote(num_cpus=1)(EnvType)
         # leave the name envs for consistency, albeit workers seems more appropriate
-        self.envs = [args.update({'seed': 10*i}) or RayEnvType.remote(args.copy()) 
-                    for i in range(self.n_workers)]
+        seed = args.get('seed', 0)
+        self.envs = [RayEnvType.remote(dict(args, seed=seed + 10*i)) for i in range(self.n_workers)]
 
         self.env = GymEnv(args)
         self.max_episode_steps = self.env.max_episode_steps
-
-    def reset(self):
-        return np.reshape(ray.get([env.reset.remote() for env in self.envs]), 
-                          (self.n_envs, *self.state_shape))
+        self.auto_reset = args.get('auto_reset', False)
+
+        self.state_size = int(np.prod(self.state_shape))
+        self.payloads = [(np.zeros((self.n_envs, packed_width(self.state_shape, self.auto_reset)), dtype=self.state_dtype),
+                          np.zeros((self.n_envs, 5)))
+                         for _ in range(2)]
+        self.payload_idx = 0
+        self.mask = np.ones((self.n_envs, 1), dtype=np.float32)
+        self.score = np.zeros(self.n_envs)
+        self.epslen = np.zeros(self.n_envs, dtype=np.int64)
+
+    def reset(self, idxes=None):
+        """ Reset all environments, or only those in idxes, return the states of the reset environments """
+        if idxes is None:
+            self.mask[:] = 1
+            self.score[:] = 0
+            self.epslen[:] = 0
+            return np.reshape(ray.get([env.reset.remote() for env in self.envs]), 
+                              (self.n_envs, *self.state_shape))
+
+        idxes = np.asarray(idxes)
+        self.mask[idxes] = 1
+        self.score[idxes] = 0
+        self.epslen[idxes] = 0
+        workers = idxes // self.envsperworker
+        ids = [self.envs[w].reset.remote(idxes[workers == w] % self.envsperworker) for w in np.unique(workers)]
+        state = np.zeros((len(idxes), *self.state_shape), dtype=self.state_dtype)
+        for w, worker_state in zip(np.unique(workers), ray.get(ids)):
+            state[workers == w] = worker_state
+
+        return state
 
     def random_action(self):
         return np.reshape(ray.get([env.random_action.remote() for env in self.envs]), 
                           (self.n_envs, *self.action_shape))
 
     def step(self, actions):
+        """ Infos are not transferred and None is returned in their place, 
+        except for those made up of the stats of finished episodes if auto_reset is True """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
         actions = np.reshape(actions, (self.n_workers, self.envsperworker, *self.action_shape))
-        state, reward, done, info = list(zip(*ray.get([env.step.remote(a) for a, env in zip(actions, self.envs)])))
+        self.step_ids = [env.packed_step.remote(a) for a, env in zip(actions, self.envs)]
+
+    def step_wait(self):
+        states, stats = self.payloads[self.payload_idx]
+        self.payload_idx = 1 - self.payload_idx
+        k = self.envsperworker
+        for i, (worker_states, worker_stats) in enumerate(ray.get(self.step_ids)):
+            states[i * k: (i + 1) * k] = worker_states
+            stats[i * k: (i + 1) * k] = worker_stats
+        
+        d = self.state_size
+        state = states[:, :d].reshape((self.n_envs, *self.state_shape))
+        reward = stats[:, 0:1]
+        done = stats[:, 1:2] == 1
+        self.mask[:] = stats[:, 2:3]
+        self.score[:] = stats[:, 3]
+        self.epslen[:] = stats[:, 4]
+
+        info = None
+        if self.auto_reset:
+            info = [{} for _ in range(self.n_envs)]
+            done_envs = np.nonzero(done[:, 0])[0]
+            for i in done_envs:
+                info[i] = dict(terminal_state=states[i, d:].reshape(self.state_shape).copy(), 
+                               score=self.score[i], 
+                               epslen=self.epslen[i])
+            # done environments have been reset
+            self.score[done_envs] = 0
+            self.epslen[done_envs] = 0
+
+        return state, reward, done, info
+
+    def get_mask(self):
+        """ Get mask at the current step. Should only be called after self.step """
+        return self.mask.copy()
+
+    def get_score(self):
+        return self.score.copy()
+
+    def get_epslen(self):
+        return self.epslen.copy()
 
-        return (np.reshape(state, (self.n_envs, *self.state_shape)), 
-                np.reshape(reward, (self.n_envs, 1)), 
-                np.reshape(done, (self.n_envs, 1)),
+    def close(self):
+        del self
+
+
+def _shared_array(shape, dtype):
+    """ Preallocate an array in shared memory, return (raw array, shape, dtype), which is picklable at process creation """
+    dtype = np.dtype(dtype)
+    raw = mp.RawArray('b', max(1, int(np.prod(shape)) * dtype.itemsize))
+
+    return raw, shape, dtype
+
+def _as_array(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def _subproc_worker(conn, args, start, arrays):
+    """ Step the environments in [start, start + args['n_envs']) of GymEnvSubproc. 
+    Actions are read from and results are written to the shared arrays, 
+    the pipe only carries commands and acknowledgements """
+    env = GymEnvVecBase(args)
+    end = start + env.n_envs
+    arrays = {k: _as_array(*v)[start: end] for k, v in arrays.items()}
+    
+    def write_stats():
+        arrays['score'][:] = env.get_score()
+        arrays['epslen'][:] = env.get_epslen()
+
+    while True:
+        cmd, data = conn.recv()
+        if cmd == 'step':
+            state, reward, done, info = env.step(arrays['action'])
+            if env.auto_reset:
+                for i in np.nonzero(done[:, 0])[0]:
+                    arrays['terminal_state'][i] = info[i]['terminal_state']
+                    arrays['episode_score'][i] = info[i]['score']
+                    arrays['episode_epslen'][i] = info[i]['epslen']
+            arrays['state'][:] = state
+            arrays['reward'][:] = reward
+            arrays['done'][:] = done
+            arrays['mask'][:] = env.get_mask()
+            write_stats()
+            conn.send(None)
+        elif cmd == 'reset':
+            idxes = np.arange(env.n_envs) if data is None else data
+            arrays['state'][idxes] = env.reset(data)
+            write_stats()
+            conn.send(None)
+        elif cmd == 'random_action':
+            conn.send(env.random_action())
+        elif cmd == 'close':
+            conn.close()
+            break
+        else:
+            raise NotImplementedError
+
+
+class GymEnvSubproc(EnvBase):
+    def __init__(self, args):
+        """ n_workers subprocesses, each steps args['n_envs'] environments as a GymEnvVecBase.
+        Observations, rewards, dones, masks, scores and episode lengths are written to 
+        preallocated shared memory, so a step costs one small message per worker and 
+        get_mask, get_score and get_epslen are local reads """
+        self.n_workers = args['n_workers']
+        self.envsperworker = args['n_envs']
+        self.n_envs = self.envsperworker * self.n_workers
+
+        self.env = GymEnv(dict(args, log_video=False))
+        self.max_episode_steps = self.env.max_episode_steps
+        self.auto_reset = args.get('auto_reset', False)
+
+        n = self.n_envs
+        arrays = dict(
+            state=_shared_array((n, *self.state_shape), self.state_dtype),
+            action=_shared_array((n, *self.action_shape), self.action_dtype),
+            reward=_shared_array((n, 1), np.float64),
+            done=_shared_array((n, 1), bool),
+            mask=_shared_array((n, 1), np.float32),
+            score=_shared_array((n, ), np.float64),
+            epslen=_shared_array((n, ), np.int64),
+            # stats of episodes finished at the current step, only written if auto_reset is True
+            terminal_state=_shared_array((n, *self.state_shape), self.state_dtype),
+            episode_score=_shared_array((n, ), np.float64),
+            episode_epslen=_shared_array((n, ), np.int64),
+        )
+        self.arrays = {k: _as_array(*v) for k, v in arrays.items()}
+
+        self.conns = []
+        self.processes = []
+        seed = args.get('seed', 42)
+        for i in range(self.n_workers):
+            start = i * self.envsperworker
+            parent_conn, child_conn = mp.Pipe()
+            # seeds match those of a GymEnvVecBase with all environments
+            worker_args = dict(args, n_envs=self.envsperworker, seed=seed + start)
+            process = mp.Process(target=_subproc_worker, args=(child_conn, worker_args, start, arrays), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+
+    def reset(self, idxes=None):
+        """ Reset all environments, or only those in idxes, return the states of the reset environments """
+        if idxes is None:
+            [conn.send(('reset', None)) for conn in self.conns]
+            [conn.recv() for conn in self.conns]
+            return self.arrays['state'].copy()
+
+        idxes = np.asarray(idxes)
+        workers = idxes // self.envsperworker
+        conns = [self.conns[w] for w in np.unique(workers)]
+        [conn.send(('reset', idxes[workers == w] % self.envsperworker)) for w, conn in zip(np.unique(workers), conns)]
+        [conn.recv() for conn in conns]
+
+        return self.arrays['state'][idxes]
+
+    def random_action(self):
+        [conn.send(('random_action', None)) for conn in self.conns]
+        return np.reshape([conn.recv() for conn in self.conns], (self.n_envs, *self.action_shape))
+
+    def step(self, actions):
+        """ Infos are not transferred and None is returned in their place, 
+        except for those made up of the stats of finished episodes if auto_reset is True """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        self.arrays['action'][:] = np.reshape(actions, (self.n_envs, *self.action_shape))
+        [conn.send(('step', None)) for conn in self.conns]
+
+    def step_wait(self):
+        [conn.recv() for conn in self.conns]
+
+        done = self.arrays['done'].copy()
+        info = None
+        if self.auto_reset:
+            info = [{} for _ in range(self.n_envs)]
+            for i in np.nonzero(done[:, 0])[0]:
+                info[i] = dict(terminal_state=self.arrays['terminal_state'][i].copy(), 
+                               score=self.arrays['episode_score'][i], 
+                               epslen=self.arrays['episode_epslen'][i])
+
+        # copy results as the next step overwrites them
+        return (self.arrays['state'].copy(), 
+                self.arrays['reward'].copy(), 
+                done, 
                 info)
 
     def get_mask(self):
         """ Get mask at the current step. Should only be called after self.step """
-        return np.reshape(ray.get([env.get_mask.remote() for env in self.envs]), (self.n_envs, 1))
+        return self.arrays['mask'].copy()
 
     def get_score(self):
-        return np.reshape(ray.get([env.get_score.remote() for env in self.envs]), self.n_envs)
+        return self.arrays['score'].copy()
 
     def get_epslen(self):
-        return np.reshape(ray.get([env.get_epslen.remote() for env in self.envs]), self.n_envs)
+        return self.arrays['epslen'].copy()
 
     def close(self):
-        del self
+        for conn in self.conns:
+            conn.send(('close', None))
+        for process in self.processes:
+            process.join()
+
+
+class GymEnvGroups(EnvBase):
+    def __init__(self, args, n_groups=2):
+        """ Split n_workers workers into n_groups vector environments of the same backend, 
+        so that one group steps while actions are computed for another, see pipelined_steps.
+        Other methods treat the groups as a single vector environment """
+        n_workers = args['n_workers']
+        assert_colorize(n_workers % n_groups == 0 and n_workers // n_groups > 1, 
+                        f'Expect at least two workers per group, but get {n_workers} workers for {n_groups} groups')
+        n_workers //= n_groups
+        seed = args.get('seed', 0)
+        self.groups = [create_gym_env(dict(args, double_buffered=False, n_workers=n_workers, 
+                                           seed=seed + 10 * i * n_workers * args['n_envs']))
+                       for i in range(n_groups)]
+        self.n_envs = sum(group.n_envs for group in self.groups)
+        self.env = self.groups[0].env
+        self.auto_reset = args.get('auto_reset', False)
+        self.max_episode_steps = self.env.max_episode_steps
+        if args.get('normalize_obs', False):
+            # groups normalize their own states with moments shared by all groups
+            self.moments = self.groups[0].moments
+            for group in self.groups:
+                group.moments = self.moments
+
+    @property
+    def state_shape(self):
+        # groups may stack frames, see GymEnvFrameStack
+        return self.groups[0].state_shape
+
+    def reset(self, idxes=None):
+        """ Reset all environments, or only those in idxes, return the states of the reset environments """
+        if idxes is None:
+            return np.concatenate([group.reset() for group in self.groups])
+
+        idxes = np.asarray(idxes)
+        offsets = np.cumsum([0] + [group.n_envs for group in self.groups])
+        groups = np.searchsorted(offsets, idxes, side='right') - 1
+        state = None
+        for g in np.unique(groups):
+            group_state = self.groups[g].reset(idxes[groups == g] - offsets[g])
+            if state is None:
+                state = np.zeros((len(idxes), *group_state.shape[1:]), dtype=group_state.dtype)
+            state[groups == g] = group_state
+
+        return state
+
+    def random_action(self):
+        return np.concatenate([group.random_action() for group in self.groups])
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        actions = np.split(np.asarray(actions), np.cumsum([group.n_envs for group in self.groups[:-1]]))
+        [group.step_async(a) for group, a in zip(self.groups, actions)]
+
+    def step_wait(self):
+        state, reward, done, info = list(zip(*[group.step_wait() for group in self.groups]))
+        if self.auto_reset:
+            info = [i for group_info in info for i in group_info]
+
+        return np.concatenate(state), np.concatenate(reward), np.concatenate(done), info
+
+    def pipelined_steps(self, act_fn):
+        """ Step all environments with actions from act_fn until the generator is closed.
+        Actions for a group are computed while the other groups step, 
+        and the next step of a group is started before the current step is yielded
+
+        Arguments:
+            act_fn {function} -- maps states of a group to a tuple whose first element is actions
+
+        Yields:
+            (state, outputs of act_fn, next_state, reward, done, mask, info), concatenated over groups
+        """
+        states = [group.reset() for group in self.groups]
+        outputs = [None] * len(self.groups)
+        for i, group in enumerate(self.groups):
+            outputs[i] = act_fn(states[i])
+            group.step_async(outputs[i][0])
+        try:
+            while True:
+                results = []
+                for i, group in enumerate(self.groups):
+                    next_state, reward, done, info = group.step_wait()
+                    results.append((states[i], outputs[i], next_state, reward, done, group.get_mask(), info))
+                    states[i] = next_state
+                    outputs[i] = act_fn(next_state)
+                    group.step_async(outputs[i][0])
+                state, output, next_state, reward, done, mask, info = zip(*results)
+                if self.auto_reset:
+                    info = [i for group_info in info for i in group_info]
+                yield (np.concatenate(state), tuple(np.concatenate(o) for o in zip(*output)), 
+                       np.concatenate(next_state), np.concatenate(reward), np.concatenate(done), np.concatenate(mask), info)
+        finally:
+            # finish the steps in flight so that groups can be reset afterwards
+            [group.step_wait() for group in self.groups]
+
+    def get_mask(self):
+        """ Get mask at the current step. Should only be called after self.step """
+        return np.concatenate([group.get_mask() for group in self.groups])
+
+    def get_score(self):
+        return np.concatenate([group.get_score() for group in self.groups])
+
+    def get_epslen(self):
+        return np.concatenate([group.get_epslen() for group in self.groups])
+
+    def close(self):
+        [group.close() for group in self.groups]
+
+
+class GymEnvNormObs(EnvBase):
+    def __init__(self, env, clip=5.):
+        """ A stage after env, which normalizes states of all environments in one batch 
+        with running per-dimension moments, see utility/run_avg.RunningMoments.
+        Moments are updated by states from reset and step unless update_moments is False.
+        Processes share statistics by merging moments, e.g., through a learner.
+        Used by on-policy agents, off-policy agents normalize states sampled from their replays instead,
+        see OffPolicyOperation._prepare_data """
+        self.venv = env
+        self.env = env.env
+        self.n_envs = env.n_envs
+        self.max_episode_steps = env.max_episode_steps
+        self.moments = RunningMoments(self.state_shape, clip)
+        self.update_moments = True
+
+    def __getattr__(self, name):
+        # methods not involving states, e.g., get_mask, get_score and get_epslen
+        return getattr(self.venv, name)
+
+    def follow(self, env):
+        """ Normalize with the moments of another GymEnvNormObs without updating them, e.g., for evaluation """
+        self.moments = env.moments
+        self.update_moments = False
+
+    def reset(self, idxes=None):
+        state = self.venv.reset() if idxes is None else self.venv.reset(idxes)
+        return self._normalize(state)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        self.venv.step_async(actions)
+
+    def step_wait(self):
+        state, reward, done, info = self.venv.step_wait()
+        state = self._normalize(state)
+        if self.venv.auto_reset:
+            # terminal states are normalized with the same moments as states of this step
+            for i in (info if isinstance(info, list) else [info]):
+                if 'terminal_state' in i:
+                    i['terminal_state'] = self._normalize(i['terminal_state'], update=False)
+
+        return state, reward, done, info
+
+    """ Implementation """
+    def _normalize(self, state, update=True):
+        x = np.reshape(state, (-1, *self.state_shape))
+        if update and self.update_moments:
+            self.moments.update(x)
+
+        return np.reshape(self.moments.normalize(x), np.shape(state))
+
+
+class GymEnvFrameStack(EnvBase):
+    def __init__(self, env, frame_stack):
+        """ A stage after env, which stacks the latest frame_stack uint8 frames of each environment along the last axis.
+        The stack of the first state of an episode repeats its frame. 
+        Like LazyFrames, consecutive stacks share frames: replays store each frame once 
+        and rebuild stacks from indexes at sample time, see replay/utils.stack_frames. 
+        Stacks are written to two arrays used in turn as in GymEnvVecBase """
+        assert_colorize(env.state_dtype == np.uint8, 
+                        f'Frame stacking expects uint8 frames, e.g., from WarpFrame, but get {env.state_dtype}')
+        self.venv = env
+        self.env = env.env
+        self.n_envs = env.n_envs
+        self.max_episode_steps = env.max_episode_steps
+        self.frame_stack = frame_stack
+        self.frame_shape = env.state_shape
+        self.stacks = [np.zeros((self.n_envs, *self.state_shape), dtype=np.uint8) for _ in range(2)]
+        self.stack_idx = 0
+
+    @property
+    def state_shape(self):
+        *shape, channels = self.frame_shape
+        return (*shape, channels * self.frame_stack)
+
+    def __getattr__(self, name):
+        # methods not involving states, e.g., get_mask, get_score and get_epslen
+        return getattr(self.venv, name)
+
+    def reset(self, idxes=None):
+        """ Reset all environments, or only those in idxes, return the states of the reset environments.
+        Stacks of the reset environments are restarted in the array returned by the last step, 
+        which callers replace their states with anyway, so that the next step keeps the other array intact """
+        frames = self.venv.reset() if idxes is None else self.venv.reset(idxes)
+        idxes = np.arange(self.n_envs) if idxes is None else idxes
+        stacks = self.stacks[self.stack_idx]
+        stacks[idxes] = self._repeat(np.reshape(frames, (len(idxes), *self.frame_shape)))
+
+        return np.reshape(stacks[idxes], (*np.shape(frames)[:-1], -1))
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions):
+        self.venv.step_async(actions)
+
+    def step_wait(self):
+        frame, reward, done, info = self.venv.step_wait()
+        frames = np.reshape(frame, (self.n_envs, *self.frame_shape))
+        c = self.frame_shape[-1]
+        stacks = self.stacks[self.stack_idx]
+        self.stack_idx = 1 - self.stack_idx
+        next_stacks = self.stacks[self.stack_idx]
+        next_stacks[..., :-c] = stacks[..., c:]
+        next_stacks[..., -c:] = frames
+        if self.venv.auto_reset:
+            # done environments have been reset, their frames start new stacks
+            infos = info if isinstance(info, list) else [info]
+            for i in np.nonzero(np.reshape(done, self.n_envs))[0]:
+                terminal_state = next_stacks[i].copy()
+                terminal_state[..., -c:] = infos[i]['terminal_state']
+                infos[i]['terminal_state'] = terminal_state
+                next_stacks[i] = self._repeat(frames[i])
+
+        return np.reshape(next_stacks, (*np.shape(frame)[:-1], -1)), reward, done, info
+
+    """ Implementation """
+    def _repeat(self, frames):
+        return np.concatenate([frames] * self.frame_stack, axis=-1)
 
 
 def create_gym_env(args):
+    """ args['backend'] selects how n_workers > 1 workers run their environments, 
+    'ray' for ray actors and 'subproc' for subprocesses with shared memory.
+    If args['double_buffered'] is True, workers are split into two groups, see GymEnvGroups.
+    If args['frame_stack'] is larger than 1, frames are stacked by GymEnvFrameStack.
+    If args['normalize_obs'] is True, states are normalized by GymEnvNormObs """
     # manually use GymEnvVecBaes for easy environments
     EnvType = GymEnv if 'n_envs' not in args or args['n_envs'] == 1 else GymEnvVecBase
     if 'n_workers' not in args or args['n_workers'] == 1:
-        return EnvType(args)
+        env = EnvType(args)
+    elif args.get('double_buffered', False):
+        # frame stacking and normalization are applied to each group
+        return GymEnvGroups(args)
+    elif args.get('backend', 'ray') == 'subproc':
+        env = GymEnvSubproc(args)
     else:
-        return GymEnvVec(EnvType, args)
+        env = GymEnvVec(EnvType, args)
+
+    if args.get('frame_stack', 1) > 1:
+        assert_colorize(not args.get('normalize_obs', False), 'Stacked frames are not normalized by running moments')
+        env = GymEnvFrameStack(env, args['frame_stack'])
+    if args.get('normalize_obs', False):
+        env = GymEnvNormObs(env, args.get('obs_clip', 5.))
+
+    return env
 
 
 if __name__ == '__main__':
-    # test efficiency
+    # test efficiency of the three backends stepping the same number of environments
+    # python -m env.gym_env
     default_args = dict(
         name='BipedalWalker-v2', # Pendulum-v0, CartPole-v0
         video_path='video',
@@ -198,35 +767,83 @@ if __name__ == '__main__':
         n_envs=8,
         seed=0
     )
-    from time import sleep
 
+    def benchmark(name, envs):
+        actions = envs.random_action()
+        with Timer(name):
+            states = envs.reset()
+            for _ in range(envs.max_episode_steps):
+                states, rewards, dones, _ = envs.step(actions)
+                states = np.asarray(states)
+                rewards = np.asarray(rewards)
+                dones = np.asarray(dones)
+                masks = envs.get_mask()
+        print(envs.get_epslen())
+
+    n = default_args['n_workers']
     ray.init()
-    args = default_args.copy()
-    n = args['n_workers']
-    envvec = create_gym_env(args)
-    actions = envvec.random_action()
-    with Timer(f'envvec {n} workers'):
-        states = envvec.reset()
-        for _ in range(envvec.max_episode_steps):
-            states, rewards, dones, _ = envvec.step(actions)
-            states = np.asarray(states)
-            rewards = np.asarray(rewards)
-            dones = np.asarray(dones)
-    print(envvec.get_epslen())
+    envvec = create_gym_env(dict(default_args, backend='ray'))
+    benchmark(f'envvec {n} workers', envvec)
     envvec.close()
+
+    # per-step time of the ray backend with one environment per worker, where the driver overhead dominates.
+    # The unpacked protocol is the one before packed_step: it steps, then fetches masks in another round 
+    # of remote calls, and assembles results from lists
+    from time import time
+    n_steps = 1000
+    for n_workers in [8, 32]:
+        envvec = create_gym_env(dict(default_args, backend='ray', n_workers=n_workers, n_envs=1))
+        actions = np.reshape(envvec.random_action(), (n_workers, 1, *envvec.action_shape))
+        envvec.reset()
+        start = time()
+        for _ in range(n_steps):
+            state, reward, done, _ = zip(*ray.get([env.step.remote(a) for a, env in zip(actions, envvec.envs)]))
+            state = np.reshape(state, (envvec.n_envs, *envvec.state_shape))
+            reward = np.reshape(reward, (envvec.n_envs, 1))
+            done = np.reshape(done, (envvec.n_envs, 1))
+            mask = np.reshape(ray.get([env.get_mask.remote() for env in envvec.envs]), (envvec.n_envs, 1))
+        print(f'unpacked protocol {n_workers} workers: {(time() - start) / n_steps * 1e3:.3f}ms per step')
+        envvec.reset()
+        start = time()
+        for _ in range(n_steps):
+            state, reward, done, _ = envvec.step(actions)
+            mask = envvec.get_mask()
+        print(f'packed protocol {n_workers} workers: {(time() - start) / n_steps * 1e3:.3f}ms per step')
+        envvec.close()
     ray.shutdown()
 
+    envsubproc = create_gym_env(dict(default_args, backend='subproc'))
+    benchmark(f'envsubproc {n} workers', envsubproc)
+    envsubproc.close()
+
     args = default_args.copy()
     args['n_envs'] *= args['n_workers']
     del args['n_workers']
     envs = create_gym_env(args)
-    actions = envs.random_action()
-    with Timer('envvecbase'):
+    benchmark('envvecbase', envs)
+
+    # latency hiding of double-buffered rollouts on 64 environments, 
+    # the policy is a numpy mlp standing in for the inference of an actor
+    args = dict(default_args, n_envs=8, n_workers=8, backend='subproc', max_episode_steps=1000)
+    weights = [np.random.randn(*shape).astype(np.float32) / 16 
+               for shape in [(24, 512), (512, 512), (512, 256), (256, 4)]]
+    def act_fn(states):
+        x = states.astype(np.float32)
+        for w in weights:
+            x = np.tanh(x @ w)
+        return (x, )
+
+    envs = create_gym_env(args)
+    with Timer('synchronous rollout on 64 envs'):
         states = envs.reset()
         for _ in range(envs.max_episode_steps):
-            states, rewards, dones, _ = envs.step(actions)
-            states = np.asarray(states)
-            rewards = np.asarray(rewards)
-            dones = np.asarray(dones)
-    print(envs.get_epslen())
-    
\ No newline at end of file
+            states, _, _, _ = envs.step(act_fn(states)[0])
+    envs.close()
+
+    envs = create_gym_env(dict(args, double_buffered=True))
+    with Timer('double-buffered rollout on 64 envs'):
+        steps = envs.pipelined_steps(act_fn)
+        for _ in range(envs.max_episode_steps):
+            next(steps)
+        steps.close()
+    envs.close()
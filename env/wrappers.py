@@ -3,6 +3,8 @@ https://github.com/openai/baselines/blob/master/baselines/common/wrappers.py
 """
 import numpy as np
 import gym
+import cv2
+cv2.ocl.setUseOpenCL(False)
 
 class TimeLimit(gym.Wrapper):
     def __init__(self, env, max_episode_steps=None):
@@ -32,6 +34,24 @@ class ClipActionsWrapper(gym.Wrapper):
     def reset(self, **kwargs):
         return self.env.reset(**kwargs)
 
+class WarpFrame(gym.ObservationWrapper):
+    def __init__(self, env, frame_size=(84, 84), grayscale=True):
+        """ Warp frames to frame_size, given as (height, width), and convert them to grayscale if grayscale is True.
+        Frames are uint8 of shape (height, width, channels) """
+        super(WarpFrame, self).__init__(env)
+        self.height, self.width = frame_size
+        self.grayscale = grayscale
+        channels = 1 if grayscale else env.observation_space.shape[-1]
+        self.observation_space = gym.spaces.Box(low=0, high=255, 
+                                                shape=(self.height, self.width, channels), dtype=np.uint8)
+
+    def observation(self, frame):
+        if self.grayscale:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        # cv2 drops the channel axis of single-channel frames
+        return np.reshape(frame, self.observation_space.shape)
+
 class EnvStats(gym.Wrapper):
     """ Provide Environment Stats Records """
     def reset(self):
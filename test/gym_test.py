@@ -48,3 +48,24 @@ class TestClass:
         assert np.all(n == env.get_epslen()), f'counted epslen: {n}\nrecorded epslen: {env.get_epslen()}'
             
         return cr, n
+
+    def test_GymEnvSubproc(self):
+        args['n_envs'] = 2
+        args['n_workers'] = random.randint(2, 4)
+        args['backend'] = 'subproc'
+        env = create_gym_env(args)
+        del args['n_workers'], args['backend']
+        cr = np.zeros(env.n_envs)
+        n = np.zeros(env.n_envs)
+        s = env.reset()
+        for _ in range(env.max_episode_steps):
+            a = env.random_action()
+            s, r, d, _ = env.step(a)
+            m = np.squeeze(env.get_mask())
+            cr += np.squeeze(r) * m
+            n += m
+        env.close()
+        assert np.allclose(cr, env.get_score()), f'counted reward: {cr}\nrecorded reward: {env.get_score()}'
+        assert np.all(n == env.get_epslen()), f'counted epslen: {n}\nrecorded epslen: {env.get_epslen()}'
+            
+        return cr, n
@@ -0,0 +1,67 @@
+import threading
+
+from algo.off_policy.replay.rate_limiter import RateLimiter
+
+
+def start(fn, *args):
+    """ Run fn in a daemon thread, so that a call blocking forever fails the test instead of hanging it """
+    thread = threading.Thread(target=fn, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def finishes(thread, timeout=5):
+    thread.join(timeout)
+    return not thread.is_alive()
+
+def blocks(thread, timeout=.2):
+    # a blocked call rechecks its condition on every wakeup, so it stays blocked until the other side moves
+    thread.join(timeout)
+    return thread.is_alive()
+
+class TestClass:
+    # diff = 2 * inserts - samples is kept in [16, 24] once 10 transitions are inserted
+    samples_per_insert, min_size, tolerance = 2, 10, 4
+
+    def test_band_edges(self):
+        limiter = RateLimiter(self.samples_per_insert, self.min_size, self.tolerance)
+        # nothing is sampled before min_size transitions are inserted
+        limiter.n_inserts = self.min_size - 1
+        assert not limiter.can_sample(1)
+        limiter.n_inserts = self.min_size
+        assert limiter.diff == 20
+        assert limiter.can_sample(4) and not limiter.can_sample(5)
+        assert limiter.can_insert(2) and not limiter.can_insert(3)
+        limiter.n_samples = 4
+        assert not limiter.can_sample(1)
+        assert limiter.can_insert(4) and not limiter.can_insert(5)
+
+    def test_await_sample(self):
+        limiter = RateLimiter(self.samples_per_insert, self.min_size, self.tolerance)
+        sampler = start(limiter.await_sample, 1)
+        assert blocks(sampler)
+        # the sampler goes through once min_size transitions are inserted
+        assert finishes(start(limiter.await_insert, self.min_size))
+        assert finishes(sampler)
+        assert limiter.n_samples == 1
+        assert finishes(start(limiter.await_sample, 3))
+        sampler = start(limiter.await_sample, 1)
+        assert blocks(sampler)
+        # an insert raises diff to 18 and releases the sampler
+        limiter.await_insert(1)
+        assert finishes(sampler)
+        assert limiter.n_samples == 5 and limiter.diff == 17
+
+    def test_await_insert(self):
+        limiter = RateLimiter(self.samples_per_insert, self.min_size, self.tolerance)
+        # inserts are never blocked while sampling is, otherwise both sides would wait forever
+        assert finishes(start(limiter.await_insert, 100))
+        limiter = RateLimiter(self.samples_per_insert, self.min_size, self.tolerance)
+        limiter.await_insert(self.min_size)
+        assert finishes(start(limiter.await_insert, 2))
+        inserter = start(limiter.await_insert, 1)
+        assert blocks(inserter)
+        assert limiter.n_inserts == self.min_size + 2
+        # a sample lowers diff to 22 and releases the inserter
+        limiter.await_sample(2)
+        assert finishes(inserter)
+        assert limiter.n_inserts == self.min_size + 3 and limiter.diff == 24
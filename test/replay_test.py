@@ -0,0 +1,65 @@
+import numpy as np
+
+from algo.off_policy.replay.utils import add_buffer, compute_n_step, store_state, stack_frames
+
+
+def random_episodes(n_episodes, max_len=20):
+    """ One-step rewards and dones of consecutive complete episodes """
+    lens = np.random.randint(1, max_len, size=n_episodes)
+    reward = np.random.normal(size=np.sum(lens))
+    done = np.zeros(np.sum(lens), dtype=bool)
+    done[np.cumsum(lens) - 1] = True
+
+    return reward, done
+
+def stacked_states(frames, done, frame_stack, first=0):
+    """ Stacks of frames along the last axis as GymEnvFrameStack produces them,
+    frames before the start of an episode or before first are replaced by the oldest available one """
+    starts = np.concatenate([[0], np.nonzero(done[:-1])[0] + 1])
+    states = []
+    for t in range(len(frames)):
+        start = max(starts[starts <= t][-1], first)
+        states.append(np.concatenate([frames[max(t - i, start)] for i in reversed(range(frame_stack))], axis=-1))
+
+    return np.asarray(states)
+
+class TestClass:
+    def test_compute_n_step(self):
+        for n_steps in [1, 3, 5]:
+            gamma = .99
+            reward, done = random_episodes(10)
+            n = len(reward)
+            buffer = dict(state=np.zeros((n, 1)),
+                          action=np.zeros((n, 1)),
+                          reward=np.zeros((n, 1)),
+                          done=np.zeros((n, 1), dtype=bool),
+                          steps=np.zeros((n, 1), dtype=np.uint8))
+            for i, (r, d) in enumerate(zip(reward, done)):
+                add_buffer(buffer, i, 0, 0, r, d, n_steps, gamma)
+            n_step_reward, n_step_done, steps = compute_n_step(reward, done, n_steps, gamma)
+
+            assert np.allclose(n_step_reward, buffer['reward']), f'n_steps={n_steps}'
+            assert np.all(n_step_done == buffer['done']), f'n_steps={n_steps}'
+            assert np.all(steps == buffer['steps']), f'n_steps={n_steps}'
+
+    def test_stack_frames(self):
+        frame_stack, channels = 4, 2
+        _, done = random_episodes(10)
+        n = len(done)
+        frames = np.random.randint(256, size=(n, 3, 3, channels), dtype=np.uint8)
+        states = stacked_states(frames, done, frame_stack)
+        buffer = dict(state=np.zeros((n, 3, 3, channels), dtype=np.uint8),
+                      first_frame=np.zeros((n, 1), dtype=bool))
+        store_state(buffer, slice(None), states)
+        assert np.all(stack_frames(buffer, np.arange(n), frame_stack) == states)
+
+        # a circular buffer keeps the latest capacity frames, stacks stop at the oldest one
+        capacity = n // 2
+        buffer = dict(state=np.zeros((capacity, 3, 3, channels), dtype=np.uint8),
+                      first_frame=np.zeros((capacity, 1), dtype=bool))
+        for t in range(n):
+            store_state(buffer, t % capacity, states[t])
+        oldest = n % capacity
+        indexes = (oldest + np.arange(capacity)) % capacity
+        expected = stacked_states(frames, done, frame_stack, first=n - capacity)[n - capacity:]
+        assert np.all(stack_frames(buffer, indexes, frame_stack, oldest) == expected)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from utility.run_avg import RunningMoments
+
+
+class TestClass:
+    def test_RunningMoments_merge(self):
+        shape = (3, )
+        batches = [np.random.normal(np.random.normal(), np.random.uniform(.5, 2), size=(np.random.randint(1, 50), *shape))
+                   for _ in range(10)]
+        # each process updates its own moments with half of the batches and merges the others' deltas
+        a, b = RunningMoments(shape), RunningMoments(shape)
+        for i, x in enumerate(batches):
+            (a if i % 2 == 0 else b).update(x)
+            if i % 3 == 2:
+                da, db = a.pop_delta(), b.pop_delta()
+                a.merge(db)
+                b.merge(da)
+        da, db = a.pop_delta(), b.pop_delta()
+        a.merge(db)
+        b.merge(da)
+
+        x = np.concatenate(batches)
+        for moments in [a, b]:
+            count, mean, m2 = moments.get_moments()
+            assert count == len(x)
+            assert np.allclose(mean, np.mean(x, axis=0))
+            assert np.allclose(m2 / count, np.var(x, axis=0))
+        assert a.pop_delta()[0] == 0
+        normalized = np.clip((x - np.mean(x, axis=0)) / np.sqrt(np.var(x, axis=0) + a.epsilon), -a.clip, a.clip)
+        assert np.allclose(a.normalize(x.copy()), normalized)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from algo.off_policy.apex.buffer import LocalBuffer
+from algo.off_policy.apex.transfer import pack_buffer, unpack_buffer, merge_packets
+from algo.off_policy.replay.proportional_replay import ProportionalPrioritizedReplay
+
+
+args = dict(normalize_reward=False, reward_scale=1, to_update_priority=False,
+            alpha=.7, beta0=.4, epsilon=1e-4, beta_steps=5e4, min_size=10, capacity=100,
+            local_capacity=40, n_steps=3, tb_capacity=10, gamma=.99, batch_size=8)
+
+def random_local_buffer(state_shape, action_dim, length, frame_stack=1):
+    """ A local buffer holding length random transitions ending with a complete episode """
+    buffer = LocalBuffer(dict(args, frame_stack=frame_stack), state_shape, action_dim)
+    for i in range(length):
+        if frame_stack > 1:
+            state = np.random.randint(256, size=state_shape, dtype=np.uint8)
+        else:
+            state = np.random.normal(size=state_shape)
+        action = np.random.randint(action_dim) if action_dim == 1 else np.random.uniform(-1, 1, size=action_dim)
+        buffer.add_data(state, action, np.random.normal(), i == length - 1)
+    buffer.add_last_state(np.zeros_like(state))
+    buffer['priority'][:length] = np.random.uniform(.1, 1, size=(length, 1))
+
+    return buffer
+
+def check_packets(compression):
+    """ Fields unpacked from packets of local buffers are those packed with their dtypes """
+    for state_shape, action_dim, frame_stack in [((5, ), 3, 1), ((4, 4, 8), 1, 4)]:
+        length = 30
+        local_buffer = random_local_buffer(state_shape, action_dim, length, frame_stack)
+        for with_priority in [True, False]:
+            packet = pack_buffer(local_buffer, length, compression, with_priority=with_priority)
+            buffer, n = unpack_buffer(packet)
+            assert n == length
+            keys = [k for k in local_buffer if with_priority or k != 'priority']
+            assert sorted(buffer) == sorted(keys)
+            for k in keys:
+                # priorities are sent in float32
+                dtype = np.float32 if k == 'priority' else local_buffer[k].dtype
+                assert buffer[k].dtype == dtype, k
+                assert np.all(buffer[k] == local_buffer[k][:length].astype(dtype)), k
+
+class TestClass:
+    def test_pack_buffer(self):
+        check_packets(None)
+
+    def test_pack_buffer_lz4(self):
+        pytest.importorskip('lz4.frame')
+        check_packets('lz4')
+
+    def test_merge_packets(self):
+        state_shape, action_dim, length = (5, ), 3, 30
+        local_buffers = [random_local_buffer(state_shape, action_dim, length) for _ in range(5)]
+        for top_priority in [False, True]:
+            # merge_buffer of the learner
+            expected = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+            replay = ProportionalPrioritizedReplay(args, state_shape, action_dim)
+            for local_buffer in local_buffers:
+                if top_priority:
+                    local_buffer = dict(local_buffer, priority=np.full((length, 1), expected.top_priority))
+                expected.merge(local_buffer, length)
+            # more transitions than capacity are merged, so merges wrap around the replay
+            merge_packets(replay, [pack_buffer(b, length, with_priority=not top_priority) for b in local_buffers],
+                          top_priority=top_priority)
+
+            assert len(replay) == len(expected) and replay.mem_idx == expected.mem_idx
+            for k, v in expected.memory.items():
+                assert replay.memory[k].dtype == v.dtype, k
+                assert np.all(replay.memory[k] == v), k
+            assert np.isclose(replay.data_structure.total_priorities, expected.data_structure.total_priorities)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from utility.weight_codec import WeightEncoder, WeightDecoder
+
+
+def sync(encoder, decoder, versions):
+    """ Push successive versions of weights as an optimizer moves them,
+    decode each right after it is encoded against the decoder's version, return the last weights """
+    w = np.random.normal(scale=.05, size=1000).astype(np.float32)
+    for _ in range(versions):
+        w = w + 3e-4 * np.random.normal(size=w.size).astype(np.float32)
+        encoder.push(w)
+        decoded = decoder.decode(encoder.encode(decoder.version))
+        assert decoded is not None
+        assert decoded.dtype == np.float32
+        assert decoder.version == encoder.version
+        assert np.all(decoded == w.astype(encoder.dtype).astype(np.float32))
+
+    return w
+
+class TestClass:
+    def test_round_trip(self):
+        for dtype in ['float32', 'float16']:
+            for delta in [None, 'xor']:
+                encoder, decoder = WeightEncoder(dtype=dtype, delta=delta), WeightDecoder()
+                sync(encoder, decoder, 5)
+
+    def test_xor_delta(self):
+        encoder, decoder = WeightEncoder(delta='xor', history=4), WeightDecoder()
+        w = sync(encoder, decoder, 1)
+        # the decoder skips versions the encoder still holds, so the payload is a delta against its version
+        for _ in range(3):
+            encoder.push(w + np.float32(1e-3))
+            w = w + np.float32(1e-3)
+        payload = encoder.encode(decoder.version)
+        assert payload['base_version'] == decoder.version
+        assert np.all(decoder.decode(payload) == w)
+        assert decoder.version == encoder.version
+
+    def test_missing_base_version(self):
+        encoder, decoder = WeightEncoder(delta='xor'), WeightDecoder()
+        w = sync(encoder, decoder, 2)
+        encoder.push(w + np.float32(1e-3))
+        # a delta against a version other than the decoder's requires a full snapshot
+        payload = encoder.encode(1)
+        assert payload['base_version'] == 1
+        assert decoder.decode(payload) is None
+        assert decoder.version == 2
+        assert WeightDecoder().decode(encoder.encode(2)) is None
+        # versions out of history are answered with a full snapshot
+        payload = encoder.encode(-1)
+        assert payload['base_version'] is None
+        assert np.all(decoder.decode(payload) == w + np.float32(1e-3))
+
+    def test_lz4(self):
+        pytest.importorskip('lz4.frame')
+        for dtype in ['float32', 'float16']:
+            for delta in [None, 'xor']:
+                encoder, decoder = WeightEncoder(dtype=dtype, delta=delta, compression='lz4'), WeightDecoder()
+                sync(encoder, decoder, 5)
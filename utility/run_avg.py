@@ -51,3 +51,64 @@ class RunningMeanStd(object):
         x = (x - self.mean) / (self.var + self.epsilon)
         # print(f'after normalization:\tmean:{np.mean(x)}\tstd:{np.std(x)}')
         return x
+
+
+def merge_moments(a, b):
+    """ Merge two (count, mean, m2) tuples, where m2 is the sum of squared deviations from the mean """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + np.square(delta) * count_a * count_b / count
+
+    return count, mean, m2
+
+
+class RunningMoments:
+    """ Per-dimension running mean and variance, which can be merged across processes.
+    Besides the overall moments, moments of data seen since the last pop_delta are kept, 
+    so that processes only send what others have not seen yet when they all-reduce their statistics """
+    def __init__(self, shape, clip=5., epsilon=1e-8):
+        self.shape = tuple(shape)
+        self.clip = clip
+        self.epsilon = epsilon
+        self.set_moments(self._zeros())
+        self.delta = self._zeros()
+
+    def update(self, x):
+        """ Update moments with a batch x of shape [N, *shape] """
+        x = np.reshape(x, (-1, *self.shape))
+        mean = np.mean(x, axis=0)
+        batch = (len(x), mean, np.sum(np.square(x - mean), axis=0))
+        self.set_moments(merge_moments(self.get_moments(), batch))
+        self.delta = merge_moments(self.delta, batch)
+
+    def merge(self, moments):
+        """ Merge (count, mean, m2) computed elsewhere """
+        self.set_moments(merge_moments(self.get_moments(), moments))
+
+    def pop_delta(self):
+        """ Return moments of data seen since the last call and clear them """
+        delta, self.delta = self.delta, self._zeros()
+        return delta
+
+    def get_moments(self):
+        return self.count, self.mean, self.m2
+
+    def set_moments(self, moments):
+        self.count, self.mean, self.m2 = moments
+        var = self.m2 / self.count if self.count > 0 else np.ones(self.shape)
+        # replaced as a whole, so threads that only normalize never see half-updated statistics
+        self.scale = (self.mean, 1 / np.sqrt(var + self.epsilon))
+
+    def normalize(self, x):
+        mean, inv_std = self.scale
+        x = (x - mean) * inv_std
+        return np.clip(x, -self.clip, self.clip, out=x)
+
+    """ Implementation """
+    def _zeros(self):
+        return 0, np.zeros(self.shape), np.zeros(self.shape)
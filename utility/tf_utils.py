@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import numpy as np
 import tensorflow as tf
 import tensorflow.contrib as tc
@@ -213,4 +214,30 @@ def get_sess_config(parallelism_threads):
                                  allow_soft_placement=True)
     sess_config.gpu_options.allow_growth = True
 
-    return sess_config
\ No newline at end of file
+    return sess_config
+
+
+class VariableGroup:
+    """ Flat weights of exactly the given variables, in the given order. 
+    Same interface as ray.experimental.tf_utils.TensorFlowVariables, 
+    which also collects every variable its output depends on """
+    def __init__(self, variables, sess):
+        self.sess = sess
+        self.variables = OrderedDict((v.op.name, v) for v in variables)
+        self.shapes = [v.shape.as_list() for v in self.variables.values()]
+        self.placeholders = [tf.compat.v1.placeholder(v.dtype.base_dtype, shape) 
+                             for v, shape in zip(self.variables.values(), self.shapes)]
+        self.assign_op = tf.group(*[v.assign(p) for v, p in zip(self.variables.values(), self.placeholders)])
+
+    def get_flat_size(self):
+        return sum(int(np.prod(shape)) for shape in self.shapes)
+
+    def get_flat(self):
+        weights = self.sess.run(list(self.variables.values()))
+        return np.concatenate([np.reshape(w, -1) for w in weights])
+
+    def set_flat(self, new_weights):
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        weights = np.split(new_weights, np.cumsum(sizes)[:-1])
+        self.sess.run(self.assign_op, feed_dict={p: np.reshape(w, shape) 
+                                                 for p, w, shape in zip(self.placeholders, weights, self.shapes)})
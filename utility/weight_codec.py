@@ -0,0 +1,174 @@
+"""
+Codec for shipping flat weights from learners to workers.
+Three independent options are supported:
+    dtype: 'float32' or 'float16', float16 halves the payload at the cost of precision
+    delta: None or 'xor', XOR the bits of the weights against a version the receiver
+           already has. Successive versions share signs, exponents and leading mantissa bits,
+           so the result is mostly zeros, which pays off only when combined with compression
+    compression: None or 'lz4'
+The encoder keeps the last few versions it has published. When the receiver's version
+is no longer available, a full snapshot is sent instead.
+"""
+from collections import OrderedDict
+import numpy as np
+
+from utility.display import assert_colorize
+
+
+_UINT = dict(float32=np.uint32, float16=np.uint16)
+
+
+def _compress(data, compression):
+    if compression == 'lz4':
+        import lz4.frame
+        return lz4.frame.compress(data.tobytes())
+    else:
+        return data
+
+def _decompress(data, compression, dtype):
+    if compression == 'lz4':
+        import lz4.frame
+        return np.frombuffer(lz4.frame.decompress(data), dtype=dtype)
+    else:
+        return data
+
+def payload_nbytes(payload):
+    data = payload['data']
+    return data.nbytes if isinstance(data, np.ndarray) else len(data)
+
+
+class WeightEncoder:
+    """ Interface """
+    def __init__(self, dtype='float32', delta=None, compression=None, history=8):
+        """ Encode weights for receivers identified by the last version they have decoded
+
+        Keyword Arguments:
+            dtype {str} -- 'float32' or 'float16' (default: {'float32'})
+            delta {str} -- None or 'xor' (default: {None})
+            compression {str} -- None or 'lz4' (default: {None})
+            history {int} -- number of versions kept for delta encoding (default: {8})
+        """
+        assert_colorize(dtype in _UINT, f'Unsupported dtype: {dtype}')
+        assert_colorize(delta in (None, 'xor'), f'Unsupported delta: {delta}')
+        assert_colorize(compression in (None, 'lz4'), f'Unsupported compression: {compression}')
+        if compression == 'lz4':
+            # fail early rather than on the first sync
+            import lz4.frame
+        self.dtype = dtype
+        self.delta = delta
+        self.compression = compression
+        self.history = history
+
+        self.version = 0
+        self.weights = OrderedDict()     # version --> weights in self.dtype
+
+    @classmethod
+    def from_args(cls, args):
+        args = args or {}
+        none = lambda x: None if x is None or str(x).lower() == 'none' else x
+        return cls(dtype=args.get('dtype', 'float32'),
+                   delta=none(args.get('delta')),
+                   compression=none(args.get('compression')),
+                   history=args.get('history', 8))
+
+    def push(self, flat, version=None):
+        """ Record a new version of the weights, return its version """
+        self.version = self.version + 1 if version is None else version
+        self.weights[self.version] = np.asarray(flat).astype(self.dtype)
+        while len(self.weights) > (self.history if self.delta else 1):
+            self.weights.popitem(last=False)
+
+        return self.version
+
+    def encode(self, base_version=None):
+        """ Encode the latest weights for a receiver who has base_version,
+        fall back to a full snapshot if base_version is not in history """
+        weights = self.weights[self.version]
+        if self.delta and base_version in self.weights and base_version != self.version:
+            uint = _UINT[self.dtype]
+            data = weights.view(uint) ^ self.weights[base_version].view(uint)
+        else:
+            base_version = None
+            data = weights
+
+        return dict(version=self.version,
+                    base_version=base_version,
+                    dtype=self.dtype,
+                    compression=self.compression,
+                    data=_compress(data, self.compression))
+
+
+class WeightDecoder:
+    """ Interface """
+    def __init__(self):
+        self.version = 0
+        self.weights = None         # weights in the payload dtype, the reference for delta payloads
+        self.nbytes = 0             # size of the last payload
+
+    def decode(self, payload):
+        """ Return float32 flat weights, or None if payload is a delta against
+        a version other than self.version, in which case a full snapshot is required """
+        if isinstance(payload, np.ndarray):
+            # plain flat weights
+            self.nbytes = payload.nbytes
+            return payload
+        self.nbytes = payload_nbytes(payload)
+        dtype = payload['dtype']
+        data = _decompress(payload['data'], payload['compression'], dtype)
+        if payload['base_version'] is not None:
+            if payload['base_version'] != self.version:
+                return None
+            uint = _UINT[dtype]
+            data = (data.view(uint) ^ self.weights.view(uint)).view(dtype)
+        self.weights = data
+        self.version = payload['version']
+
+        return data.astype(np.float32)
+
+
+if __name__ == '__main__':
+    # bytes and latency of each codec option on weights of the size of SAC nets with 512-512-256 units
+    # python -m utility.weight_codec
+    import time
+    import itertools
+
+    def mlp_size(units, in_dim, out_dim):
+        dims = [in_dim] + units + [out_dim]
+        return sum((i + 1) * o for i, o in zip(dims[:-1], dims[1:]))
+
+    state_dim, action_dim = 24, 4
+    units = [512, 512, 256]
+    size = mlp_size(units, state_dim, 2 * action_dim) + 2 * mlp_size(units, state_dim + action_dim, 1)
+    flat = np.random.normal(scale=.05, size=size).astype(np.float32)
+    n = 20
+    try:
+        import lz4.frame
+        compressions = [None, 'lz4']
+    except ImportError:
+        print('lz4 is not installed, only uncompressed options are benchmarked')
+        compressions = [None]
+    print(f'{size} parameters, {flat.nbytes / 2**20:.2f}MB in float32')
+
+    for dtype, delta, compression in itertools.product(['float32', 'float16'], [None, 'xor'], compressions):
+        encoder = WeightEncoder(dtype=dtype, delta=delta, compression=compression)
+        decoder = WeightDecoder()
+        w = flat.copy()
+        encoder.push(w)
+        decoder.decode(encoder.encode(None))
+        nbytes, encode_time, decode_time, error = [], 0, 0, 0
+        for _ in range(n):
+            # mimic an optimizer step, where every parameter moves by about the learning rate
+            w = w + 3e-4 * np.random.normal(size=size).astype(np.float32)
+            encoder.push(w)
+            start = time.time()
+            payload = encoder.encode(decoder.version)
+            encode_time += time.time() - start
+            start = time.time()
+            decoded = decoder.decode(payload)
+            decode_time += time.time() - start
+            nbytes.append(payload_nbytes(payload))
+            error = max(error, np.max(np.abs(decoded - w)))
+        print(f'dtype={dtype:8s}delta={str(delta):6s}compression={str(compression):6s}'
+              f'payload {np.mean(nbytes) / 2**20:.2f}MB\t'
+              f'encode {encode_time / n * 1e3:.2f}ms\tdecode {decode_time / n * 1e3:.2f}ms\t'
+              f'max error {error:.2e}')